@@ -1,8 +1,13 @@
 from flask import Flask
 from flask_cors import CORS
 
+from .core.startup import Startup
 from .webapp.routes import api_bp
 
 app = Flask(__name__)
 CORS(app)
 app.register_blueprint(api_bp)
+
+# importing the package has no side effects, the process serving the api
+# brings the device up with Startup.start() (see start.py); the bring-up
+# runs in the background, GET /ready reports when it is done
@@ -36,6 +36,8 @@ class InvalidRange(InvalidAddress, ValueError):
 
 class Address():
 
+    FUSES_PER_CHIP = 16
+
     REGISTER_ADDRESSES = {
         'lock': 0x00,
         'error_control': 0x01,
@@ -54,26 +56,19 @@ class Address():
         for key, value in MASKS.items()
     }
 
-    ADDRESS_TUPLE_RANGE = product(
-        Config.get('i2c', 'chip_addresses').values(),
-        [
-            REGISTER_ADDRESSES['lock'],
-            REGISTER_ADDRESSES['error_control'],
-            *REGISTER_ADDRESSES['fuse'],
-            *REGISTER_ADDRESSES['error']
-        ]
+    # the letter syntax ("b4:2") is only a parsing and display layer,
+    # internally a fuse is identified by chip_index * 16 + fuse number
+    _REGEX = re.compile(
+        r"^\s*(?P<letter>[A-Za-z]+)(?P<number>[0-9]+)"
+        r"(:(?P<range>[0-9]+))?\s*$"
+    )
+    # inclusive fuse range on one chip, e.g. "a0-15"
+    _RANGE_REGEX = re.compile(
+        r"^\s*(?P<letter>[A-Za-z]+)(?P<first>[0-9]+)-(?P<last>[0-9]+)\s*$"
     )
 
-    _REGEX_STRINGS = {
-        'letter': r"(?P<letter>[A-Za-z])",
-        'number': r"([A-Za-z])(?P<number>[0-9]|(1[0-5]))(:|$)",
-        'range': r"(:)(?P<range>[1-4])"
-    }
-
-    _REGEX_MODULES = {
-        key: re.compile(value)
-        for key, value in _REGEX_STRINGS.items()
-    }
+    _chip_table = None
+    _cache = dict()
 
     def __init__(self, raw_address):
         self._raw_address = raw_address
@@ -84,8 +79,24 @@ class Address():
         self._extract_components()
         self._validate_components()
 
-        self._chip_address = None
-        self._read_chip_address()
+        self._init_fuse(
+            Address._chips()['indices'][self._letter] * Address.FUSES_PER_CHIP
+            + self._number,
+            self._range
+        )
+
+    def _init_fuse(self, fuse_id, range_):
+        chips = Address._chips()
+        self._fuse_id = fuse_id
+        self._chip_index, self._number = divmod(
+            fuse_id, Address.FUSES_PER_CHIP
+        )
+        self._range = range_
+        self._fuse_bitmask = ((1 << range_) - 1) << fuse_id
+        self._letter = chips['letters'][self._chip_index]
+
+        self._chip_address = chips['chip_addresses'][self._chip_index]
+        self._bus_address = chips['bus_addresses'][self._chip_index]
 
         self._fuse_address = None
         self._error_address = None
@@ -95,38 +106,46 @@ class Address():
         self._error_mask = 0x00
         self._calc_register_masks()
 
+    @classmethod
+    def _chips(cls):
+        if cls._chip_table is None:
+            letters = [
+                letter.lower()
+                for letter in Config.get('i2c', 'chip_addresses').keys()
+            ]
+            bus_addresses = cls.chip_bus_addresses()
+            cls._chip_table = {
+                'letters': letters,
+                'indices': {
+                    letter: idx for idx, letter in enumerate(letters)
+                },
+                'chip_addresses': list(
+                    Config.get('i2c', 'chip_addresses').values()
+                ),
+                'bus_addresses': list(bus_addresses.values())
+            }
+        return cls._chip_table
+
     def _extract_components(self):
-        letter_match = Address._REGEX_MODULES['letter'].search(
-            self._raw_address)
-        number_match = Address._REGEX_MODULES['number'].search(
-            self._raw_address)
-        range_match = Address._REGEX_MODULES['range'].search(
-            self._raw_address)
-
-        if letter_match is None or number_match is None:
+        match = Address._REGEX.match(self._raw_address)
+        if match is None:
             raise AddressSyntaxError(self._raw_address)
 
-        self._letter = letter_match.group('letter').lower()
-        self._number = int(number_match.group('number'))
-        self._range = 1 if range_match is None \
-            else int(range_match.group('range'))
+        self._letter = match.group('letter').lower()
+        self._number = int(match.group('number'))
+        self._range = 1 if match.group('range') is None \
+            else int(match.group('range'))
 
     def _validate_components(self):
-        if not any([
-            (self._letter in [chip.lower(), chip.upper()])
-            for chip in Config.get('i2c', 'chip_addresses').keys()
-        ]):
+        if self._letter not in Address._chips()['indices']:
             raise InvalidChip(self._raw_address)
 
-        if self._number not in range(0, 16):
+        if self._number not in range(0, Address.FUSES_PER_CHIP):
             raise InvalidFuse(self._raw_address)
 
-        if self._range > 4 - (self._number % 4):
+        if not 1 <= self._range <= 4 - (self._number % 4):
             raise InvalidRange(self._raw_address)
 
-    def _read_chip_address(self):
-        self._chip_address = Config.get('i2c', 'chip_addresses')[self._letter]
-
     def _calc_register_addresses(self):
         self._fuse_address = Address.REGISTER_ADDRESSES['fuse'][
             self._number // 4
@@ -146,10 +165,30 @@ class Address():
     def raw_address(self):
         return f"{self._letter}{self._number}:{self._range}"
 
+    @property
+    def fuse_id(self):
+        return self._fuse_id
+
+    @property
+    def fuse_ids(self):
+        return range(self._fuse_id, self._fuse_id + self._range)
+
+    @property
+    def fuse_bitmask(self):
+        return self._fuse_bitmask
+
+    @property
+    def chip_index(self):
+        return self._chip_index
+
     @property
     def chip_address(self):
         return self._chip_address
 
+    @property
+    def bus_address(self):
+        return self._bus_address
+
     @property
     def register_address(self):
         return self._fuse_address
@@ -186,11 +225,121 @@ class Address():
         return self._range
 
     @classmethod
-    def full_address_list(self):
+    def parse(cls, raw_address):
+        # addresses are immutable, so parsed ones are shared; keyed on the
+        # components and only filled with valid addresses, the cache holds
+        # at most every fuse with every range
+        match = cls._REGEX.match(raw_address)
+        if match is None:
+            raise AddressSyntaxError(raw_address)
+        key = (
+            match.group('letter').lower(),
+            int(match.group('number')),
+            1 if match.group('range') is None else int(match.group('range'))
+        )
+        address = cls._cache.get(key)
+        if address is None:
+            address = Address(raw_address)
+            cls._cache[key] = address
+        return address
+
+    @classmethod
+    def parse_expression(cls, expression):
+        # a single address or a fuse range, ranges are split into the
+        # fewest addresses that each stay within one fuse register
+        match = cls._RANGE_REGEX.match(expression)
+        if match is None:
+            return [cls.parse(expression)]
+
+        letter = match.group('letter').lower()
+        first, last = int(match.group('first')), int(match.group('last'))
+        if letter not in cls._chips()['indices']:
+            raise InvalidChip(expression)
+        if not 0 <= first < cls.FUSES_PER_CHIP or \
+                not 0 <= last < cls.FUSES_PER_CHIP:
+            raise InvalidFuse(expression)
+        if last < first:
+            raise InvalidRange(expression)
+
+        addresses = list()
+        number = first
+        while number <= last:
+            range_ = min(4 - number % 4, last - number + 1)
+            addresses.append(cls.parse(f"{letter}{number}:{range_}"))
+            number += range_
+        return addresses
+
+    @classmethod
+    def from_fuse_id(cls, fuse_id, range_=1):
+        if not 0 <= fuse_id < cls.n_fuses():
+            raise InvalidFuse(fuse_id)
+        if not 1 <= range_ <= 4 - (fuse_id % 4):
+            raise InvalidRange(fuse_id)
+        address = cls.__new__(cls)
+        address._raw_address = None
+        address._init_fuse(fuse_id, range_)
+        return address
+
+    @classmethod
+    def address_tuple_range(cls):
+        # every (chip address, register address) pair in use
+        return product(
+            Config.get('i2c', 'chip_addresses').values(),
+            [
+                Address.REGISTER_ADDRESSES['lock'],
+                Address.REGISTER_ADDRESSES['error_control'],
+                *Address.REGISTER_ADDRESSES['fuse'],
+                *Address.REGISTER_ADDRESSES['error']
+            ]
+        )
+
+    @classmethod
+    def n_chips(cls):
+        return len(cls._chips()['letters'])
+
+    @classmethod
+    def n_fuses(cls):
+        return cls.n_chips() * cls.FUSES_PER_CHIP
+
+    @classmethod
+    def chip_letters(cls):
+        return cls._chips()['letters']
+
+    @classmethod
+    def group_by_chip(cls, fuse_values):
+        # display layer: turns a list indexed by fuse id into
+        # {letter: [16 values]}
+        return {
+            letter: fuse_values[
+                idx * cls.FUSES_PER_CHIP:(idx + 1) * cls.FUSES_PER_CHIP
+            ]
+            for idx, letter in enumerate(cls._chips()['letters'])
+        }
+
+    @classmethod
+    def chip_bus_addresses(cls):
+        chip_buses = Config.get('i2c', 'chip_buses')
+        default_bus = Config.get('i2c', 'bus_address')
+        return {
+            chip_letter: chip_buses.get(chip_letter, default_bus)
+            for chip_letter in Config.get('i2c', 'chip_addresses').keys()
+        }
+
+    @classmethod
+    def full_address_list(cls):
         return [
-            Address(letter + str(number))
-            for letter, number in product(
-                Config.get('i2c', 'chip_addresses').keys(),
-                range(16)
-            )
+            Address.from_fuse_id(fuse_id)
+            for fuse_id in range(cls.n_fuses())
         ]
+
+    @classmethod
+    def addresses_from_bitmask(cls, bitmask):
+        # raw single fuse addresses of all bits set in a fuse id bitmask
+        raw_addresses = list()
+        while bitmask:
+            low_bit = bitmask & -bitmask
+            raw_addresses.append(
+                Address.from_fuse_id(low_bit.bit_length() - 1).raw_address
+            )
+            bitmask ^= low_bit
+        return raw_addresses
@@ -0,0 +1,157 @@
+import math
+
+from .config import Config
+from .fire_command import FireCommand
+from .program import Program
+from .timestamp import Timestamp
+
+# every byte on the bus takes 9 clocks (8 data bits and the ack), start,
+# repeated start and stop conditions count as one clock each
+READ_CLOCKS = 4 * 9 + 3   # address, register, address, data
+WRITE_CLOCKS = 3 * 9 + 2  # address, register, data
+
+
+class BusPlannerError(Exception):
+    pass
+
+
+class InvalidTolerance(BusPlannerError, ValueError):
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+
+
+class BusPlanner():
+    # estimates the i2c traffic of a program: every fuse register touched
+    # by a frame costs one read-modify-write when the frame is lit and one
+    # more when it is unlit after the ignition time, buses work in parallel
+
+    @classmethod
+    def transaction_time(cls):
+        return (
+            (READ_CLOCKS + WRITE_CLOCKS)
+            / Config.get('bus_planner', 'bus_speed')
+            + 2 * Config.get('bus_planner', 'transaction_overhead')
+        )
+
+    @classmethod
+    def _ignition_deciseconds(cls):
+        return round(Config.get('timings', 'ignition') * 10)
+
+    @classmethod
+    def _register_key(cls, address):
+        return (
+            address.bus_address, address.chip_address,
+            address.register_address
+        )
+
+    @classmethod
+    def _frames(cls, program):
+        # (deciseconds, commands) of every frame in time order
+        frames = list()
+        for command in program.schedule:
+            deciseconds = command.timestamp.total_deciseconds
+            if len(frames) == 0 or frames[-1][0] != deciseconds:
+                frames.append((deciseconds, list()))
+            frames[-1][1].append(command)
+        return frames
+
+    @classmethod
+    def _load(cls, frames):
+        # registers written per (deciseconds, bus address)
+        ignition = cls._ignition_deciseconds()
+        load = dict()
+        for deciseconds, commands in frames:
+            for command in commands:
+                key = cls._register_key(command.address)
+                for slot in (deciseconds, deciseconds + ignition):
+                    load.setdefault((slot, key[0]), set()).add(key[1:])
+        return load
+
+    @classmethod
+    def plan(cls, program):
+        transaction_time = cls.transaction_time()
+        window = Config.get('bus_planner', 'window')
+        frames = cls._frames(program)
+
+        slots = list()
+        for (deciseconds, bus_address), registers \
+                in sorted(cls._load(frames).items()):
+            busy = len(registers) * transaction_time
+            slots.append({
+                'time': deciseconds / 10,
+                'bus': bus_address,
+                'transactions': len(registers),
+                'busy': busy,
+                'utilization': busy / window
+            })
+
+        infeasible = [slot for slot in slots if slot['utilization'] > 1.0]
+        peak = max(slots, key=lambda slot: slot['utilization'], default=None)
+        return {
+            'bus_speed': Config.get('bus_planner', 'bus_speed'),
+            'window': window,
+            'transaction_time': transaction_time,
+            'frames': len(frames),
+            'peak': peak,
+            'n_infeasible': len(infeasible),
+            'infeasible':
+                infeasible[:Config.get('bus_planner', 'max_reported')]
+        }
+
+    @classmethod
+    def shift(cls, program, tolerance):
+        # moves register writes that do not fit into the window of their
+        # frame to later deciseconds, at most tolerance seconds after their
+        # cue; registers that fit nowhere keep their time
+        if tolerance < 0:
+            raise InvalidTolerance(tolerance)
+        capacity = max(1, math.floor(
+            Config.get('bus_planner', 'window') / cls.transaction_time()
+        ))
+        max_shift = math.floor(round(tolerance * 10, 6))
+        ignition = cls._ignition_deciseconds()
+
+        load = dict()
+        shifted = dict()
+
+        def fits(slot, key):
+            registers = load.get((slot, key[0]), set())
+            return key[1:] in registers or len(registers) < capacity
+
+        for deciseconds, commands in cls._frames(program):
+            units = dict()
+            for command in commands:
+                units.setdefault(
+                    cls._register_key(command.address), list()
+                ).append(command)
+
+            for key, unit_commands in units.items():
+                target = deciseconds
+                for slot in range(deciseconds, deciseconds + max_shift + 1):
+                    if fits(slot, key) and fits(slot + ignition, key):
+                        target = slot
+                        break
+                for slot in (target, target + ignition):
+                    load.setdefault((slot, key[0]), set()).add(key[1:])
+                if target != deciseconds:
+                    for command in unit_commands:
+                        shifted[id(command)] = target
+
+        if len(shifted) == 0:
+            return program
+
+        result = Program(program.name)
+        for command in program.commands:
+            timestamp = command.timestamp
+            if id(command) in shifted:
+                timestamp = Timestamp.from_total_deciseconds(
+                    shifted[id(command)]
+                )
+            result.add_command(FireCommand(
+                address=command.address,
+                timestamp=timestamp,
+                name=command.name,
+                description=command.description
+            ))
+        result.finalize()
+        return result
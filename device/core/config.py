@@ -24,14 +24,20 @@ class NoConfigFile(ConfigError, OSError):
 class Config():
     _CONFIG_FILENAME = "device/config/config.json"
 
-    try:
-        with open(_CONFIG_FILENAME, 'r', encoding='utf-8') as file:
-            _config_data = json.load(file)
-    except OSError:
-        raise NoConfigFile(_CONFIG_FILENAME)
+    _config_data = None
+
+    @classmethod
+    def _load(cls):
+        try:
+            with open(cls._CONFIG_FILENAME, 'r', encoding='utf-8') as file:
+                cls._config_data = json.load(file)
+        except OSError:
+            raise NoConfigFile(cls._CONFIG_FILENAME)
 
     @classmethod
     def get(cls, category, key):
+        if cls._config_data is None:
+            cls._load()
         if category not in cls._config_data:
             raise InvalidCategory(category)
         if key not in cls._config_data[category]:
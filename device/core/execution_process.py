@@ -0,0 +1,224 @@
+import multiprocessing
+import time
+from functools import wraps
+from threading import Lock, Thread
+
+from .config import Config
+from .status_board import StatusBoard, StatusBoardError
+
+
+class ExecutionProcessError(Exception):
+    pass
+
+
+class ExecutionProcessDied(ExecutionProcessError, RuntimeError):
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+
+
+class ReadOnlyProcess(ExecutionProcessError, PermissionError):
+    def __init__(self, target, method):
+        self.target = target
+        self.method = method
+
+
+def _targets():
+    from .fire_controller import FireController
+    from .hardware_controller import HardwareController
+    from .metrics import Metrics
+    from .profiler import Profiler
+
+    return {
+        'fire_controller': FireController,
+        'hardware_controller': HardwareController,
+        'metrics': Metrics,
+        'profiler': Profiler
+    }
+
+
+def isolated(target):
+    # forwards the call to the execution process if there is one, so the
+    # api side never touches programs or the bus itself
+    def decorator(func):
+        inner = func.__func__ \
+            if isinstance(func, (classmethod, staticmethod)) else func
+
+        @wraps(inner)
+        def wrapper(*args, **kwargs):
+            if ExecutionProcess.is_active():
+                return ExecutionProcess.call(
+                    target, inner.__name__, *args, **kwargs
+                )
+            if ExecutionProcess.is_reader():
+                raise ReadOnlyProcess(target, inner.__name__)
+            if isinstance(func, classmethod):
+                return inner(_targets()[target], *args, **kwargs)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _execution_main(connection):
+    from .startup import Startup
+    from .status_publisher import StatusPublisher
+
+    targets = _targets()
+    # the first message tells the api process the bring-up is done and
+    # how each step went, failed steps do not keep the process from serving
+    connection.send(Startup.run_steps(Startup.local_steps()))
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        target, method, args, kwargs = message
+        try:
+            result = (
+                True,
+                getattr(targets[target], method)(*args, **kwargs)
+            )
+        except Exception as exc:
+            # most of our exceptions can not be unpickled from args
+            result = (False, (type(exc), vars(exc)))
+        # publish before answering, so the caller reads its own changes
+        StatusPublisher.publish(hardware=(target == 'hardware_controller'))
+        connection.send(result)
+
+    StatusPublisher.stop()
+
+
+class ExecutionProcess():
+    # runs FireController and HardwareController in a dedicated process,
+    # the api process only sends commands and reads the shared status
+
+    _process = None
+    _connection = None
+    _connection_lock = Lock()
+    _status_board = None
+    _ready = False
+    _bring_up = None
+    _watch_thread = None
+
+    @classmethod
+    def is_active(cls):
+        return cls._process is not None
+
+    @classmethod
+    def is_reader(cls):
+        # reader processes (e.g. additional api workers) only serve the
+        # status published by the owning process
+        return Config.get('status_board', 'role') == 'reader'
+
+    @classmethod
+    def is_remote(cls):
+        return cls.is_active() or cls.is_reader()
+
+    @classmethod
+    def start(cls):
+        context = multiprocessing.get_context('spawn')
+        cls._connection, child_connection = context.Pipe()
+        cls._status_board = StatusBoard.create_shared()
+        cls._ready = False
+        cls._process = context.Process(
+            target=_execution_main,
+            args=(child_connection,),
+            name='__execution_process__',
+            daemon=True
+        )
+        cls._process.start()
+        child_connection.close()
+
+    @classmethod
+    def _wait_ready(cls):
+        # called with the connection lock held
+        if cls._ready:
+            return
+        try:
+            cls._bring_up = cls._connection.recv()
+        except EOFError:
+            cls._process.join()
+            raise ExecutionProcessDied(cls._process.exitcode)
+        cls._ready = True
+
+    @classmethod
+    def wait_ready(cls):
+        # returns the results of the bring-up steps of the process
+        with cls._connection_lock:
+            cls._wait_ready()
+        return cls._bring_up
+
+    @classmethod
+    def stop(cls):
+        if cls._process is None:
+            return
+        with cls._connection_lock:
+            if cls._process.is_alive():
+                cls._wait_ready()
+                cls._connection.send(None)
+        cls._process.join(timeout=Config.get('timeouts', 'program_thread'))
+        cls._process = None
+        cls._status_board.close()
+        cls._status_board = None
+
+    @classmethod
+    def call(cls, target, method, *args, **kwargs):
+        with cls._connection_lock:
+            if not cls._process.is_alive():
+                raise ExecutionProcessDied(cls._process.exitcode)
+            cls._wait_ready()
+            cls._connection.send((target, method, args, kwargs))
+            success, result = cls._connection.recv()
+        if success:
+            return result
+
+        exc_type, exc_vars = result
+        exc = exc_type.__new__(exc_type)
+        exc.__dict__.update(exc_vars)
+        raise exc
+
+    @classmethod
+    def status(cls):
+        return StatusBoard.shared().read()
+
+    @classmethod
+    def _watch_handler(cls, on_state_change):
+        # the owning process publishes right away on every state change, a
+        # new sequence number of the board is the cue to look at the state
+        last_sequence = None
+        program_state = None
+        while True:
+            time.sleep(Config.get('status_board', 'watch_period'))
+            try:
+                status_board = StatusBoard.shared()
+                sequence = status_board.sequence()
+                if sequence == last_sequence:
+                    continue
+                last_sequence = sequence
+                new_state = status_board.read()['program_state']
+            except (OSError, StatusBoardError):
+                # the owning process has not created the board (yet)
+                continue
+            if program_state is not None and new_state != program_state:
+                on_state_change(new_state)
+            program_state = new_state
+
+    @classmethod
+    def watch_state(cls, on_state_change):
+        # program state changes happen in another process when remote, they
+        # are forwarded to on_state_change from a thread of this process
+        if cls._watch_thread is not None:
+            return
+        cls._watch_thread = Thread(
+            target=cls._watch_handler,
+            args=(on_state_change,),
+            name='__STATE_WATCH_THREAD__',
+            daemon=True
+        )
+        cls._watch_thread.start()
+
+    @classmethod
+    def bitmaps(cls):
+        return cls.status()['bitmaps']
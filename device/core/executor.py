@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition, Event, Thread
+
+from .metrics import Metrics
+
+LATENESS = Metrics.histogram(
+    'device_executor_lateness_seconds',
+    "Delay between the deadline of an executor event and its execution"
+)
+CALLBACK_ERRORS = Metrics.counter(
+    'device_executor_callback_errors_total',
+    "Executor callbacks that raised"
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorEvent():
+
+    def __init__(self, deadline, callback):
+        self._deadline = deadline
+        self._callback = callback
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+
+class MonotonicClock():
+
+    @classmethod
+    def now(cls):
+        return time.monotonic()
+
+    @classmethod
+    def wait(cls, condition, timeout=None):
+        condition.wait(timeout)
+
+    @classmethod
+    def settle(cls):
+        pass
+
+
+class VirtualClock():
+    # jumps straight to the next deadline instead of sleeping, used to
+    # simulate programs faster than real time; work that takes simulated
+    # time (e.g. bus transactions) occupies the clock up to a horizon the
+    # clock catches up with once the current event is done
+
+    def __init__(self):
+        self._now = 0.0
+        self._horizon = 0.0
+        self._idle = Event()
+
+    def now(self):
+        return self._now
+
+    def wait(self, condition, timeout=None):
+        if timeout is None:
+            self._idle.set()
+            condition.wait()
+            return
+        self._now += timeout
+
+    def occupy(self, until):
+        self._horizon = max(self._horizon, until)
+
+    def settle(self):
+        self._now = max(self._now, self._horizon)
+
+    @property
+    def idle(self):
+        # set once there is nothing left to execute
+        return self._idle
+
+
+class Executor():
+    # a single thread runs all timed work (program ticks, unlighting of
+    # frames), so concurrent programs do not need a thread each; deadlines
+    # are values of the executor clock (time.monotonic() unless simulating)
+
+    _clock = MonotonicClock
+    _condition = Condition()
+    _queue = list()
+    _counter = itertools.count()
+    _thread = None
+
+    @classmethod
+    def schedule(cls, deadline, callback):
+        event = ExecutorEvent(deadline, callback)
+        with cls._condition:
+            if cls._thread is None:
+                cls._thread = Thread(
+                    target=cls._executor_handler,
+                    name='__EXECUTOR_THREAD__',
+                    daemon=True
+                )
+                cls._thread.start()
+            heapq.heappush(cls._queue, (deadline, next(cls._counter), event))
+            cls._condition.notify()
+        return event
+
+    @classmethod
+    def call_later(cls, delay, callback):
+        return cls.schedule(cls._clock.now() + delay, callback)
+
+    @classmethod
+    def call_soon(cls, callback):
+        return cls.schedule(cls._clock.now(), callback)
+
+    @classmethod
+    def now(cls):
+        return cls._clock.now()
+
+    @classmethod
+    def set_clock(cls, clock):
+        # only before anything has been scheduled
+        cls._clock = clock
+
+    @classmethod
+    def _next_event(cls):
+        with cls._condition:
+            while True:
+                if len(cls._queue) == 0:
+                    cls._clock.wait(cls._condition)
+                    continue
+                deadline, _, event = cls._queue[0]
+                if event.cancelled:
+                    heapq.heappop(cls._queue)
+                    continue
+                remaining = deadline - cls._clock.now()
+                if remaining <= 0:
+                    heapq.heappop(cls._queue)
+                    return event
+                cls._clock.wait(cls._condition, remaining)
+
+    @classmethod
+    def _executor_handler(cls):
+        while True:
+            event = cls._next_event()
+            LATENESS.observe(cls._clock.now() - event.deadline)
+            try:
+                event._callback()
+            except Exception as exc:
+                cls.report_failure(event, exc)
+            cls._clock.settle()
+
+    @classmethod
+    def report_failure(cls, event, exc):
+        # the executor thread runs everyone's timed work, a failing callback
+        # is counted and logged instead of ending it
+        CALLBACK_ERRORS.inc()
+        logger.error(
+            "Executor callback %r failed: %r", event._callback, exc,
+            exc_info=exc
+        )
@@ -1,8 +1,16 @@
-import time
-from threading import Thread
+import logging
 
 from .config import Config
+from .executor import Executor
+from .fire_journal import FAILED, LIT, UNLIT, FireJournal
 from .hardware_controller import HardwareController
+from .metrics import Metrics
+
+ON_LIT_ERRORS = Metrics.counter(
+    'device_frame_on_lit_errors_total', "Frame on_lit callbacks that raised"
+)
+
+logger = logging.getLogger(__name__)
 
 
 class FireCommandError(Exception):
@@ -32,41 +40,25 @@ class AlreadyJoined(FireCommandError):
 
 class FireCommand():
 
-    def __init__(self, address, timestamp=None, name=None, description=None):
+    def __init__(self, address, timestamp=None, name=None, description=None,
+                 fuse_board=None):
         self._address = address
+        self._fuse_board = fuse_board
         self._timestamp = timestamp
         self._name = name
         self._description = description
-        self._thread = Thread(target=self._fire_handler)
-        self._thread.name = f"__fire_thread_{self._address}__"
         self._fired = False
         self._fireing = False
 
-    def _fire_handler(self):
-        self._fireing = True
-
-        try:
-            HardwareController.light(self._address)
-        except Exception:
-            ...  # TODO
-
-        try:
-            time.sleep(Config.get('timings', 'ignition'))
-        except Exception:
-            ...  # TODO
+    def fire(self, journal_id=None):
+        FireFrame([self], self._fuse_board, journal_id=journal_id).fire()
 
-        try:
-            HardwareController.unlight(self._address)
-        except Exception:
-            ...  # TODO
+    def mark_fireing(self):
+        self._fireing = True
 
+    def mark_fired(self):
         self._fireing, self._fired = False, True
 
-    def fire(self):
-        if self._fired or self._fireing:
-            raise AlreadyFired(self._address)
-        self._thread.start()
-
     @property
     def address(self):
         return self._address
@@ -87,6 +79,90 @@ class FireCommand():
     def fired(self):
         return self._fired
 
+    @property
+    def fuse_board(self):
+        return self._fuse_board
+
+    @fuse_board.setter
+    def fuse_board(self, fuse_board):
+        self._fuse_board = fuse_board
+
     @property
     def fireing(self):
         return self._fireing
+
+
+class FireFrame():
+    # lights all commands of a frame at once and unlights them after the
+    # ignition time, both steps run on the shared executor; with a journal
+    # id both steps are journaled
+
+    def __init__(self, commands, fuse_board=None, on_lit=None,
+                 journal_id=None):
+        self._commands = commands
+        self._fuse_board = fuse_board
+        self._on_lit = on_lit
+        self._journal_id = journal_id
+        self._addresses = [command.address for command in commands]
+        self._fuse_bitmask = 0
+        for command in commands:
+            self._fuse_bitmask |= command.address.fuse_bitmask
+
+    def _journal(self, event):
+        if self._journal_id is None:
+            return
+        try:
+            FireJournal.cues(event, self._commands, self._journal_id)
+        except Exception as exc:
+            FireJournal.report_failure('cues', exc)
+
+    def _light(self):
+        try:
+            HardwareController.light_frame(self._addresses)
+            self._journal(LIT)
+        except Exception:
+            self._journal(FAILED)
+        if self._on_lit is not None:
+            try:
+                self._on_lit(self)
+            except Exception as exc:
+                # the frame is lit either way and still has to be unlit
+                ON_LIT_ERRORS.inc()
+                logger.error(
+                    "Frame on_lit callback %r failed: %r", self._on_lit, exc,
+                    exc_info=exc
+                )
+        Executor.call_later(Config.get('timings', 'ignition'), self._unlight)
+
+    def _unlight(self):
+        try:
+            HardwareController.unlight_frame(self._addresses)
+            self._journal(UNLIT)
+        except Exception:
+            self._journal(FAILED)
+
+        for command in self._commands:
+            command.mark_fired()
+        if self._fuse_board is not None:
+            self._fuse_board.fired(self._fuse_bitmask)
+
+    def fire(self, delay=None):
+        for command in self._commands:
+            if command.fired or command.fireing:
+                raise AlreadyFired(command.address)
+        for command in self._commands:
+            command.mark_fireing()
+        if self._fuse_board is not None:
+            self._fuse_board.fire(self._fuse_bitmask)
+        if delay is None:
+            Executor.call_soon(self._light)
+        else:
+            Executor.call_later(delay, self._light)
+
+    @property
+    def commands(self):
+        return self._commands
+
+    @property
+    def fuse_bitmask(self):
+        return self._fuse_bitmask
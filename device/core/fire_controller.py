@@ -1,14 +1,25 @@
+import time
 from datetime import datetime
+from functools import wraps
 from threading import Lock, Thread
 from time import sleep
 
-import dateutil.parser
-
-from .address import Address
+from .address import Address, AddressError
+from .bus_planner import BusPlanner
 from .config import Config
-from .fire_command import FireCommand
+from .execution_process import ExecutionProcess, isolated
+from .fire_command import FireCommand, FireFrame
+from .fire_journal import LOADED as LOADED_EVENT
+from .fire_journal import MANUAL, FireJournal
+from .fuse_board import VERBOSE, FuseBoard
 from .hardware_controller import HardwareController, HardwareLocked
-from .program import Program
+from .lane import Lane
+from .metrics import Metrics
+from .program import InvalidOffset, Program
+from .program_compiler import Compilation
+from .program_library import ProgramLibrary
+from .program_store import NoStoredProgram, ProgramStore
+from .program_upload import ProgramUpload
 
 
 class FireControllerError(Exception):
@@ -44,6 +55,57 @@ class NoProgramScheduled(FireControllerError):
     pass
 
 
+class UploadInProgress(FireControllerError):
+    def __init__(self, program_name):
+        self.program_name = program_name
+
+
+class NoUploadInProgress(FireControllerError):
+    pass
+
+
+class ProgramCompiling(FireControllerError):
+    def __init__(self, program_name):
+        self.program_name = program_name
+
+
+class NoCompilation(FireControllerError):
+    pass
+
+
+class UnknownLane(FireControllerError, KeyError):
+    def __init__(self, lane_name):
+        self.lane_name = lane_name
+
+
+class LaneExists(FireControllerError):
+    def __init__(self, lane_name):
+        self.lane_name = lane_name
+
+
+class LanesLoaded(FireControllerError):
+    def __init__(self, lane_names):
+        self.lane_names = lane_names
+
+
+class FusesInUse(FireControllerError):
+    def __init__(self, owner, fuse_mask):
+        self.owner = owner
+        self.fuses = Address.addresses_from_bitmask(fuse_mask)
+
+
+class InvalidFireBatch(FireControllerError, ValueError):
+    def __init__(self, errors):
+        # maps every rejected address expression to its exception
+        self.errors = errors
+
+
+class InvalidFireTime(FireControllerError, ValueError):
+    def __init__(self, fire_time, max_delay):
+        self.fire_time = fire_time
+        self.max_delay = max_delay
+
+
 class HangingScheduleThread(FireControllerError, RuntimeError):
     def __init__(self, schedule_time):
         self.schedule_time = schedule_time
@@ -56,6 +118,7 @@ PAUSED = 'paused'
 RUNNING_TL = 'running_testloop'
 PAUSED_TL = 'paused_testloop'
 SCHEDULED = 'scheduled'
+COMPILING = 'compiling'
 RUNNING_STATES = [
     RUNNING,
     RUNNING_TL
@@ -68,44 +131,83 @@ RUNNING_PAUSED_STATES = \
     RUNNING_STATES + PAUSED_STATES
 NOT_RUNNING_STATES = [
     LOADED,
-    UNLOADED
+    UNLOADED,
+    COMPILING
 ]
 
+# owner reported by FusesInUse for manual frames waiting to be lit
+MANUAL_OWNER = 'manual'
+
+
+INTERACTIONS = Metrics.counter(
+    'device_interaction_lock_acquisitions_total',
+    "Acquisitions of the interaction lock"
+)
+INTERACTIONS_CONTENDED = Metrics.counter(
+    'device_interaction_lock_contended_total',
+    "Acquisitions of the interaction lock that had to wait"
+)
+INTERACTION_WAIT = Metrics.histogram(
+    'device_interaction_lock_wait_seconds',
+    "Time waited for the interaction lock when contended"
+)
+
 
 def lock_interaction(func):
+    @wraps(func.__func__ if isinstance(func, (classmethod, staticmethod))
+           else func)
     def wrapper(*args, **kwargs):
-        FireController._interaction_lock.acquire(blocking=True)
+        if not FireController._interaction_lock.acquire(blocking=False):
+            INTERACTIONS_CONTENDED.inc()
+            start = time.perf_counter()
+            FireController._interaction_lock.acquire(blocking=True)
+            INTERACTION_WAIT.observe(time.perf_counter() - start)
+        INTERACTIONS.inc()
         try:
             if isinstance(func, (classmethod, staticmethod)):
-                func.__func__(FireController, *args, **kwargs)
+                result = func.__func__(FireController, *args, **kwargs)
             else:
-                func(*args, **kwargs)
+                result = func(*args, **kwargs)
         except Exception:
             FireController._interaction_lock.release()
             raise
         FireController._interaction_lock.release()
+        return result
     return wrapper
 
 
 def raise_on_lock(func):
+    @wraps(func)
     def wrapper(*args, **kwargs):
         if HardwareController.is_locked():
             raise HardwareLocked()
         else:
-            func(*args, **kwargs)
+            return func(*args, **kwargs)
     return wrapper
 
 
 class FireController():
     _program_state = UNLOADED
     _interaction_lock = Lock()
+    _upload_lock = Lock()
+    _upload = None
+    _compilation = None
+    _lanes = dict()
     _program = None
     _testloop_program = None
+    _testloop_results = None
     _schedule_thread = None
     _scheduled_time = None
+    _start_offset = 0.0
 
     _unschedule_flag = False
 
+    # fuse masks of manual frames waiting to be lit, by frame
+    _manual_frames = dict()
+    _manual_frames_lock = Lock()
+
+    _state_listeners = list()
+
     @classmethod
     def raise_on_state(
         cls, states, exception, *exception_args, **exception_kwargs
@@ -115,18 +217,149 @@ class FireController():
         if cls._program_state in states:
             raise exception(*exception_args, **exception_kwargs)
 
+    @classmethod
+    def _raise_on_compiling(cls):
+        if cls._program_state == COMPILING:
+            raise ProgramCompiling(cls._compilation.program_name)
+
+    @isolated('fire_controller')
     @lock_interaction
     @classmethod
-    def load_program(cls, commands, program_name):
+    def load_program(cls, commands, program_name, shift_tolerance=None):
         cls.raise_on_state(RUNNING_STATES, ProgramRunning)
         cls.raise_on_state(
             SCHEDULED, ProgramScheduled, cls._scheduled_time
         )
         cls.raise_on_state(LOADED, ProgramLoaded)
+        cls._raise_on_compiling()
+
+        compilation = Compilation(commands, program_name, shift_tolerance)
+        cls._compilation = compilation
+        cls.set_program_state(COMPILING)
+        compilation.start(callback=cls._compilation_callback)
+        return compilation.progress
+
+    @classmethod
+    def _compilation_callback(cls, compilation, program):
+        # swaps the compiled program in, unless the compilation has been
+        # cancelled or replaced in the meantime
+        with cls._interaction_lock:
+            if compilation is not cls._compilation or \
+                    cls._program_state != COMPILING:
+                return False
+            if program is None or compilation.cancelled:
+                cls.set_program_state(UNLOADED)
+                return False
+            try:
+                cls._set_program(program)
+            except Exception:
+                cls.set_program_state(UNLOADED)
+                raise
+            return True
 
-        cls._program = Program.from_command_list(commands, program_name)
-        cls._program_state = LOADED
+    @isolated('fire_controller')
+    @classmethod
+    def cancel_compilation(cls):
+        # no interaction lock, the compilation thread needs it to finish
+        compilation = cls._compilation
+        if compilation is None or compilation.finished:
+            raise NoCompilation()
+        compilation.cancel()
+
+    @isolated('fire_controller')
+    @classmethod
+    def get_compilation_progress(cls):
+        compilation = cls._compilation
+        if compilation is None:
+            raise NoCompilation()
+        return compilation.progress
 
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def load_binary_program(cls, data, program_name=None):
+        cls.raise_on_state(RUNNING_STATES, ProgramRunning)
+        cls.raise_on_state(
+            SCHEDULED, ProgramScheduled, cls._scheduled_time
+        )
+        cls.raise_on_state(LOADED, ProgramLoaded)
+        cls._raise_on_compiling()
+
+        return cls._set_program(Program.from_binary(data, program_name))
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def load_program_by_hash(cls, content_hash):
+        cls.raise_on_state(RUNNING_STATES, ProgramRunning)
+        cls.raise_on_state(
+            SCHEDULED, ProgramScheduled, cls._scheduled_time
+        )
+        cls.raise_on_state(LOADED, ProgramLoaded)
+        cls._raise_on_compiling()
+
+        return cls._set_program(ProgramLibrary.get(content_hash))
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def export_program(cls):
+        if cls._program is None:
+            raise NoProgramLoaded()
+        return cls._program.to_binary()
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def begin_upload(cls, program_name):
+        cls.raise_on_state(RUNNING_STATES, ProgramRunning)
+        cls.raise_on_state(
+            SCHEDULED, ProgramScheduled, cls._scheduled_time
+        )
+        cls.raise_on_state(LOADED, ProgramLoaded)
+        cls._raise_on_compiling()
+        if cls._upload is not None:
+            raise UploadInProgress(cls._upload.name)
+
+        cls._upload = ProgramUpload(program_name)
+
+    @isolated('fire_controller')
+    @classmethod
+    def append_upload(cls, commands, offset=None):
+        # parsing happens outside of _interaction_lock so that control
+        # requests are not blocked by large uploads
+        with cls._upload_lock:
+            if cls._upload is None:
+                raise NoUploadInProgress()
+            cls._upload.append(commands, offset)
+            return cls._upload.n_received
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def commit_upload(cls):
+        cls.raise_on_state(RUNNING_STATES, ProgramRunning)
+        cls.raise_on_state(
+            SCHEDULED, ProgramScheduled, cls._scheduled_time
+        )
+        cls.raise_on_state(LOADED, ProgramLoaded)
+        cls._raise_on_compiling()
+
+        with cls._upload_lock:
+            if cls._upload is None:
+                raise NoUploadInProgress()
+            upload, cls._upload = cls._upload, None
+        return cls._set_program(upload.commit())
+
+    @isolated('fire_controller')
+    @classmethod
+    def abort_upload(cls):
+        with cls._upload_lock:
+            if cls._upload is None:
+                raise NoUploadInProgress()
+            cls._upload = None
+
+    @isolated('fire_controller')
     @lock_interaction
     @classmethod
     def delete_program(cls):
@@ -134,21 +367,48 @@ class FireController():
         cls.raise_on_state(SCHEDULED,
                            ProgramScheduled, cls._scheduled_time)
         cls.raise_on_state(UNLOADED, NoProgramLoaded)
+        cls._raise_on_compiling()
 
         cls._program = None
-        cls._program_state = UNLOADED
+        cls.set_program_state(UNLOADED)
+        ProgramStore.clear()
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def restore_program(cls):
+        cls.raise_on_state(RUNNING_PAUSED_STATES, ProgramRunning)
+        cls.raise_on_state(SCHEDULED,
+                           ProgramScheduled, cls._scheduled_time)
+        cls.raise_on_state(LOADED, ProgramLoaded)
+        cls._raise_on_compiling()
 
+        try:
+            program = ProgramStore.load()
+        except NoStoredProgram:
+            return False
+        cls._prepare_program(program)
+        cls._program = program
+        cls.set_program_state(LOADED)
+        return True
+
+    @isolated('fire_controller')
     @raise_on_lock
     @lock_interaction
     @classmethod
-    def run_program(cls):
+    def run_program(cls, start_offset=0.0):
         cls.raise_on_state(RUNNING_PAUSED_STATES, ProgramRunning)
         cls.raise_on_state(SCHEDULED,
                            ProgramScheduled, cls._scheduled_time)
         cls.raise_on_state(UNLOADED, NoProgramLoaded)
+        cls._raise_on_compiling()
+        if start_offset < 0:
+            raise InvalidOffset(start_offset)
 
+        cls._start_offset = start_offset
         cls._run_program()
 
+    @isolated('fire_controller')
     @lock_interaction
     @classmethod
     def pause_program(cls):
@@ -159,10 +419,11 @@ class FireController():
 
         cls._program.pause()
         if cls._program_state is RUNNING_TL:
-            cls._program_state = PAUSED_TL
+            cls.set_program_state(PAUSED_TL)
         else:
-            cls._program_state = PAUSED
+            cls.set_program_state(PAUSED)
 
+    @isolated('fire_controller')
     @raise_on_lock
     @lock_interaction
     @classmethod
@@ -174,10 +435,11 @@ class FireController():
 
         cls._program.continue_()
         if cls._program_state is PAUSED_TL:
-            cls._program_state = RUNNING_TL
+            cls.set_program_state(RUNNING_TL)
         else:
-            cls._program_state = RUNNING
+            cls.set_program_state(RUNNING)
 
+    @isolated('fire_controller')
     @lock_interaction
     @classmethod
     def stop_program(cls):
@@ -185,17 +447,27 @@ class FireController():
         cls.raise_on_state(SCHEDULED,
                            ProgramScheduled, cls._scheduled_time)
 
+        # the execution callback unloads the program, fired fuses can not
+        # be loaded again
         cls._program.stop()
-        cls._program_state = LOADED
 
+    @isolated('fire_controller')
     @raise_on_lock
     @lock_interaction
     @classmethod
-    def schedule_program(cls, scheduled_time):
+    def schedule_program(cls, scheduled_time, start_offset=0.0):
         cls.raise_on_state(RUNNING_STATES, ProgramRunning)
         cls.raise_on_state(SCHEDULED,
                            ProgramScheduled, cls._scheduled_time)
         cls.raise_on_state(UNLOADED, NoProgramLoaded)
+        cls._raise_on_compiling()
+        if start_offset < 0:
+            raise InvalidOffset(start_offset)
+
+        cls._start_offset = start_offset
+
+        # dateutil is only needed here, it stays out of the startup path
+        import dateutil.parser
 
         cls._schedule_thread = Thread(
             target=cls._schedule_handler,
@@ -205,8 +477,9 @@ class FireController():
             scheduled_time
         ).replace(tzinfo=None)
         cls._schedule_thread.start()
-        cls._program_state = SCHEDULED
+        cls.set_program_state(SCHEDULED)
 
+    @isolated('fire_controller')
     @lock_interaction
     @classmethod
     def unschedule_program(cls):
@@ -220,47 +493,317 @@ class FireController():
         if cls._schedule_thread.is_alive():
             raise HangingScheduleThread(cls._scheduled_time)
         cls._schedule_thread = None
-        cls._program_state = LOADED
+        cls.set_program_state(LOADED)
 
+    @isolated('fire_controller')
     @raise_on_lock
     @lock_interaction
     @classmethod
-    def fire(cls, raw_address):
+    def fire(cls, raw_addresses, fire_time=None):
+        # raw_addresses is one address expression or a list of them, the
+        # whole batch is validated before anything fires and then fires as
+        # one frame, optionally at fire_time (iso format, shortly ahead)
         cls.raise_on_state(RUNNING_STATES, ProgramRunning)
         cls.raise_on_state(LOADED, ProgramLoaded)
         cls.raise_on_state(SCHEDULED,
                            ProgramScheduled, cls._scheduled_time)
 
-        address = Address(raw_address)
-        command = FireCommand(address, None)
-        command.fire()
+        if isinstance(raw_addresses, str):
+            raw_addresses = [raw_addresses]
+        if len(raw_addresses) == 0:
+            raise InvalidFireBatch(dict())
+        if fire_time is not None:
+            fire_time = cls._parse_fire_time(fire_time)
+
+        owners = cls._fuse_owners()
+        batch_owners = list()
+        results = list()
+        commands = list()
+        errors = dict()
+        for raw_address in raw_addresses:
+            try:
+                addresses = Address.parse_expression(raw_address)
+                fuse_mask = 0
+                for address in addresses:
+                    fuse_mask |= address.fuse_bitmask
+                for owner, owner_mask in owners + batch_owners:
+                    if fuse_mask & owner_mask:
+                        raise FusesInUse(owner, fuse_mask & owner_mask)
+            except (AddressError, FusesInUse) as exc:
+                errors[raw_address] = {
+                    'exception_type': type(exc).__name__,
+                    'exception_args': vars(exc)
+                }
+                continue
+            batch_owners.append((raw_address, fuse_mask))
+            results.append({
+                'address': raw_address,
+                'fuses': [address.raw_address for address in addresses]
+            })
+            commands.extend(FireCommand(address) for address in addresses)
+        if len(errors) > 0:
+            raise InvalidFireBatch(errors)
+
+        delay = None
+        if fire_time is not None:
+            delay = max(0.0, (fire_time - datetime.now()).total_seconds())
+        # the fuses stay reserved until the frame is lit, so nothing loaded
+        # or fired in the meantime can claim them
+        frame = FireFrame(
+            commands, on_lit=cls._release_manual_frame, journal_id=MANUAL
+        )
+        with cls._manual_frames_lock:
+            cls._manual_frames[frame] = frame.fuse_bitmask
+        try:
+            frame.fire(delay)
+        except Exception:
+            cls._release_manual_frame(frame)
+            raise
+        return {
+            'fire_time': None if fire_time is None else fire_time.isoformat(),
+            'results': results
+        }
 
+    @classmethod
+    def _parse_fire_time(cls, raw_fire_time):
+        fire_time = datetime.fromisoformat(raw_fire_time)
+        if fire_time.tzinfo is not None:
+            fire_time = fire_time.astimezone().replace(tzinfo=None)
+        max_delay = Config.get('manual_fire', 'max_delay')
+        if not 0 <= (fire_time - datetime.now()).total_seconds() <= max_delay:
+            raise InvalidFireTime(raw_fire_time, max_delay)
+        return fire_time
+
+    @isolated('fire_controller')
     @raise_on_lock
     @lock_interaction
     @classmethod
-    def testloop(cls):
+    def testloop(cls, pattern=None, verify=None):
         cls.raise_on_state(RUNNING_STATES, ProgramRunning)
         cls.raise_on_state(LOADED, ProgramLoaded)
+        cls._raise_on_compiling()
         cls.raise_on_state(SCHEDULED,
                            ProgramScheduled, cls._scheduled_time)
-
-        cls._testloop_program = Program.testloop_program()
+        if len(cls._lanes) > 0:
+            raise LanesLoaded(list(cls._lanes))
+
+        if pattern is None:
+            pattern = Config.get('testloop', 'pattern')
+        if verify is None:
+            verify = Config.get('testloop', 'verify')
+        cls._testloop_program = Program.testloop_program(pattern, verify)
+        cls._testloop_results = {
+            'pattern': pattern,
+            'verify': verify,
+            'steps': cls._testloop_program.test_results
+        }
         cls._testloop_program.run(
             callback=cls._testloop_execution_callback_factory()
         )
-        cls._program_state = RUNNING_TL
+        cls.set_program_state(RUNNING_TL)
+
+    @isolated('fire_controller')
+    @classmethod
+    def get_testloop_results(cls):
+        if cls._testloop_results is None:
+            return None
+        return dict(
+            cls._testloop_results,
+            steps=list(cls._testloop_results['steps'])
+        )
+
+    @classmethod
+    def _release_manual_frame(cls, frame):
+        with cls._manual_frames_lock:
+            cls._manual_frames.pop(frame, None)
+
+    @classmethod
+    def _fuse_owners(cls, exclude_lane=None):
+        owners = list()
+        if cls._program is not None:
+            owners.append((None, cls._program.fuse_mask))
+        for lane_name, lane in cls._lanes.items():
+            if lane_name != exclude_lane:
+                owners.append((lane_name, lane.fuse_mask))
+        with cls._manual_frames_lock:
+            owners.extend(
+                (MANUAL_OWNER, fuse_mask)
+                for fuse_mask in cls._manual_frames.values()
+            )
+        return owners
+
+    @classmethod
+    def _raise_on_fuses_in_use(cls, fuse_mask, exclude_lane=None):
+        # lanes, the main program and manual fireing never share a fuse
+        for owner, owner_mask in cls._fuse_owners(exclude_lane):
+            if fuse_mask & owner_mask:
+                raise FusesInUse(owner, fuse_mask & owner_mask)
+
+    @classmethod
+    def _get_lane(cls, lane_name):
+        try:
+            return cls._lanes[lane_name]
+        except KeyError:
+            raise UnknownLane(lane_name)
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def load_lane(
+        cls, lane_name, commands=None, program_name=None, content_hash=None
+    ):
+        if lane_name in cls._lanes:
+            raise LaneExists(lane_name)
+        if content_hash is not None:
+            program = ProgramLibrary.get(content_hash)
+        else:
+            program = Program.from_command_list(commands, program_name)
+        cls._raise_on_fuses_in_use(program.fuse_mask)
+
+        content_hash = cls._add_to_library(program)
+        cls._prepare_program(program)
+        cls._lanes[lane_name] = Lane(lane_name, program)
+        return content_hash
+
+    @isolated('fire_controller')
+    @raise_on_lock
+    @lock_interaction
+    @classmethod
+    def run_lane(cls, lane_name, start_offset=0.0):
+        cls._raise_on_compiling()
+        cls.raise_on_state(RUNNING_TL, ProgramRunning)
+        cls._get_lane(lane_name).run(start_offset)
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def pause_lane(cls, lane_name):
+        cls._get_lane(lane_name).pause()
+
+    @isolated('fire_controller')
+    @raise_on_lock
+    @lock_interaction
+    @classmethod
+    def continue_lane(cls, lane_name):
+        cls._get_lane(lane_name).continue_()
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def stop_lane(cls, lane_name):
+        cls._get_lane(lane_name).stop()
+
+    @isolated('fire_controller')
+    @lock_interaction
+    @classmethod
+    def delete_lane(cls, lane_name):
+        lane = cls._get_lane(lane_name)
+        if lane.program.running:
+            lane.stop()
+        del cls._lanes[lane_name]
+
+    @isolated('fire_controller')
+    @classmethod
+    def get_bus_plan(cls, lane_name=None):
+        if lane_name is not None:
+            return BusPlanner.plan(cls._get_lane(lane_name).program)
+        if cls._program is None:
+            raise NoProgramLoaded()
+        return BusPlanner.plan(cls._program)
+
+    @isolated('fire_controller')
+    @classmethod
+    def get_cues(cls, start=None, end=None, offset=0, limit=None,
+                 lane_name=None):
+        if lane_name is not None:
+            program = cls._get_lane(lane_name).program
+        elif cls._program is not None:
+            program = cls._program
+        else:
+            raise NoProgramLoaded()
+        return program.cues(start, end, offset, limit)
+
+    @isolated('fire_controller')
+    @classmethod
+    def get_lanes(cls):
+        return [lane.to_dict() for lane in list(cls._lanes.values())]
+
+    @isolated('fire_controller')
+    @classmethod
+    def get_journal(cls, start=None, end=None, raw_address=None, event=None,
+                    offset=0, limit=None):
+        return FireJournal.query(
+            start, end, raw_address, event, offset, limit
+        )
+
+    @isolated('fire_controller')
+    @classmethod
+    def get_journal_recovery(cls):
+        recovery = FireJournal.recovery()
+        if recovery is None:
+            return None
+        return {
+            'program': recovery['program'],
+            'started': recovery['started'],
+            'fired': Address.addresses_from_bitmask(recovery['fuse_mask'])
+        }
+
+    @isolated('fire_controller')
+    @classmethod
+    def clear_journal_recovery(cls):
+        FireJournal.clear_recovery()
+
+    @classmethod
+    def _prepare_program(cls, program):
+        # fuses fired by an interrupted run of the same program are not
+        # fired again; a broken journal does not keep programs from loading
+        try:
+            recovery = FireJournal.recovery()
+        except Exception as exc:
+            FireJournal.report_failure('recovery', exc)
+            recovery = None
+        if recovery is not None and \
+                recovery['program'] == program.content_hash[:16]:
+            program.mark_fired(recovery['fuse_mask'])
+        program.enable_journal()
+        try:
+            FireJournal.event(LOADED_EVENT, program.journal_id)
+        except Exception as exc:
+            FireJournal.report_failure('event', exc)
+
+    @classmethod
+    def _add_to_library(cls, program):
+        # a failing library write must not keep a program from loading
+        try:
+            ProgramLibrary.add(program)
+        except OSError as exc:
+            ProgramLibrary.report_failure('add', exc)
+        return program.content_hash
+
+    @classmethod
+    def _set_program(cls, program):
+        cls._raise_on_fuses_in_use(program.fuse_mask)
+        content_hash = cls._add_to_library(program)
+        cls._prepare_program(program)
+        ProgramStore.save(program)
+        cls._program = program
+        cls.set_program_state(LOADED)
+        return content_hash
 
     @classmethod
     def _run_program(cls):
+        # a program that has started firing must not come back as LOADED
+        ProgramStore.clear()
         cls._program.run(
-            callback=cls._program_execution_callback_factory()
+            callback=cls._program_execution_callback_factory(),
+            start_offset=cls._start_offset
         )
-        cls._program_state = RUNNING
+        cls.set_program_state(RUNNING)
 
     @classmethod
     def _program_state_setter_factory(cls, program_state):
         def program_state_setter():
-            cls._program_state = program_state
+            cls.set_program_state(program_state)
         return program_state_setter
 
     @classmethod
@@ -303,28 +846,88 @@ class FireController():
 
     @classmethod
     def get_program_state(cls):
+        if ExecutionProcess.is_remote():
+            return ExecutionProcess.status()['program_state']
         return cls._program_state
 
     @classmethod
     def set_program_state(cls, program_state):
+        changed = program_state != cls._program_state
         cls._program_state = program_state
+        if changed:
+            cls._notify_state_listeners(program_state)
+
+    @classmethod
+    def _notify_state_listeners(cls, program_state):
+        for listener in cls._state_listeners:
+            listener(program_state)
+
+    @classmethod
+    def add_state_listener(cls, listener):
+        if listener not in cls._state_listeners:
+            cls._state_listeners.append(listener)
+
+    @classmethod
+    def watch_remote_state(cls):
+        # when isolated (or a reader) the state is set in another process,
+        # listeners of this process hear of it through the status board,
+        # at most a watch period later
+        ExecutionProcess.watch_state(cls._notify_state_listeners)
 
     @classmethod
-    def get_fuse_status(cls):
+    def get_fuse_bitmaps(cls):
+        if ExecutionProcess.is_remote():
+            bitmaps = ExecutionProcess.bitmaps()
+            return {state: bitmaps[state] for state in FuseBoard.STATES}
         if cls._program is None and cls._testloop_program is None:
-            return Program.empty_fuse_status()
+            bitmaps = FuseBoard().bitmaps()
         elif cls._program is None:
-            return cls._testloop_program.fuse_status
+            bitmaps = cls._testloop_program.fuse_board.bitmaps()
         else:
-            return cls._program.fuse_status
+            bitmaps = cls._program.fuse_board.bitmaps()
+        # lanes use disjoint fuses, so their boards simply add up
+        for lane in list(cls._lanes.values()):
+            for state, bitmap in lane.program.fuse_board.bitmaps().items():
+                bitmaps[state] |= bitmap
+        return bitmaps
+
+    @classmethod
+    def get_fuse_status(cls, fuse_format=VERBOSE):
+        if ExecutionProcess.is_remote():
+            return FuseBoard.from_bitmaps(
+                ExecutionProcess.bitmaps()
+            ).serialize(fuse_format)
+        if len(cls._lanes) > 0:
+            return FuseBoard.from_bitmaps(
+                cls.get_fuse_bitmaps()
+            ).serialize(fuse_format)
+        if cls._program is None and cls._testloop_program is None:
+            return Program.empty_fuse_status(fuse_format)
+        elif cls._program is None:
+            return cls._testloop_program.serialize_fuse_status(fuse_format)
+        else:
+            return cls._program.serialize_fuse_status(fuse_format)
 
     @classmethod
     def get_scheduled_time(cls):
+        if ExecutionProcess.is_remote():
+            return ExecutionProcess.status()['scheduled_time']
         return cls._scheduled_time
 
     @classmethod
     def get_program_name(cls):
+        if ExecutionProcess.is_remote():
+            return ExecutionProcess.status()['program_name']
         if cls._program is None:
             return None
         else:
             return cls._program.name
+
+    @classmethod
+    def get_program_hash(cls):
+        if ExecutionProcess.is_remote():
+            return ExecutionProcess.status()['program_hash']
+        if cls._program is None:
+            return None
+        else:
+            return cls._program.content_hash
@@ -0,0 +1,439 @@
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from bisect import bisect_left
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+from .address import Address
+from .config import Config
+from .metrics import Metrics
+
+# Journal segment layout (little endian):
+#
+#   header  | magic, version, segment number, padded to one record
+#   records | time (posix), event, number of fuses, first fuse id, cue time
+#           | (deciseconds), program id (first 8 bytes of the content hash,
+#           | zero for manual fireing), crc32 of the preceding fields
+#
+# Segments have a fixed size and are memory mapped, unused space is zero.
+# Reading a segment stops at the first record that is empty or does not
+# match its checksum, so a torn write at a crash only loses that record.
+
+MAGIC = b'RLFJ'
+VERSION = 1
+
+SEGMENT_HEADER = struct.Struct('<4sHQ')
+RECORD_BODY = struct.Struct('<dBBHI8s')
+RECORD = struct.Struct('<dBBHI8sI4x')
+HEADER_SIZE = RECORD.size
+
+LOADED = 'loaded'
+STARTED = 'started'
+PAUSED = 'paused'
+CONTINUED = 'continued'
+STOPPED = 'stopped'
+FINISHED = 'finished'
+LIT = 'lit'
+UNLIT = 'unlit'
+FAILED = 'failed'
+
+# index 0 marks an empty record
+EVENTS = [
+    None, LOADED, STARTED, PAUSED, CONTINUED, STOPPED, FINISHED, LIT, UNLIT,
+    FAILED
+]
+
+MANUAL = bytes(8)
+
+JOURNAL_ERRORS = Metrics.counter(
+    'device_journal_errors_total', "Failed journal operations",
+    ('operation',)
+)
+
+logger = logging.getLogger(__name__)
+
+
+class FireJournalError(Exception):
+    pass
+
+
+class InvalidEvent(FireJournalError, ValueError):
+    def __init__(self, event):
+        self.event = event
+
+
+def program_id(content_hash):
+    return bytes.fromhex(content_hash[:16])
+
+
+class Segment():
+
+    def __init__(self, filename, number, create=False):
+        self._filename = filename
+        self._number = number
+        size = Config.get('journal', 'segment_size')
+        if create:
+            with open(filename, 'wb') as file:
+                file.truncate(size)
+        self._n_records = 0
+        # time index, and per fuse id the times and indices of its records
+        self._times = list()
+        self._fuses = dict()
+        self._file = open(filename, 'r+b')
+        if os.fstat(self._file.fileno()).st_size < HEADER_SIZE:
+            # truncated, can not even be mapped: counts as full
+            self._mmap = None
+            self._capacity = 0
+            return
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._capacity = (len(self._mmap) - HEADER_SIZE) // RECORD.size
+        if create:
+            # a segment without its header is ignored on the next start
+            SEGMENT_HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, number)
+            self._mmap.flush()
+        else:
+            self._scan()
+
+    def _scan(self):
+        magic, version, _ = SEGMENT_HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            # never appended to, the journal rotates past it
+            self._capacity = 0
+            return
+        while self._n_records < self._capacity:
+            offset = HEADER_SIZE + self._n_records * RECORD.size
+            record = RECORD.unpack_from(self._mmap, offset)
+            if record[1] == 0 or record[1] >= len(EVENTS) or record[-1] != \
+                    zlib.crc32(self._mmap[offset:offset + RECORD_BODY.size]):
+                break
+            self._index(record)
+
+    def _index(self, record):
+        timestamp, _, n_fuses, fuse_id = record[:4]
+        for indexed_fuse_id in range(fuse_id, fuse_id + n_fuses):
+            times, indices = self._fuses.setdefault(
+                indexed_fuse_id, (list(), list())
+            )
+            times.append(timestamp)
+            indices.append(self._n_records)
+        self._times.append(timestamp)
+        self._n_records += 1
+
+    def append(self, timestamp, event, n_fuses, fuse_id, deciseconds,
+               program_id):
+        offset = HEADER_SIZE + self._n_records * RECORD.size
+        RECORD_BODY.pack_into(
+            self._mmap, offset,
+            timestamp, event, n_fuses, fuse_id, deciseconds, program_id
+        )
+        struct.pack_into(
+            '<I', self._mmap, offset + RECORD_BODY.size,
+            zlib.crc32(self._mmap[offset:offset + RECORD_BODY.size])
+        )
+        self._index((timestamp, event, n_fuses, fuse_id))
+
+    def record(self, idx):
+        return RECORD.unpack_from(
+            self._mmap, HEADER_SIZE + idx * RECORD.size
+        )
+
+    def range(self, start, end, fuse_id=None):
+        # indices of the records with start <= time < end
+        if fuse_id is None:
+            times, indices = self._times, None
+        else:
+            times, indices = self._fuses.get(fuse_id, ((), ()))
+        low = 0 if start is None else bisect_left(times, start)
+        high = len(times) if end is None else bisect_left(times, end)
+        if indices is None:
+            return range(low, max(low, high))
+        return indices[low:high]
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self._filename)
+
+    @property
+    def number(self):
+        return self._number
+
+    @property
+    def full(self):
+        return self._n_records >= self._capacity
+
+    @property
+    def n_records(self):
+        return self._n_records
+
+
+class FireJournal():
+    # append-only journal of program lifecycle and cue events in rotating
+    # segments; appending only writes to the memory map, a background
+    # thread flushes it to disk
+
+    _lock = Lock()
+    _segments = None
+    _last_time = 0.0
+    _dirty = set()
+    _flush_thread = None
+    _stop_event = Event()
+    _recovery = None
+    # created ahead by the flush thread, so rotating does not create files
+    # on the thread appending
+    _spare = None
+
+    @classmethod
+    def _filename(cls, number):
+        return os.path.join(
+            Config.get('journal', 'directory'), f"journal-{number:08d}.bin"
+        )
+
+    @classmethod
+    def _open(cls):
+        # called with the lock held
+        if cls._segments is not None:
+            return
+        directory = Config.get('journal', 'directory')
+        os.makedirs(directory, exist_ok=True)
+        segments = list()
+        for filename in sorted(
+            glob.glob(os.path.join(directory, 'journal-*.bin'))
+        ):
+            number = int(os.path.basename(filename)[8:-4])
+            segments.append(Segment(filename, number))
+        if len(segments) == 0 or segments[-1].full:
+            number = segments[-1].number + 1 if len(segments) > 0 else 0
+            segments.append(Segment(cls._filename(number), number, True))
+        cls._segments = segments
+        for segment in segments:
+            if segment.n_records > 0:
+                cls._last_time = max(
+                    cls._last_time,
+                    segment.record(segment.n_records - 1)[0]
+                )
+        cls._recovery = cls._recover()
+
+        cls._stop_event.clear()
+        cls._flush_thread = Thread(
+            target=cls._flush_handler,
+            name='__JOURNAL_FLUSH_THREAD__',
+            daemon=True
+        )
+        cls._flush_thread.start()
+
+    @classmethod
+    def _rotate(cls):
+        number = cls._segments[-1].number + 1
+        if cls._spare is not None and cls._spare.number == number:
+            cls._segments.append(cls._spare)
+        else:
+            cls._segments.append(Segment(cls._filename(number), number, True))
+        cls._spare = None
+        while len(cls._segments) > Config.get('journal', 'max_segments'):
+            segment = cls._segments.pop(0)
+            cls._dirty.discard(segment)
+            segment.remove()
+
+    @classmethod
+    def _append(cls, timestamp, event, address, deciseconds, program_id):
+        if cls._segments[-1].full:
+            cls._rotate()
+        segment = cls._segments[-1]
+        if address is None:
+            n_fuses, fuse_id = 0, 0
+        else:
+            n_fuses, fuse_id = len(address.fuse_ids), address.fuse_id
+        segment.append(
+            timestamp, EVENTS.index(event), n_fuses, fuse_id, deciseconds,
+            program_id
+        )
+        cls._dirty.add(segment)
+
+    @classmethod
+    def _now(cls):
+        # the indices need non decreasing times, a system clock set back
+        # holds the journal time until it has caught up
+        cls._last_time = max(cls._last_time, time.time())
+        return cls._last_time
+
+    @classmethod
+    def event(cls, event, program_id):
+        with cls._lock:
+            cls._open()
+            cls._append(cls._now(), event, None, 0, program_id)
+            if event in (STOPPED, FINISHED) and cls._recovery is not None \
+                    and cls._recovery['program'] == program_id.hex():
+                cls._recovery = None
+
+    @classmethod
+    def cues(cls, event, commands, program_id):
+        with cls._lock:
+            cls._open()
+            timestamp = cls._now()
+            for command in commands:
+                cls._append(
+                    timestamp, event, command.address,
+                    0 if command.timestamp is None
+                    else command.timestamp.total_deciseconds,
+                    program_id
+                )
+
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            dirty = list(cls._dirty)
+            cls._dirty.clear()
+        for segment in dirty:
+            segment.flush()
+
+    @classmethod
+    def _prepare_spare(cls):
+        with cls._lock:
+            if cls._segments is None or cls._spare is not None:
+                return
+            number = cls._segments[-1].number + 1
+        spare = Segment(cls._filename(number), number, True)
+        with cls._lock:
+            if cls._segments is not None and cls._spare is None and \
+                    cls._segments[-1].number + 1 == number:
+                cls._spare = spare
+                return
+        spare.remove()
+
+    @classmethod
+    def _flush_handler(cls):
+        while not cls._stop_event.wait(Config.get('journal', 'flush_period')):
+            try:
+                cls.flush()
+            except Exception as exc:
+                cls.report_failure('flush', exc)
+            try:
+                cls._prepare_spare()
+            except Exception as exc:
+                cls.report_failure('rotate', exc)
+
+    @classmethod
+    def report_failure(cls, operation, exc):
+        # the journal is best-effort for its callers, failures are counted
+        # and logged instead of being raised into fireing or loading
+        JOURNAL_ERRORS.labels(operation).inc()
+        logger.warning("Journal %s failed: %r", operation, exc)
+
+    @classmethod
+    def close(cls):
+        if cls._segments is None:
+            return
+        cls._stop_event.set()
+        cls._flush_thread.join()
+        cls.flush()
+        with cls._lock:
+            for segment in cls._segments:
+                segment.close()
+            if cls._spare is not None:
+                cls._spare.close()
+            cls._segments = None
+            cls._spare = None
+
+    @classmethod
+    def _decode(cls, record):
+        timestamp, event, n_fuses, fuse_id, deciseconds, raw_id, _ = record
+        return {
+            'time': datetime.fromtimestamp(timestamp).isoformat(),
+            'event': EVENTS[event],
+            'address': None if n_fuses == 0 else Address.from_fuse_id(
+                fuse_id, range_=n_fuses
+            ).raw_address,
+            'cue_time': deciseconds / 10 if n_fuses > 0 else None,
+            'program': None if raw_id == MANUAL else raw_id.hex()
+        }
+
+    @classmethod
+    def query(cls, start=None, end=None, raw_address=None, event=None,
+              offset=0, limit=None):
+        # events with start <= time < end (posix seconds), optionally of
+        # one event type or touching the fuses of an address; returns the
+        # page and the number of matching events
+        if event is not None and event not in EVENTS[1:]:
+            raise InvalidEvent(event)
+        fuse_ids = None if raw_address is None else \
+            Address.parse(raw_address).fuse_ids
+
+        with cls._lock:
+            cls._open()
+            matches = list()
+            for segment in cls._segments:
+                if fuse_ids is None:
+                    indices = segment.range(start, end)
+                else:
+                    indices = sorted(set(
+                        idx for fuse_id in fuse_ids
+                        for idx in segment.range(start, end, fuse_id)
+                    ))
+                if event is None:
+                    matches.extend((segment, idx) for idx in indices)
+                    continue
+                event_idx = EVENTS.index(event)
+                matches.extend(
+                    (segment, idx) for idx in indices
+                    if segment.record(idx)[1] == event_idx
+                )
+            last = len(matches) if limit is None else offset + limit
+            return [
+                cls._decode(segment.record(idx))
+                for segment, idx in matches[offset:last]
+            ], len(matches)
+
+    @classmethod
+    def _recover(cls):
+        # fuses fired by the program of the last run that neither finished
+        # nor was stopped, i.e. a run interrupted by a crash or power loss
+        fired = dict()
+        last_started = None
+        for segment in cls._segments:
+            for idx in range(segment.n_records):
+                timestamp, event, n_fuses, fuse_id, _, raw_id, _ = \
+                    segment.record(idx)
+                event = EVENTS[event]
+                if raw_id == MANUAL:
+                    continue
+                if event == STARTED:
+                    fired.setdefault(raw_id, 0)
+                    last_started = raw_id, timestamp
+                elif event in (STOPPED, FINISHED):
+                    fired.pop(raw_id, None)
+                elif event == LIT and raw_id in fired:
+                    fired[raw_id] |= ((1 << n_fuses) - 1) << fuse_id
+
+        if last_started is None or last_started[0] not in fired:
+            return None
+        raw_id, timestamp = last_started
+        return {
+            'program': raw_id.hex(),
+            'started': datetime.fromtimestamp(timestamp).isoformat(),
+            'fuse_mask': fired[raw_id]
+        }
+
+    @classmethod
+    def recovery(cls):
+        with cls._lock:
+            cls._open()
+            return cls._recovery
+
+    @classmethod
+    def clear_recovery(cls):
+        with cls._lock:
+            cls._recovery = None
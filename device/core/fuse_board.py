@@ -0,0 +1,106 @@
+import base64
+from threading import Lock
+
+from .address import Address
+
+STAGED = 'staged'
+FIREING = 'fireing'
+FIRED = 'fired'
+SKIPPED = 'skipped'
+
+VERBOSE = 'verbose'
+BITMAP = 'bitmap'
+BASE64 = 'base64'
+FORMATS = [VERBOSE, BITMAP, BASE64]
+
+
+class FuseBoardError(Exception):
+    pass
+
+
+class InvalidFormat(FuseBoardError, ValueError):
+    def __init__(self, fuse_format):
+        self.fuse_format = fuse_format
+
+
+def bitmap_to_words(bitmap):
+    # one 16 bit word per chip, bit n is fuse n of that chip
+    return [
+        (bitmap >> (chip_index * Address.FUSES_PER_CHIP)) & 0xffff
+        for chip_index in range(Address.n_chips())
+    ]
+
+
+def bitmap_to_base64(bitmap):
+    return base64.b64encode(
+        bitmap.to_bytes(Address.n_chips() * 2, 'little')
+    ).decode('ascii')
+
+
+def serialize_bitmap(bitmap, fuse_format):
+    if fuse_format == BITMAP:
+        return bitmap_to_words(bitmap)
+    elif fuse_format == BASE64:
+        return bitmap_to_base64(bitmap)
+    raise InvalidFormat(fuse_format)
+
+
+class FuseBoard():
+    # fuse states as one bitmap per state, bit n is fuse id n
+
+    STATES = [STAGED, FIREING, FIRED, SKIPPED]
+
+    def __init__(self):
+        self._lock = Lock()
+        self._bitmaps = {state: 0 for state in FuseBoard.STATES}
+
+    @classmethod
+    def from_bitmaps(cls, bitmaps):
+        fuse_board = FuseBoard()
+        for state in FuseBoard.STATES:
+            fuse_board._bitmaps[state] = bitmaps[state]
+        return fuse_board
+
+    def stage(self, mask):
+        with self._lock:
+            self._bitmaps[STAGED] |= mask
+
+    def fire(self, mask):
+        with self._lock:
+            self._bitmaps[STAGED] &= ~mask
+            self._bitmaps[FIREING] |= mask
+
+    def fired(self, mask):
+        with self._lock:
+            self._bitmaps[STAGED] &= ~mask
+            self._bitmaps[FIREING] &= ~mask
+            self._bitmaps[FIRED] |= mask
+
+    def skip(self, mask):
+        with self._lock:
+            self._bitmaps[STAGED] &= ~mask
+            self._bitmaps[SKIPPED] |= mask
+
+    def bitmap(self, state):
+        return self._bitmaps[state]
+
+    def bitmaps(self):
+        with self._lock:
+            return dict(self._bitmaps)
+
+    def serialize(self, fuse_format=VERBOSE):
+        bitmaps = self.bitmaps()
+        if fuse_format != VERBOSE:
+            return {
+                state: serialize_bitmap(bitmap, fuse_format)
+                for state, bitmap in bitmaps.items()
+            }
+
+        result = ['none'] * Address.n_fuses()
+        for state in FuseBoard.STATES:
+            bitmap = bitmaps[state]
+            while bitmap:
+                low_bit = bitmap & -bitmap
+                result[low_bit.bit_length() - 1] = {'state': state}
+                bitmap ^= low_bit
+        return Address.group_by_chip(result)
@@ -1,11 +1,64 @@
-from functools import wraps
-from itertools import product
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
-from smbus2 import SMBus
-
+from ..util.bus_trace import OPERATIONS, THREAD_CLASSES, BusTrace
 from .address import Address
 from .config import Config
+from .execution_process import ExecutionProcess, isolated
+from .fuse_board import VERBOSE, serialize_bitmap
+from .metrics import Metrics
+
+READ = 'read'
+WRITE = 'write'
+
+I2C_TRANSACTIONS = Metrics.counter(
+    'device_i2c_transactions_total', "I2C transactions",
+    ('bus', 'chip', 'operation')
+)
+I2C_ERRORS = Metrics.counter(
+    'device_i2c_errors_total', "Failed I2C transactions",
+    ('bus', 'chip', 'operation')
+)
+I2C_SECONDS = Metrics.histogram(
+    'device_i2c_transaction_seconds', "I2C transaction latency",
+    ('bus', 'chip', 'operation')
+)
+BUS_LOCK_WAIT = Metrics.histogram(
+    'device_bus_lock_wait_seconds', "Time waited for a bus lock", ('bus',)
+)
+BUS_LOCK_HOLD = Metrics.histogram(
+    'device_bus_lock_hold_seconds', "Time a bus lock was held", ('bus',)
+)
+
+_bus_trace = None
+_bus_trace_lock = Lock()
+def bus_trace():
+    # created on first use, importing the module does not read the config
+    global _bus_trace
+    if _bus_trace is None:
+        with _bus_trace_lock:
+            if _bus_trace is None:
+                _bus_trace = BusTrace(Config.get('bus_trace', 'size'))
+    return _bus_trace
+
+
+THREAD_CLASS_NAMES = {
+    '__EXECUTOR_THREAD__': 'executor',
+    '__STATUS_PUBLISHER_THREAD__': 'status',
+    'heartbeat_handler': 'heartbeat'
+}
+
+# thread class of the thread a bus job was dispatched from, the job itself
+# may run on a dispatch thread
+_origin = threading.local()
+
+
+def _thread_class():
+    return THREAD_CLASSES.index(THREAD_CLASS_NAMES.get(
+        threading.current_thread().name, 'other'
+    ))
 
 
 class HardwareError(Exception):
@@ -41,126 +94,394 @@ class BusError(HardwareError, OSError):
         self.bus_address = bus_address
 
 
-def lock_bus(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        HardwareController.LOCK.acquire(blocking=True)
-        result = func(*args, **kwargs)
-        HardwareController.LOCK.release()
-        return result
-    return wrapper
+class Bus():
 
+    def __init__(self, bus_address):
+        self._bus_address = bus_address
+        self._lock = Lock()
+        self._init_metrics()
+        self._bus = None
 
-class HardwareController():
+    def open(self):
+        # the device is opened on bring-up, or by the first transaction if
+        # that comes earlier
+        if self._bus is not None:
+            return
+        from smbus2 import SMBus
+
+        try:
+            self._bus = SMBus(self._bus_address)
+        except TypeError:
+            raise InvalidBusType(self._bus_address)
+        except OSError:
+            raise BusError(self._bus_address)
+
+    def _init_metrics(self):
+        # metric children of every known chip are resolved up front
+        self._metrics = dict()
+        self._chip_names = {
+            chip_address: letter
+            for letter, chip_address
+            in Config.get('i2c', 'chip_addresses').items()
+            if Address.chip_bus_addresses()[letter] == self._bus_address
+        }
+        for chip_address in self._chip_names:
+            for operation in (READ, WRITE):
+                self._chip_metrics(chip_address, operation)
+        self._lock_wait = BUS_LOCK_WAIT.labels(str(self._bus_address))
+        self._lock_hold = BUS_LOCK_HOLD.labels(str(self._bus_address))
 
-    LOCK = Lock()
+    def _chip_metrics(self, i2c_address, operation):
+        metrics = self._metrics.get((i2c_address, operation))
+        if metrics is None:
+            labels = (
+                str(self._bus_address),
+                self._chip_names.get(i2c_address, hex(i2c_address)),
+                operation
+            )
+            metrics = (
+                I2C_TRANSACTIONS.labels(*labels),
+                I2C_ERRORS.labels(*labels),
+                I2C_SECONDS.labels(*labels)
+            )
+            self._metrics[(i2c_address, operation)] = metrics
+        return metrics
 
-    try:
-        BUS = SMBus(Config.get('i2c', 'bus_address'))
-    except TypeError:
-        raise InvalidBusType(Config.get('i2c', 'bus_address'))
-    except OSError:
-        raise BusError(Config.get('i2c', 'bus_address'))
+    def _trace(self, start, i2c_address, register_address, value,
+               operation, failed):
+        end = time.perf_counter()
+        bus_trace().record(
+            time.monotonic() - (end - start), end - start,
+            self._bus_address, i2c_address, register_address, value,
+            OPERATIONS.index(operation),
+            getattr(_origin, 'thread_class', 0), 1 if failed else 0
+        )
+        if failed and Config.get('bus_trace', 'freeze_on_error'):
+            bus_trace().freeze()
+        return end - start
 
-    @classmethod
-    def _write(cls, i2c_address, register_address, value):
+    def write(self, i2c_address, register_address, value):
+        transactions, errors, seconds = \
+            self._chip_metrics(i2c_address, WRITE)
+        if self._bus is None:
+            self.open()
+        start = time.perf_counter()
+        failed = False
         try:
-            cls.BUS.write_byte_data(i2c_address, register_address, value)
-            print(f"WRITE {value} TO {i2c_address}:{register_address}")
+            self._bus.write_byte_data(i2c_address, register_address, value)
         except OSError:
+            failed = True
+            errors.inc()
             raise WriteError(
-                Config.get('i2c', 'bus_address'),
+                self._bus_address,
                 i2c_address,
                 register_address,
                 value
             )
+        finally:
+            transactions.inc()
+            seconds.observe(self._trace(
+                start, i2c_address, register_address, value, WRITE, failed
+            ))
 
-    @classmethod
-    def _read(cls, i2c_address, register_address):
+    def read(self, i2c_address, register_address):
+        transactions, errors, seconds = \
+            self._chip_metrics(i2c_address, READ)
+        if self._bus is None:
+            self.open()
+        start = time.perf_counter()
+        value = 0
+        failed = False
         try:
-            value = cls.BUS.read_byte_data(i2c_address, register_address)
+            value = self._bus.read_byte_data(i2c_address, register_address)
             return value
         except OSError:
+            failed = True
+            errors.inc()
             raise ReadError(
-                Config.get('i2c', 'bus_address'),
+                self._bus_address,
                 i2c_address,
                 register_address
             )
+        finally:
+            transactions.inc()
+            seconds.observe(self._trace(
+                start, i2c_address, register_address, value, READ, failed
+            ))
+
+    def set_bits(self, i2c_address, register_address, mask, value):
+        current = self.read(i2c_address, register_address)
+        current &= 0xff - mask
+        current |= value
+        self.write(i2c_address, register_address, current)
+
+    @property
+    def lock(self):
+        return self._lock
+
+    @property
+    def lock_wait(self):
+        return self._lock_wait
+
+    @property
+    def lock_hold(self):
+        return self._lock_hold
+
+    @property
+    def bus_address(self):
+        return self._bus_address
+
+
+class HardwareController():
+
+    _buses = None
+    _buses_lock = Lock()
+    _executor = None
+    _executor_lock = Lock()
+    _chips_by_bus_cache = None
+
+    @classmethod
+    def buses(cls):
+        # bus address to Bus, built from the config on first use
+        if cls._buses is None:
+            with cls._buses_lock:
+                if cls._buses is None:
+                    cls._buses = {
+                        bus_address: Bus(bus_address)
+                        for bus_address in set(
+                            Address.chip_bus_addresses().values()
+                        )
+                    }
+        return cls._buses
+
+    @classmethod
+    def set_buses(cls, buses):
+        with cls._buses_lock:
+            cls._buses = buses
+
+    @classmethod
+    def initialize(cls):
+        for bus in cls.buses().values():
+            with bus.lock:
+                bus.open()
+
+    @classmethod
+    def _chips_by_bus(cls):
+        if cls._chips_by_bus_cache is None:
+            chips = dict()
+            for chip_index in range(Address.n_chips()):
+                address = Address.from_fuse_id(
+                    chip_index * Address.FUSES_PER_CHIP
+                )
+                chips.setdefault(address.bus_address, list()).append(
+                    (chip_index, address.chip_address)
+                )
+            cls._chips_by_bus_cache = chips
+        return cls._chips_by_bus_cache
+
+    @classmethod
+    def _dispatch_executor(cls):
+        # requests may dispatch before (or while) the bring-up initializes,
+        # racing threads must not each start a pool
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=len(cls.buses()),
+                    thread_name_prefix='__bus_dispatch__'
+                )
+            return cls._executor
+
+    @classmethod
+    def _dispatch(cls, jobs):
+        # jobs: mapping of bus address to a callable taking the Bus,
+        # buses are driven in parallel, each one under its own lock
+        thread_class = _thread_class()
+
+        def run(bus_address, job):
+            _origin.thread_class = thread_class
+            bus = cls.buses()[bus_address]
+            start = time.perf_counter()
+            with bus.lock:
+                acquired = time.perf_counter()
+                try:
+                    return job(bus)
+                finally:
+                    bus.lock_wait.observe(acquired - start)
+                    bus.lock_hold.observe(time.perf_counter() - acquired)
+
+        if len(jobs) == 0:
+            return dict()
+        if len(jobs) == 1:
+            ((bus_address, job),) = jobs.items()
+            return {bus_address: run(bus_address, job)}
+
+        executor = cls._dispatch_executor()
+        futures = {
+            bus_address: executor.submit(run, bus_address, job)
+            for bus_address, job in jobs.items()
+        }
+        return {
+            bus_address: future.result()
+            for bus_address, future in futures.items()
+        }
+
+    @classmethod
+    def _frame_jobs(cls, addresses, light):
+        # merges all addresses that share a fuse register into a single
+        # read-modify-write
+        registers = dict()
+        for address in addresses:
+            key = (address.chip_address, address.register_address)
+            registers.setdefault(address.bus_address, dict())
+            registers[address.bus_address].setdefault(key, 0)
+            registers[address.bus_address][key] |= address.register_mask
+
+        def job_factory(bus_registers):
+            def job(bus):
+                for (chip_address, register_address), mask \
+                        in bus_registers.items():
+                    bus.set_bits(
+                        chip_address, register_address,
+                        mask, mask if light else 0x00
+                    )
+            return job
+
+        return {
+            bus_address: job_factory(bus_registers)
+            for bus_address, bus_registers in registers.items()
+        }
 
     @classmethod
-    @lock_bus
     def light(cls, address):
-        value = cls._read(
-            address.chip_address,
-            address.register_address
-        )
-        value &= address.rev_register_mask
-        value |= address.register_mask
-        cls._write(
-            address.chip_address,
-            address.register_address,
-            value
-        )
+        cls.light_frame([address])
 
     @classmethod
-    @lock_bus
     def unlight(cls, address):
-        value = cls._read(
-            address.chip_address,
-            address.register_address
-        )
-        value &= address.rev_register_mask
-        cls._write(
-            address.chip_address,
-            address.register_address,
-            value
-        )
+        cls.unlight_frame([address])
 
     @classmethod
-    @lock_bus
+    def light_frame(cls, addresses):
+        cls._dispatch(cls._frame_jobs(addresses, light=True))
+
+    @classmethod
+    def unlight_frame(cls, addresses):
+        cls._dispatch(cls._frame_jobs(addresses, light=False))
+
+    @classmethod
+    def _write_lock_register(cls, mask):
+        def job_factory(chips):
+            def job(bus):
+                for _, chip_address in chips:
+                    bus.write(
+                        chip_address,
+                        Address.REGISTER_ADDRESSES['lock'],
+                        mask
+                    )
+            return job
+
+        cls._dispatch({
+            bus_address: job_factory(chips)
+            for bus_address, chips in cls._chips_by_bus().items()
+        })
+
+    @isolated('hardware_controller')
+    @classmethod
     def lock(cls):
-        for chip_address in Config.get('i2c', 'chip_addresses').values():
-            cls._write(
-                chip_address,
-                Address.REGISTER_ADDRESSES['lock'],
-                Address.MASKS['lock']
-            )
+        cls._write_lock_register(Address.MASKS['lock'])
 
+    @isolated('hardware_controller')
     @classmethod
-    @lock_bus
     def unlock(cls):
-        for chip_address in Config.get('i2c', 'chip_addresses').values():
-            cls._write(
-                chip_address,
-                Address.REGISTER_ADDRESSES['lock'],
-                Address.MASKS['unlock']
-            )
+        cls._write_lock_register(Address.MASKS['unlock'])
 
     @classmethod
-    @lock_bus
     def is_locked(cls):
-        for chip_addr in Config.get('i2c', 'chip_addresses').values():
-            value = cls._read(chip_addr, Address.REGISTER_ADDRESSES['lock'])
-            value &= Address.MASKS['lock']
-            if value > 0:
-                return True
-        return False
+        if ExecutionProcess.is_remote():
+            return ExecutionProcess.status()['locked']
+
+        def job_factory(chips):
+            def job(bus):
+                for _, chip_address in chips:
+                    value = bus.read(
+                        chip_address, Address.REGISTER_ADDRESSES['lock']
+                    )
+                    if value & Address.MASKS['lock'] > 0:
+                        return True
+                return False
+            return job
+
+        return any(cls._dispatch({
+            bus_address: job_factory(chips)
+            for bus_address, chips in cls._chips_by_bus().items()
+        }).values())
 
     @classmethod
-    @lock_bus
-    def errors(cls):
-        # maybe generates false errors?
-        return {
-            chip_letter: [
-                False if (value & mask) == 0 else True
-                for value, mask in product(
-                    [
-                        cls._read(chip_address, reg_address)
-                        for reg_address in Address.REGISTER_ADDRESSES['error']
-                    ],
-                    range(8)  # 8 bools per register
-                )
-            ]
-            for chip_letter, chip_address
-            in Config.get('i2c', 'chip_addresses').items()
-        }
+    def error_bitmap(cls):
+        # bit n is set if fuse id n reports an error
+        if ExecutionProcess.is_remote():
+            return ExecutionProcess.bitmaps()['error']
+
+        def job_factory(chips):
+            def job(bus):
+                bitmap = 0
+                for chip_index, chip_address in chips:
+                    word = 0
+                    for idx, reg_address in enumerate(
+                        Address.REGISTER_ADDRESSES['error']
+                    ):
+                        word |= bus.read(chip_address, reg_address) \
+                            << (8 * idx)  # 8 fuses per register
+                    bitmap |= word << (chip_index * Address.FUSES_PER_CHIP)
+                return bitmap
+            return job
+
+        bitmap = 0
+        for bus_bitmap in cls._dispatch({
+            bus_address: job_factory(chips)
+            for bus_address, chips in cls._chips_by_bus().items()
+        }).values():
+            bitmap |= bus_bitmap
+        return bitmap
+
+    @classmethod
+    def error_list(cls):
+        # one bool per fuse id
+        bitmap = cls.error_bitmap()
+        return [
+            (bitmap >> fuse_id) & 1 == 1
+            for fuse_id in range(Address.n_fuses())
+        ]
+
+    @classmethod
+    def errors(cls, error_format=VERBOSE):
+        if error_format == VERBOSE:
+            return Address.group_by_chip(cls.error_list())
+        return serialize_bitmap(cls.error_bitmap(), error_format)
+
+    @isolated('hardware_controller')
+    @classmethod
+    def freeze_trace(cls):
+        bus_trace().freeze()
+        return bus_trace().status
+
+    @isolated('hardware_controller')
+    @classmethod
+    def unfreeze_trace(cls):
+        bus_trace().unfreeze()
+        return bus_trace().status
+
+    @isolated('hardware_controller')
+    @classmethod
+    def clear_trace(cls):
+        bus_trace().clear()
+        return bus_trace().status
+
+    @isolated('hardware_controller')
+    @classmethod
+    def get_trace_status(cls):
+        return bus_trace().status
+
+    @isolated('hardware_controller')
+    @classmethod
+    def dump_trace(cls):
+        return bus_trace().dump()
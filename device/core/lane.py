@@ -0,0 +1,115 @@
+from threading import Lock
+
+LOADED = 'loaded'
+RUNNING = 'running'
+PAUSED = 'paused'
+FINISHED = 'finished'
+
+
+class LaneError(Exception):
+    def __init__(self, lane_name):
+        self.lane_name = lane_name
+
+
+class LaneRunning(LaneError):
+    def __init__(self, lane_name):
+        LaneError.__init__(self, lane_name)
+
+
+class LaneNotRunning(LaneError):
+    def __init__(self, lane_name):
+        LaneError.__init__(self, lane_name)
+
+
+class LanePaused(LaneError):
+    def __init__(self, lane_name):
+        LaneError.__init__(self, lane_name)
+
+
+class LaneNotPaused(LaneError):
+    def __init__(self, lane_name):
+        LaneError.__init__(self, lane_name)
+
+
+class LaneFinished(LaneError):
+    def __init__(self, lane_name):
+        LaneError.__init__(self, lane_name)
+
+
+class Lane():
+    # an independently controlled program on its own set of fuses, all
+    # lanes share the executor and the bus dispatcher
+
+    def __init__(self, name, program):
+        self._name = name
+        self._program = program
+        self._state = LOADED
+        self._lock = Lock()
+
+    def _finished(self):
+        with self._lock:
+            self._state = FINISHED
+
+    def run(self, start_offset=0.0):
+        with self._lock:
+            if self._state in (RUNNING, PAUSED):
+                raise LaneRunning(self._name)
+            if self._state == FINISHED:
+                raise LaneFinished(self._name)
+            self._state = RUNNING
+        try:
+            self._program.run(
+                callback=self._finished, start_offset=start_offset
+            )
+        except Exception:
+            with self._lock:
+                self._state = LOADED
+            raise
+
+    def pause(self):
+        with self._lock:
+            if self._state == PAUSED:
+                raise LanePaused(self._name)
+            if self._state != RUNNING:
+                raise LaneNotRunning(self._name)
+            self._program.pause()
+            self._state = PAUSED
+
+    def continue_(self):
+        with self._lock:
+            if self._state == RUNNING:
+                raise LaneNotPaused(self._name)
+            if self._state != PAUSED:
+                raise LaneNotRunning(self._name)
+            self._program.continue_()
+            self._state = RUNNING
+
+    def stop(self):
+        with self._lock:
+            if self._state not in (RUNNING, PAUSED):
+                raise LaneNotRunning(self._name)
+        self._program.stop()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def program(self):
+        return self._program
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def fuse_mask(self):
+        return self._program.fuse_mask
+
+    def to_dict(self):
+        return {
+            'lane': self._name,
+            'state': self._state,
+            'program_name': self._program.name,
+            'program_hash': self._program.content_hash
+        }
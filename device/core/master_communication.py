@@ -1,12 +1,31 @@
+import gzip
+import json
+import logging
+import random
 import time
-from threading import Thread
-
-import requests
+from threading import Event, Lock, Thread
 
 from ..util.sys_time import get_system_time
 from .config import Config
 from .fire_controller import FireController
 from .hardware_controller import HardwareController
+from .metrics import Metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+HEARTBEAT_SECONDS = Metrics.histogram(
+    'device_heartbeat_send_seconds', "Heartbeat request latency"
+)
+HEARTBEAT_FAILURES = Metrics.counter(
+    'device_heartbeat_failures_total', "Failed heartbeats"
+)
 
 
 class MasterCommunicatorError(Exception):
@@ -17,67 +36,280 @@ class NotRegistered(MasterCommunicatorError):
     pass
 
 
+class InvalidCompression(MasterCommunicatorError, ValueError):
+    def __init__(self, compression):
+        self.compression = compression
+
+
+def state_changes(old, new, path=()):
+    # yields [path, value] pairs that turn old into new, containers are only
+    # descended into if their shape (dict keys, list length) is unchanged
+    if isinstance(old, dict) and isinstance(new, dict) \
+            and old.keys() == new.keys():
+        for key in new:
+            yield from state_changes(old[key], new[key], (*path, key))
+    elif isinstance(old, list) and isinstance(new, list) \
+            and len(old) == len(new):
+        for idx, (old_item, new_item) in enumerate(zip(old, new)):
+            yield from state_changes(old_item, new_item, (*path, idx))
+    elif old != new:
+        yield [list(path), new]
+
+
+def _json_default(value):
+    return value.isoformat()
+
+
 class MasterCommunicator():
 
-    _heartbeat_thread = Thread()
+    _heartbeat_thread = None
+    _registration_lock = Lock()
 
     _master_registered = False
     _master_address = None
     _master_port = None
 
-    _stop_heartbeat_flag = False
+    # every heartbeat thread gets its own stop event, a thread that was
+    # told to stop never picks up a later registration
+    _stop_heartbeat_event = None
+    _heartbeat_wakeup = Event()
+    _heartbeat_failures = 0
+
+    _heartbeat_version = 0
+    _last_state = None
+    _last_version = None
+    _beats_since_keyframe = 0
+    _keyframe_requested = False
+    # uncompressed size of the last keyframe, what a beat would cost
+    # without delta encoding and compression; the state has a fixed shape,
+    # so it stands in for the deltas since without encoding the full state
+    # a second time
+    _full_size = 0
+
+    _stats = {
+        'beats': 0,
+        'keyframes': 0,
+        'deltas': 0,
+        'failures': 0,
+        'bytes_full': 0,
+        'bytes_sent': 0
+    }
 
     @classmethod
     def register_master(cls, address, port):
-        cls._master_address = address
-        cls._master_port = port
-        cls._heartbeat_url = (
-            f"http://{cls._master_address}:"
-            f"{cls._master_port}/master/heartbeat"
-        )
+        # fails the registration instead of every single heartbeat
+        compression = Config.get('heartbeat', 'compression')
+        if compression not in COMPRESSIONS:
+            raise InvalidCompression(compression)
 
-        if not cls._heartbeat_thread.is_alive():
-            cls._heartbeat_thread = Thread(
-                target=cls._heartbeat_handler,
-                name="heartbeat_handler"
+        with cls._registration_lock:
+            if cls._stop_heartbeat_event is None and \
+                    cls._heartbeat_thread is not None:
+                # a stopped thread may still be in a send, it must be done
+                # with the shared heartbeat state before a new one starts
+                cls._heartbeat_thread.join(
+                    2 * Config.get('timeouts', 'heartbeat')
+                )
+
+            cls._master_address = address
+            cls._master_port = port
+            cls._heartbeat_url = (
+                f"http://{cls._master_address}:"
+                f"{cls._master_port}/master/heartbeat"
             )
-            cls._heartbeat_thread.start()
-        cls._master_registered = True
+
+            if cls._stop_heartbeat_event is None:
+                cls._last_state = None
+                cls._heartbeat_failures = 0
+                cls._stop_heartbeat_event = Event()
+                cls._heartbeat_thread = Thread(
+                    target=cls._heartbeat_handler,
+                    args=(cls._stop_heartbeat_event,),
+                    name="heartbeat_handler"
+                )
+                cls._heartbeat_thread.start()
+            cls._master_registered = True
 
     @classmethod
     def deregister_master(cls):
-        if not cls._master_registered:
-            raise NotRegistered()
-        cls._master_registered = False
-        cls._master_address = None
-        cls._stop_heartbeat_flag = True
-        cls._master_port = None
+        with cls._registration_lock:
+            if not cls._master_registered:
+                raise NotRegistered()
+            cls._master_registered = False
+            cls._master_address = None
+            cls._stop_heartbeat_event.set()
+            cls._stop_heartbeat_event = None
+            cls._heartbeat_wakeup.set()
+            cls._master_port = None
+
+    @classmethod
+    def request_keyframe(cls):
+        cls._keyframe_requested = True
+
+    @classmethod
+    def get_heartbeat_stats(cls):
+        stats = dict(cls._stats)
+        stats['bytes_saved'] = stats['bytes_full'] - stats['bytes_sent']
+        stats['keyframe_ratio'] = (
+            stats['keyframes'] / (stats['keyframes'] + stats['deltas'])
+            if stats['keyframes'] + stats['deltas'] > 0 else None
+        )
+        return stats
+
+    @classmethod
+    def _heartbeat_state(cls):
+        fuse_format = Config.get('heartbeat', 'fuse_format')
+        return {
+            'device_id': Config.get('connection', 'device_id'),
+            'system_time': get_system_time(),
+            'locked': HardwareController.is_locked(),
+            'program_state': FireController.get_program_state(),
+            'scheduled_time': FireController.get_scheduled_time(),
+            'program_name': FireController.get_program_name(),
+            'fuse_states': FireController.get_fuse_status(fuse_format),
+            'error_states': HardwareController.errors(fuse_format)
+        }
+
+    @classmethod
+    def _heartbeat_payload(cls, state):
+        cls._heartbeat_version += 1
+        keyframe = (
+            not Config.get('heartbeat', 'delta_encoding')
+            or cls._last_state is None
+            or cls._keyframe_requested
+            or cls._beats_since_keyframe + 1
+            >= Config.get('heartbeat', 'keyframe_interval')
+        )
+        if keyframe:
+            return {
+                'version': cls._heartbeat_version,
+                'keyframe': True,
+                **state
+            }
+        return {
+            'version': cls._heartbeat_version,
+            'keyframe': False,
+            'base_version': cls._last_version,
+            'device_id': state['device_id'],
+            'changes': list(state_changes(cls._last_state, state))
+        }
+
+    @classmethod
+    def _encode(cls, payload):
+        # returns the body, its headers and the size before compression
+        data = json.dumps(payload, default=_json_default).encode('utf-8')
+        raw_size = len(data)
+        headers = {'Content-Type': 'application/json'}
+        compression = Config.get('heartbeat', 'compression')
+        if compression == 'zstd' and zstandard is None:
+            compression = 'gzip'
+        if compression == 'none' or \
+                len(data) < Config.get('heartbeat', 'compression_threshold'):
+            return data, headers, raw_size
+        if compression == 'gzip':
+            data = gzip.compress(data)
+        elif compression == 'zstd':
+            data = zstandard.ZstdCompressor().compress(data)
+        else:
+            raise InvalidCompression(compression)
+        headers['Content-Encoding'] = compression
+        return data, headers, raw_size
+
+    @classmethod
+    def _send_heartbeat(cls, stop_event):
+        # requests is the slowest import of the package and only needed
+        # once the device is registered with a master
+        import requests
+
+        state = cls._heartbeat_state()
+        payload = cls._heartbeat_payload(state)
+        data, headers, raw_size = cls._encode(payload)
+
+        cls._stats['beats'] += 1
+        if payload['keyframe']:
+            cls._full_size = raw_size
+        cls._stats['bytes_full'] += cls._full_size
+        start = time.perf_counter()
+        try:
+            response = requests.post(
+                url=cls._heartbeat_url,
+                data=data,
+                headers=headers,
+                timeout=Config.get('timeouts', 'heartbeat')
+            )
+            response.raise_for_status()
+        finally:
+            HEARTBEAT_SECONDS.observe(time.perf_counter() - start)
+
+        if stop_event.is_set():
+            # deregistered during the send, the state belongs to the next
+            # registration
+            return
+        cls._stats['bytes_sent'] += len(data)
+        if payload['keyframe']:
+            cls._stats['keyframes'] += 1
+            cls._beats_since_keyframe = 0
+            cls._keyframe_requested = False
+        else:
+            cls._stats['deltas'] += 1
+            cls._beats_since_keyframe += 1
+        cls._last_state = state
+        cls._last_version = payload['version']
+
+        try:
+            if response.json().get('keyframe', False):
+                cls._keyframe_requested = True
+        except (ValueError, AttributeError):
+            pass
+
+    @classmethod
+    def _on_state_change(cls, program_state):
+        # state transitions are reported immediately, unless the master is
+        # unreachable and we are backing off
+        if cls._heartbeat_failures == 0:
+            cls._heartbeat_wakeup.set()
+
+    @classmethod
+    def _heartbeat_period(cls):
+        period = Config.get('heartbeat', 'periods').get(
+            FireController.get_program_state(),
+            Config.get('timings', 'heartbeat_period')
+        )
+        if cls._heartbeat_failures > 0:
+            # the exponent is capped, the backoff reaches backoff_max long
+            # before and large powers overflow the float conversion
+            period = min(
+                period * 2 ** min(cls._heartbeat_failures, 16),
+                Config.get('heartbeat', 'backoff_max')
+            )
+            jitter = Config.get('heartbeat', 'backoff_jitter')
+            period *= 1 + random.uniform(-jitter, jitter)
+        return period
 
     @classmethod
-    def _heartbeat_handler(cls):
-        while not cls._stop_heartbeat_flag:
+    def _heartbeat_handler(cls, stop_event):
+        while not stop_event.is_set():
+            cls._heartbeat_wakeup.clear()
             try:
-                response = requests.post(
-                    url=cls._heartbeat_url,
-                    json={
-                        'device_id': Config.get('connection', 'device_id'),
-                        'system_time': get_system_time(),
-                        'locked': HardwareController.is_locked(),
-                        'program_state': FireController.get_program_state(),
-                        'scheduled_time': FireController.get_scheduled_time(),
-                        'program_name': FireController.get_program_name(),
-                        'fuse_states': FireController.get_fuse_status(),
-                        'error_states': HardwareController.errors()
-                    },
-                    timeout=Config.get('timeouts', 'heartbeat')
+                cls._send_heartbeat(stop_event)
+                cls._heartbeat_failures = 0
+            except Exception as exc:
+                # network or not, a failed beat must not end the thread
+                if stop_event.is_set():
+                    break
+                # the master may have missed this beat, resync with a
+                # keyframe
+                cls._last_state = None
+                cls._heartbeat_failures += 1
+                cls._stats['failures'] += 1
+                HEARTBEAT_FAILURES.inc()
+                logger.warning(
+                    "Heartbeat to %s failed: %r", cls._heartbeat_url, exc
                 )
-                response.raise_for_status()
 
-            except requests.RequestException:
-                print(cls._heartbeat_url)
-                print("requests.RequestException!")
-                ...  # TODO
+            if stop_event.is_set():
+                break
+            cls._heartbeat_wakeup.wait(cls._heartbeat_period())
 
-            time.sleep(Config.get('timings', 'heartbeat_period'))
 
-        cls._stop_heartbeat_flag = False
+FireController.add_state_listener(MasterCommunicator._on_state_change)
@@ -0,0 +1,262 @@
+import threading
+from bisect import bisect_left
+
+from .config import Config
+from .execution_process import isolated
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class MetricsError(Exception):
+    pass
+
+
+class MetricExists(MetricsError):
+    def __init__(self, name):
+        self.name = name
+
+
+class InvalidLabels(MetricsError, ValueError):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+
+# Updates are plain attribute increments without a lock: they are cheap
+# enough for the fireing path and under the GIL a lost update is the worst
+# that can happen.
+
+class Counter():
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge():
+
+    def __init__(self, function=None):
+        self.value = 0
+        self._function = function
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        if self._function is not None:
+            return self._function()
+        return self.value
+
+
+class Histogram():
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self._buckets, value)] += 1
+        self.sum += value
+
+    def sample(self):
+        return list(self.counts), self.sum
+
+
+class MetricFamily():
+
+    def __init__(self, name, metric_type, description, label_names,
+                 buckets=None, function=None):
+        self._name = name
+        self._type = metric_type
+        self._description = description
+        self._label_names = tuple(label_names)
+        # a list, or a callable returning one on first use, so registering
+        # at import time does not read the config
+        self._buckets_source = buckets
+        self._buckets = None
+        self._function = function
+        self._children = dict()
+        self._lock = threading.Lock()
+        if len(self._label_names) == 0 and metric_type != HISTOGRAM:
+            self.labels()
+
+    def _resolved_buckets(self):
+        if self._buckets is None:
+            buckets = self._buckets_source
+            if callable(buckets):
+                buckets = buckets()
+            self._buckets = sorted(buckets)
+        return self._buckets
+
+    def _new_child(self):
+        if self._type == COUNTER:
+            return Counter()
+        elif self._type == GAUGE:
+            return Gauge(self._function)
+        return Histogram(self._resolved_buckets())
+
+    def labels(self, *values):
+        # children are created once and should be kept by the caller, so
+        # the hot path does not even pay for the lookup
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self._label_names):
+                raise InvalidLabels(self._name, values)
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def collect(self):
+        if len(self._label_names) == 0:
+            # histograms without labels are exported before the first
+            # observation as well
+            self.labels()
+        return {
+            'name': self._name,
+            'type': self._type,
+            'description': self._description,
+            'label_names': self._label_names,
+            'buckets': (
+                self._resolved_buckets() if self._type == HISTOGRAM else None
+            ),
+            'samples': [
+                (values, child.sample())
+                for values, child in list(self._children.items())
+            ]
+        }
+
+
+def _format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for name, value in zip(names, values)
+    ) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics():
+    # process wide registry, rendered in the prometheus text format
+
+    _families = dict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def _register(cls, name, *args, **kwargs):
+        with cls._lock:
+            if name in cls._families:
+                raise MetricExists(name)
+            family = MetricFamily(name, *args, **kwargs)
+            cls._families[name] = family
+            return family
+
+    @classmethod
+    def counter(cls, name, description, label_names=()):
+        return cls._register(name, COUNTER, description, label_names)
+
+    @classmethod
+    def gauge(cls, name, description, label_names=(), function=None):
+        return cls._register(
+            name, GAUGE, description, label_names, function=function
+        )
+
+    @classmethod
+    def histogram(cls, name, description, label_names=(), buckets=None):
+        # buckets is a list or a callable returning one, by default the
+        # configured latency buckets
+        if buckets is None:
+            def buckets():
+                return Config.get('metrics', 'latency_buckets')
+        return cls._register(
+            name, HISTOGRAM, description, label_names, buckets=buckets
+        )
+
+    @classmethod
+    def collect(cls):
+        return [family.collect() for family in list(cls._families.values())]
+
+    @isolated('metrics')
+    @classmethod
+    def collect_execution(cls):
+        return cls.collect()
+
+    @classmethod
+    def render(cls, collections):
+        # collections maps a process name to the result of collect(), the
+        # process becomes a label so families of several processes merge
+        families = dict()
+        for process_name, collected in collections.items():
+            for family in collected:
+                merged = families.setdefault(family['name'], dict(
+                    family, samples=list()
+                ))
+                merged['samples'].extend(
+                    (values + (process_name,), sample)
+                    for values, sample in family['samples']
+                )
+
+        lines = list()
+        for name, family in families.items():
+            lines.append(f"# HELP {name} {family['description']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            label_names = family['label_names'] + ('process',)
+            for values, sample in family['samples']:
+                if family['type'] != HISTOGRAM:
+                    lines.append(
+                        name + _format_labels(label_names, values) + " "
+                        + _format_value(sample)
+                    )
+                    continue
+                counts, total = sample
+                cumulative = 0
+                for bound, count in zip(
+                    family['buckets'] + [float('inf')], counts
+                ):
+                    cumulative += count
+                    lines.append(
+                        name + "_bucket" + _format_labels(
+                            label_names + ('le',),
+                            values + (_format_value(bound),)
+                        ) + " " + str(cumulative)
+                    )
+                lines.append(
+                    name + "_sum" + _format_labels(label_names, values)
+                    + " " + _format_value(total)
+                )
+                lines.append(
+                    name + "_count" + _format_labels(label_names, values)
+                    + " " + str(cumulative)
+                )
+        return "\n".join(lines) + "\n"
+
+
+THREADS = Metrics.gauge(
+    'device_threads', "Live threads", function=threading.active_count
+)
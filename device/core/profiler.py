@@ -0,0 +1,287 @@
+import hmac
+import os
+import sys
+import threading
+import time
+from threading import Event, Lock, Thread
+
+from .config import Config
+from .execution_process import ExecutionProcess, isolated
+from .fire_controller import PAUSED, RUNNING, SCHEDULED, FireController
+from .lane import PAUSED as LANE_PAUSED
+from .lane import RUNNING as LANE_RUNNING
+
+SHOW_STATES = [RUNNING, PAUSED, SCHEDULED]
+
+EXECUTION_PROCESS = 'execution'
+API_PROCESS = 'api'
+
+
+class ProfilerError(Exception):
+    pass
+
+
+class ProfilerDisabled(ProfilerError, PermissionError):
+    pass
+
+
+class NotAuthorized(ProfilerError, PermissionError):
+    pass
+
+
+class ProfilerRunning(ProfilerError):
+    pass
+
+
+class ProfilerNotRunning(ProfilerError):
+    pass
+
+
+class NoProfile(ProfilerError):
+    pass
+
+
+class ShowRunning(ProfilerError):
+    def __init__(self, program_state):
+        self.program_state = program_state
+
+
+class InvalidDuration(ProfilerError, ValueError):
+    def __init__(self, duration, max_duration):
+        self.duration = duration
+        self.max_duration = max_duration
+
+
+class InvalidInterval(ProfilerError, ValueError):
+    def __init__(self, interval):
+        self.interval = interval
+
+
+class Profiler():
+    # samples the stacks of all threads of the process owning
+    # FireController (and of the api process if isolated) at a fixed
+    # interval, the result are collapsed stacks (one "thread;outer;...;inner
+    # count" line per distinct stack) as consumed by flamegraph tools
+
+    _lock = Lock()
+    _thread = None
+    _stop_event = Event()
+    _stacks = None
+    _n_samples = 0
+    _start_time = None
+    _end_time = None
+    _duration = None
+    _interval = None
+    _frame_names = dict()
+
+    @classmethod
+    def check_token(cls, authorization):
+        token = Config.get('profiler', 'token')
+        if not token:
+            raise ProfilerDisabled()
+        if not hmac.compare_digest(
+            (authorization or "").encode('utf-8'),
+            f"Bearer {token}".encode('utf-8')
+        ):
+            raise NotAuthorized()
+
+    @classmethod
+    def _show_state(cls):
+        program_state = FireController.get_program_state()
+        if program_state in SHOW_STATES:
+            return program_state
+        for lane in FireController.get_lanes():
+            if lane['state'] in (LANE_RUNNING, LANE_PAUSED):
+                return f"lane {lane['lane']} {lane['state']}"
+        return None
+
+    @classmethod
+    def _frame_name(cls, code):
+        name = cls._frame_names.get(code)
+        if name is None:
+            name = (
+                f"{code.co_name} "
+                f"({os.path.basename(code.co_filename)}:"
+                f"{code.co_firstlineno})"
+            )
+            cls._frame_names[code] = name
+        return name
+
+    @classmethod
+    def _sample(cls):
+        own_ident = threading.get_ident()
+        thread_names = {
+            thread.ident: thread.name for thread in threading.enumerate()
+        }
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = list()
+            while frame is not None:
+                stack.append(cls._frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, str(ident)))
+            key = ";".join(reversed(stack))
+            cls._stacks[key] = cls._stacks.get(key, 0) + 1
+        cls._n_samples += 1
+
+    @classmethod
+    def _profiler_handler(cls, deadline, interval):
+        while not cls._stop_event.is_set() and time.monotonic() < deadline:
+            cls._sample()
+            cls._stop_event.wait(interval)
+        cls._end_time = time.monotonic()
+
+    @classmethod
+    def _running(cls):
+        return cls._thread is not None and cls._thread.is_alive()
+
+    @classmethod
+    def _start_local(cls, duration, interval, force):
+        with cls._lock:
+            if cls._running():
+                raise ProfilerRunning()
+            show_state = cls._show_state()
+            if show_state is not None and not force:
+                raise ShowRunning(show_state)
+
+            cls._stacks = dict()
+            cls._n_samples = 0
+            cls._duration = duration
+            cls._interval = interval
+            cls._start_time = time.monotonic()
+            cls._end_time = None
+            cls._stop_event.clear()
+            cls._thread = Thread(
+                target=cls._profiler_handler,
+                args=(cls._start_time + duration, interval),
+                name='__PROFILER_THREAD__',
+                daemon=True
+            )
+            cls._thread.start()
+        return cls._status_local()
+
+    @classmethod
+    def _stop_local(cls):
+        with cls._lock:
+            if not cls._running():
+                raise ProfilerNotRunning()
+            cls._stop_event.set()
+            cls._thread.join()
+        return cls._status_local()
+
+    @classmethod
+    def _status_local(cls):
+        if cls._start_time is None:
+            elapsed = None
+        elif cls._end_time is None:
+            elapsed = time.monotonic() - cls._start_time
+        else:
+            elapsed = cls._end_time - cls._start_time
+        return {
+            'running': cls._running(),
+            'duration': cls._duration,
+            'interval': cls._interval,
+            'elapsed': elapsed,
+            'samples': cls._n_samples,
+            'stacks': None if cls._stacks is None else len(cls._stacks)
+        }
+
+    @classmethod
+    def _collapsed_local(cls):
+        with cls._lock:
+            if cls._stacks is None:
+                raise NoProfile()
+            if cls._running():
+                raise ProfilerRunning()
+            return "".join(
+                f"{stack} {count}\n"
+                for stack, count in sorted(cls._stacks.items())
+            )
+
+    # the process owning FireController, the execution process if isolated
+
+    @isolated('profiler')
+    @classmethod
+    def _owner_start(cls, duration, interval, force):
+        return cls._start_local(duration, interval, force)
+
+    @isolated('profiler')
+    @classmethod
+    def _owner_stop(cls):
+        return cls._stop_local()
+
+    @isolated('profiler')
+    @classmethod
+    def _owner_status(cls):
+        return cls._status_local()
+
+    @isolated('profiler')
+    @classmethod
+    def _owner_collapsed(cls):
+        return cls._collapsed_local()
+
+    # when isolated, the api process (request handling, heartbeats) is
+    # sampled alongside the execution process; status reports both and the
+    # collapsed stacks are rooted in the name of their process
+
+    @classmethod
+    def start(cls, duration=None, interval=None, force=False):
+        if duration is None:
+            duration = Config.get('profiler', 'default_duration')
+        if interval is None:
+            interval = Config.get('profiler', 'interval')
+        max_duration = Config.get('profiler', 'max_duration')
+        if not 0 < duration <= max_duration:
+            raise InvalidDuration(duration, max_duration)
+        if interval < Config.get('profiler', 'min_interval'):
+            raise InvalidInterval(interval)
+
+        if not ExecutionProcess.is_active():
+            return cls._owner_start(duration, interval, force)
+        if cls._running():
+            raise ProfilerRunning()
+        cls._owner_start(duration, interval, force)
+        # the execution process already refused to disturb a show
+        cls._start_local(duration, interval, force=True)
+        return cls.status()
+
+    @classmethod
+    def stop(cls):
+        if not ExecutionProcess.is_active():
+            return cls._owner_stop()
+        try:
+            cls._owner_stop()
+        finally:
+            if cls._running():
+                cls._stop_local()
+        return cls.status()
+
+    @classmethod
+    def status(cls):
+        owner_status = cls._owner_status()
+        if not ExecutionProcess.is_active():
+            return owner_status
+        local_status = cls._status_local()
+        return {
+            **owner_status,
+            'running': owner_status['running'] or local_status['running'],
+            'processes': {
+                EXECUTION_PROCESS: owner_status,
+                API_PROCESS: local_status
+            }
+        }
+
+    @classmethod
+    def collapsed(cls):
+        owner_collapsed = cls._owner_collapsed()
+        if not ExecutionProcess.is_active():
+            return owner_collapsed
+        return "".join(
+            f"{process};{line}\n"
+            for process, collapsed in (
+                (EXECUTION_PROCESS, owner_collapsed),
+                (API_PROCESS, cls._collapsed_local())
+            )
+            for line in collapsed.splitlines()
+        )
@@ -1,13 +1,30 @@
-import time
-from datetime import datetime
-from threading import Thread
+import hashlib
+import math
+from bisect import bisect_left
+from functools import partial
+from threading import Lock
 
-import numpy as np
-
-from .address import Address
+from .address import Address, AddressError
 from .config import Config
-from .fire_command import FireCommand
-from .timestamp import Timestamp
+from .executor import Executor
+from .fire_command import FireCommand, FireFrame
+from .fire_journal import (CONTINUED, FINISHED, PAUSED, STARTED, STOPPED,
+                           FireJournal, program_id)
+from .fuse_board import (FIRED, FIREING, SKIPPED, STAGED, VERBOSE,
+                         FuseBoard)
+from .hardware_controller import HardwareController
+from .program_format import (RECORD, decode_program, decode_show,
+                             encode_program, encode_show, is_show)
+from .timestamp import Timestamp, TimestampError
+
+SEQUENTIAL = 'sequential'
+PARALLEL = 'parallel'
+REGISTER = 'register'
+
+
+def to_deciseconds(seconds):
+    # first decisecond at or after seconds
+    return math.ceil(round(seconds * 10, 6))
 
 
 class ProgramError(Exception):
@@ -18,8 +35,10 @@ class InvalidProgram(ProgramError, ValueError):
     pass
 
 
-class HangingProgramThread(ProgramError, RuntimeError):
-    pass
+class InvalidCommand(InvalidProgram):
+    def __init__(self, index, reason):
+        self.index = index
+        self.reason = reason
 
 
 class ProgramNotRunning(ProgramError):
@@ -34,6 +53,16 @@ class ProgramFinalized(ProgramError):
     pass
 
 
+class InvalidOffset(ProgramError, ValueError):
+    def __init__(self, offset):
+        self.offset = offset
+
+
+class InvalidPattern(ProgramError, ValueError):
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+
 class ProgramNotFinalized(ProgramError):
     pass
 
@@ -42,13 +71,18 @@ class Program():
 
     def __init__(self, program_name):
         self._command_list = list()
-        self._thread = None
+        self._lock = Lock()
 
         self._name = program_name
 
-        self._pause_flag = False
-        self._continue_flag = False
-        self._stop_flag = False
+        self._running = False
+        self._pause_time = None
+        self._command_idx = 0
+        self._skip_idx = 0
+        self._schedule = None
+        self._schedule_times = None
+        self._next_event = None
+        self._generation = 0
 
         self._start_time = None
 
@@ -57,132 +91,357 @@ class Program():
         self._callback = None
         self._started = False
 
+        self._content_hash = None
+
+        self._fuse_board = FuseBoard()
+        self._fuse_mask = 0
+
+        self._verify = False
+        self._test_results = list()
+
+        self._journal_id = None
+
     def add_command(self, command):
         if self._finalized:
             raise ProgramFinalized()
+        command.fuse_board = self._fuse_board
+        self._fuse_board.stage(command.address.fuse_bitmask)
+        self._fuse_mask |= command.address.fuse_bitmask
         self._command_list.append(command)
 
     def finalize(self):
         if self._finalized:
             raise ProgramFinalized()
+        # the command list keeps upload order (it defines the binary form
+        # and the content hash), execution and queries use the time index
+        self._schedule = sorted(
+            self._command_list,
+            key=lambda command: command.timestamp.total_deciseconds
+        )
+        self._schedule_times = [
+            command.timestamp.total_deciseconds for command in self._schedule
+        ]
         self._finalized = True
 
-    def run(self, callback):
+    def copy(self):
+        program = Program(self._name)
+        for command in self._command_list:
+            program.add_command(FireCommand(
+                address=command.address,
+                timestamp=command.timestamp,
+                name=command.name,
+                description=command.description
+            ))
+        program.finalize()
+        program._content_hash = self._content_hash
+        return program
+
+    def enable_journal(self):
+        self._journal_id = program_id(self.content_hash)
+
+    def _journal(self, event):
+        if self._journal_id is None:
+            return
+        try:
+            FireJournal.event(event, self._journal_id)
+        except Exception as exc:
+            FireJournal.report_failure('event', exc)
+
+    def mark_fired(self, fuse_mask):
+        # commands whose fuses are all in fuse_mask count as fired and are
+        # not fired again, e.g. after a run interrupted by a crash
+        fired_mask = 0
+        for command in self._command_list:
+            bitmask = command.address.fuse_bitmask
+            if bitmask & fuse_mask == bitmask:
+                command.mark_fired()
+                fired_mask |= bitmask
+        self._fuse_board.fired(fired_mask)
+
+    def run(self, callback, start_offset=0.0):
         if not self._finalized:
             raise ProgramNotFinalized()
-        self._callback = callback
-        self._thread = Thread(target=self._execution_handler)
-        self._thread.name = "__program_execution_thread__"
-        self._thread.start()
-        self._started = True
+        if start_offset < 0:
+            raise InvalidOffset(start_offset)
+        with self._lock:
+            self._callback = callback
+            self._skip_to(start_offset)
+            self._start_time = Executor.now() - start_offset
+            self._started = True
+            self._running = True
+            self._journal(STARTED)
+            if self._schedule_next():
+                return
+            self._running = False
+            self._journal(FINISHED)
+        self._callback()
 
     def pause(self):
         if not self._finalized:
             raise ProgramNotFinalized()
-        if not self._thread.is_alive():
-            raise ProgramNotRunning()
-        self._pause_flag = True
+        with self._lock:
+            if not self._running:
+                raise ProgramNotRunning()
+            if self._pause_time is None:
+                self._pause_time = Executor.now()
+                self._cancel_next()
+                self._journal(PAUSED)
 
     def continue_(self):
         if not self._finalized:
             raise ProgramNotFinalized()
-        if not self._thread.is_alive():
-            raise ProgramNotRunning()
-        if not self._pause_flag:
-            raise ProgramNotPaused()
-        self._continue_flag = True
+        with self._lock:
+            if not self._running:
+                raise ProgramNotRunning()
+            if self._pause_time is None:
+                raise ProgramNotPaused()
+            self._start_time += Executor.now() - self._pause_time
+            self._pause_time = None
+            self._journal(CONTINUED)
+            self._schedule_next()
 
     def stop(self):
         if not self._finalized:
             raise ProgramNotFinalized()
-        if not self._thread.is_alive():
-            raise ProgramNotRunning()
-        self._stop_flag = True
-        self._thread.join(
-            timeout=Config.get('timeouts', 'program_thread')
-        )
-        self._stop_flag = False
-        if self._thread.is_alive():
-            raise HangingProgramThread()
-
-    def _pause_handler(self):
-        while not self._continue_flag:
-            if self._stop_flag:
-                self._pause_flag = False
-                self._continue_flag = False
-                return
-            time.sleep(Config.get('timings', 'resolution'))
-            # TODO: update start_time
-        self._continue_flag = False
-        self._pause_flag = False
-
-    def _execution_handler(self):
-        self._start_time = datetime.now()
-        pause_time = None
-        command_idx = 0
-
-        while (not self._stop_flag) and len(self._command_list) > 0:
-
-            if self._pause_flag:
-                pause_time = datetime.now()
-                self._pause_handler()
-                self._start_time += (datetime.now() - pause_time)
+        with self._lock:
+            if not self._running:
+                raise ProgramNotRunning()
+            self._cancel_next()
+            self._running = False
+            self._journal(STOPPED)
+        self._callback()
 
-            time.sleep(Config.get('timings', 'resolution'))
+    def _skip_to(self, start_offset):
+        self._command_idx = bisect_left(
+            self._schedule_times, to_deciseconds(start_offset)
+        )
+        self._skip_idx = self._command_idx
+        skipped_mask = 0
+        for command in self._schedule[:self._skip_idx]:
+            skipped_mask |= command.address.fuse_bitmask
+            if skipped_mask == self._fuse_mask:
+                break
+        if skipped_mask:
+            self._fuse_board.skip(skipped_mask)
+
+    def _cancel_next(self):
+        # a tick that is already being executed notices the new generation
+        self._generation += 1
+        if self._next_event is not None:
+            self._next_event.cancel()
+            self._next_event = None
+
+    def _schedule_next(self):
+        if self._command_idx >= len(self._schedule):
+            self._next_event = None
+            return False
+        self._next_event = Executor.schedule(
+            self._start_time
+            + self._schedule[self._command_idx].timestamp.total_seconds,
+            partial(self._execution_handler, self._generation)
+        )
+        return True
 
-            command = self._command_list[command_idx]
-            timestamp = datetime.now() - self._start_time
-            if command.timestamp.total_seconds <= timestamp.total_seconds():
-                command.fire()
-                command_idx += 1
-                if command_idx >= len(self._command_list):
-                    break
+    def _execution_handler(self, generation):
+        with self._lock:
+            if generation != self._generation or not self._running:
+                return
 
+            # every command that is due in this tick is fired as one frame
+            timestamp = Executor.now() - self._start_time
+            frame = list()
+            while (
+                self._command_idx < len(self._schedule)
+                and self._schedule[self._command_idx]
+                .timestamp.total_seconds <= timestamp
+            ):
+                command = self._schedule[self._command_idx]
+                if not command.fired:
+                    frame.append(command)
+                self._command_idx += 1
+            if len(frame) > 0:
+                FireFrame(
+                    frame, self._fuse_board,
+                    on_lit=self._verify_frame if self._verify else None,
+                    journal_id=self._journal_id
+                ).fire()
+
+            if self._schedule_next():
+                return
+            self._running = False
+            self._journal(FINISHED)
         self._callback()
 
     @property
     def fuse_status(self):
-        result = Program.empty_fuse_status()
-        for command in self._command_list:
-            letter = command.address.letter
-            number = command.address.number
-            range_ = command.address.range
-
-            for r in range(range_):
-                if command.fired:
-                    result[letter][number + r] = {'state': 'fired'}
-                elif command.fireing:
-                    result[letter][number + r] = {'state': 'fireing'}
-                elif not self._started:
-                    result[letter][number + r] = {'state': 'staged'}
-                else:
+        result = ['none'] * Address.n_fuses()
+        for idx, command in enumerate(self._schedule):
+            if idx < self._skip_idx:
+                state = {'state': 'skipped'}
+            elif command.fired:
+                state = {'state': 'fired'}
+            elif command.fireing:
+                state = {'state': 'fireing'}
+            elif not self._started:
+                state = {'state': 'staged'}
+            else:
+
+                remaining_seconds = command.timestamp.total_seconds - \
+                    (Executor.now() - self._start_time)
+
+                progress = remaining_seconds / \
+                    command.timestamp.total_seconds
+
+                progress = progress if progress >= 0.0 else 0.0
+
+                state = {
+                    'state': 'staged',
+                    'progress': progress
+                }
+
+            for fuse_id in command.address.fuse_ids:
+                result[fuse_id] = state
+        return Address.group_by_chip(result)
+
+    def serialize_fuse_status(self, fuse_format=VERBOSE):
+        if fuse_format == VERBOSE:
+            return self.fuse_status
+        return self._fuse_board.serialize(fuse_format)
+
+    def _cue_state(self, idx, command):
+        if idx < self._skip_idx:
+            return SKIPPED
+        elif command.fired:
+            return FIRED
+        elif command.fireing:
+            return FIREING
+        return STAGED
+
+    def cues(self, start=None, end=None, offset=0, limit=None):
+        # cues with start <= time < end (seconds), paginated by offset and
+        # limit; returns the page and the number of cues in the range
+        if not self._finalized:
+            raise ProgramNotFinalized()
+        low = 0 if start is None else \
+            bisect_left(self._schedule_times, to_deciseconds(start))
+        high = len(self._schedule) if end is None else \
+            bisect_left(self._schedule_times, to_deciseconds(end))
+        high = max(low, high)
+        first = low + offset
+        last = high if limit is None else min(high, first + limit)
+        return [
+            {
+                'address': command.address.raw_address,
+                'time': command.timestamp.total_seconds,
+                'name': command.name,
+                'description': command.description,
+                'state': self._cue_state(idx, command)
+            }
+            for idx, command in enumerate(
+                self._schedule[first:last], first
+            )
+        ], high - low
 
-                    remaining_seconds = command.timestamp.total_seconds - \
-                        (datetime.now() - self._start_time).total_seconds()
+    @property
+    def fuse_board(self):
+        return self._fuse_board
 
-                    progress = remaining_seconds / \
-                        command.timestamp.total_seconds
+    @property
+    def commands(self):
+        return self._command_list
 
-                    progress = progress if progress >= 0.0 else 0.0
+    @property
+    def schedule(self):
+        # the commands in time order, available once finalized
+        if not self._finalized:
+            raise ProgramNotFinalized()
+        return self._schedule
 
-                    result[letter][number + r] = {
-                        'state': 'staged',
-                        'progress': progress
-                    }
-        return result
+    @property
+    def fuse_mask(self):
+        # every fuse used by this program, whatever its state
+        return self._fuse_mask
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def content_hash(self):
+        if not self._finalized:
+            raise ProgramNotFinalized()
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha256(self.to_binary()).hexdigest()
+        return self._content_hash
+
     @property
     def started(self):
         return self._started
 
+    @property
+    def journal_id(self):
+        return self._journal_id
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def paused(self):
+        return self._pause_time is not None
+
+    @classmethod
+    def empty_fuse_status(cls, fuse_format=VERBOSE):
+        return FuseBoard().serialize(fuse_format)
+
+    @classmethod
+    def _fields_from_raw(cls, raw_command, index):
+        # the fields of a JSON command of any device
+        try:
+            device_id = raw_command['device_id'].lower()
+            raw_address = raw_command['address'].lower()
+            time_fields = (
+                raw_command['h'], raw_command['m'],
+                raw_command['s'], raw_command['ms']
+            )
+            name = raw_command.get('name', "")
+            description = raw_command.get('description', "")
+        except (KeyError, TypeError, AttributeError) as exc:
+            raise InvalidCommand(index, type(exc).__name__) from exc
+        if not isinstance(name, (str, type(None))) or \
+                not isinstance(description, (str, type(None))):
+            raise InvalidCommand(index, 'TypeError')
+        return device_id, raw_address, time_fields, name, description
+
+    @classmethod
+    def _timestamp_from_raw(cls, time_fields, index):
+        try:
+            return Timestamp(*time_fields)
+        except (TimestampError, TypeError) as exc:
+            raise InvalidCommand(index, type(exc).__name__) from exc
+
+    @classmethod
+    def _address_from_raw(cls, raw_address, index):
+        try:
+            return Address.parse(raw_address)
+        except AddressError as exc:
+            raise InvalidCommand(index, type(exc).__name__) from exc
+
     @classmethod
-    def empty_fuse_status(cls):
-        chips = Config.get('i2c', 'chip_addresses').keys()
-        return {chip: (['none'] * 16) for chip in chips}
+    def command_from_raw(cls, raw_command, index):
+        device_id, raw_address, time_fields, name, description = \
+            cls._fields_from_raw(raw_command, index)
+        if device_id != Config.get("connection", 'device_id'):
+            return None
+
+        timestamp = cls._timestamp_from_raw(time_fields, index)
+        address = cls._address_from_raw(raw_address, index)
+        return FireCommand(
+            address=address,
+            timestamp=timestamp,
+            name=name,
+            description=description
+        )
 
     @classmethod
     def from_command_list(cls, commands, program_name):
@@ -191,71 +450,167 @@ class Program():
 
         program = Program(program_name)
 
-        for raw_command in commands:
-            try:
-                device_id = raw_command['device_id'].lower()
-                raw_address = raw_command['address'].lower()
-                hours = raw_command['h']
-                minutes = raw_command['m']
-                seconds = raw_command['s']
-                deciseconds = raw_command['ms']
-                if 'name' in raw_command:
-                    name = raw_command['name']
-                else:
-                    name = ""
-                if 'description' in raw_command:
-                    description = raw_command['description']
-                else:
-                    description = ""
-            except KeyError:
-                raise InvalidProgram()
-
-            if device_id != Config.get("connection", 'device_id'):
-                continue
+        for index, raw_command in enumerate(commands):
+            command = cls.command_from_raw(raw_command, index)
+            if command is not None:
+                program.add_command(command)
 
-            timestamp = Timestamp(
-                hours=hours,
-                minutes=minutes,
-                seconds=seconds,
-                deciseconds=deciseconds
-            )
+        program.finalize()
+        return program
 
-            command = FireCommand(
-                address=Address(raw_address),
-                timestamp=timestamp,
-                name=name,
-                description=description
-            )
+    @classmethod
+    def build_show(cls, commands, program_name):
+        # encodes a fleet-wide command list as a show; every command is
+        # checked like in from_command_list, addresses only for this device
+        # as other devices may have other chips
+        if not isinstance(commands, list):
+            raise InvalidProgram()
+
+        own_device_id = Config.get("connection", 'device_id')
+        device_cues = dict()
+        for index, raw_command in enumerate(commands):
+            device_id, raw_address, time_fields, name, description = \
+                cls._fields_from_raw(raw_command, index)
+            timestamp = cls._timestamp_from_raw(time_fields, index)
+            if device_id == own_device_id:
+                cls._address_from_raw(raw_address, index)
+            device_cues.setdefault(device_id, list()).append((
+                device_id, raw_address, name, description,
+                timestamp.total_deciseconds
+            ))
+        return encode_show(program_name, {
+            device_id: encode_program(program_name, cues)
+            for device_id, cues in device_cues.items()
+        })
 
+    @classmethod
+    def from_binary(cls, data, program_name=None):
+        device_id = Config.get("connection", 'device_id')
+        # a show keeps its hash on every device, so the master can tell
+        # which show a device has loaded
+        content_hash = None
+        if is_show(data):
+            show_name, content_hash, data = decode_show(data, device_id)
+            if data is None:
+                program = Program(
+                    show_name if program_name is None else program_name
+                )
+                program.finalize()
+                program._content_hash = content_hash
+                return program
+
+        name, strings, records = decode_program(data)
+        program = Program(name if program_name is None else program_name)
+
+        # the string table is case sensitive, "Dev1" and "dev1" may both
+        # be in it and both are this device
+        device_indices = {
+            idx for idx, string in enumerate(strings)
+            if string.lower() == device_id.lower()
+        }
+        addresses = dict()
+
+        for index, (
+            record_device_idx, address_idx, name_idx, description_idx,
+            deciseconds
+        ) in enumerate(RECORD.iter_unpack(records)):
+            if record_device_idx not in device_indices:
+                continue
+            try:
+                address = addresses.get(address_idx)
+                if address is None:
+                    address = Address.parse(strings[address_idx])
+                    addresses[address_idx] = address
+                command = FireCommand(
+                    address=address,
+                    timestamp=Timestamp.from_total_deciseconds(deciseconds),
+                    name=strings[name_idx],
+                    description=strings[description_idx]
+                )
+            except (AddressError, IndexError) as exc:
+                raise InvalidCommand(index, type(exc).__name__) from exc
             program.add_command(command)
 
         program.finalize()
+        if content_hash is not None:
+            program._content_hash = content_hash
         return program
 
-    @classmethod
-    def testloop_program(cls):
-        program = Program("__TESTLOOP__")
+    def to_binary(self):
+        device_id = Config.get("connection", 'device_id')
+        return encode_program(
+            self._name,
+            (
+                (
+                    device_id,
+                    command.address.raw_address,
+                    command.name,
+                    command.description,
+                    command.timestamp.total_deciseconds
+                )
+                for command in self._command_list
+            )
+        )
+
+    def _verify_frame(self, frame):
+        # reads the error registers back while the frame is lit
+        errors = HardwareController.error_bitmap() & frame.fuse_bitmask
+        self._test_results.append({
+            'time': frame.commands[0].timestamp.total_seconds,
+            'fuses': Address.addresses_from_bitmask(frame.fuse_bitmask),
+            'errors': Address.addresses_from_bitmask(errors)
+        })
+
+    @property
+    def test_results(self):
+        return self._test_results
 
-        address_list = Address.full_address_list()
-        for address, timestamp in zip(
-            address_list,
-            [
-                Timestamp(*timestamp_components)
-                for timestamp_components in [
-                    Timestamp.get_timestamp_components(total_seconds)
-                    for total_seconds in np.arange(
-                        0,
-                        len(address_list) * Config.get(
-                            'timings',
-                            'testloop_period'
-                        ),
-                        Config.get('timings', 'testloop_period')
+    @classmethod
+    def testloop_steps(cls, pattern):
+        n_chips = Address.n_chips()
+        if pattern == SEQUENTIAL:
+            # one fuse per step
+            return [
+                [Address.from_fuse_id(fuse_id)]
+                for fuse_id in range(Address.n_fuses())
+            ]
+        elif pattern == PARALLEL:
+            # fuse n of every chip per step, one write per chip
+            return [
+                [
+                    Address.from_fuse_id(
+                        chip_index * Address.FUSES_PER_CHIP + number
                     )
+                    for chip_index in range(n_chips)
                 ]
+                for number in range(Address.FUSES_PER_CHIP)
             ]
-        ):
-            command = FireCommand(address, timestamp)
-            program.add_command(command)
+        elif pattern == REGISTER:
+            # a whole fuse register (4 outputs) of every chip per step
+            return [
+                [
+                    Address.from_fuse_id(
+                        chip_index * Address.FUSES_PER_CHIP + number,
+                        range_=4
+                    )
+                    for chip_index in range(n_chips)
+                ]
+                for number in range(0, Address.FUSES_PER_CHIP, 4)
+            ]
+        raise InvalidPattern(pattern)
+
+    @classmethod
+    def testloop_program(cls, pattern=SEQUENTIAL, verify=False):
+        program = Program("__TESTLOOP__")
+        program._verify = verify
+
+        period = Config.get('timings', 'testloop_period')
+        for step, addresses in enumerate(cls.testloop_steps(pattern)):
+            timestamp = Timestamp.from_total_deciseconds(
+                round(step * period * 10)
+            )
+            for address in addresses:
+                program.add_command(FireCommand(address, timestamp))
 
         program.finalize()
 
@@ -0,0 +1,248 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Event, Thread
+
+from .address import Address
+from .bus_planner import BusPlanner, InvalidTolerance
+from .config import Config
+from .fire_command import FireCommand
+from .metrics import Metrics
+from .program import InvalidProgram, Program
+from .timestamp import Timestamp
+
+QUEUED = 'queued'
+COMPILING = 'compiling'
+PLANNING = 'planning'
+HASHING = 'hashing'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+COMPILATION_SECONDS = Metrics.histogram(
+    'device_compilation_seconds', "Program compilation time", ('outcome',)
+)
+COMPILATION_COMMANDS = Metrics.histogram(
+    'device_compilation_commands', "Commands per compiled program",
+    buckets=lambda: Config.get('metrics', 'size_buckets')
+)
+
+
+class ProgramCompilerError(Exception):
+    pass
+
+
+class CompilationCancelled(ProgramCompilerError):
+    pass
+
+
+class HangingCompilationThread(ProgramCompilerError, RuntimeError):
+    def __init__(self, program_name):
+        self.program_name = program_name
+
+
+def validate_commands(commands, start_index):
+    # runs in a worker process, only plain tuples travel back
+    validated = list()
+    for index, raw_command in enumerate(commands, start_index):
+        command = Program.command_from_raw(raw_command, index)
+        if command is not None:
+            validated.append((
+                command.address.raw_address,
+                command.timestamp.total_deciseconds,
+                command.name,
+                command.description
+            ))
+    return validated
+
+
+class Compilation():
+    # builds a Program from a raw command list in a background thread,
+    # large shows are validated on a process pool
+
+    def __init__(self, commands, program_name, shift_tolerance=None):
+        if not isinstance(commands, list):
+            raise InvalidProgram()
+        if shift_tolerance is not None and shift_tolerance < 0:
+            raise InvalidTolerance(shift_tolerance)
+        self._commands = commands
+        self._program_name = program_name
+        self._shift_tolerance = shift_tolerance
+        self._bus_plan = None
+        self._n_total = len(commands)
+        self._n_done = 0
+        self._phase = QUEUED
+        self._error = None
+        self._content_hash = None
+        self._start_time = None
+        self._end_time = None
+        self._cancel_event = Event()
+        self._thread = None
+        self._callback = None
+
+    def start(self, callback):
+        # callback(compilation, program) is called from the compilation
+        # thread, program is None if compilation failed or was cancelled;
+        # it returns whether the program was taken
+        self._callback = callback
+        self._thread = Thread(
+            target=self._compilation_handler,
+            name='__COMPILATION_THREAD__',
+            daemon=True
+        )
+        self._start_time = time.monotonic()
+        self._phase = COMPILING
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel_event.set()
+        self._thread.join(timeout=Config.get('timeouts', 'compilation'))
+        if self._thread.is_alive():
+            raise HangingCompilationThread(self._program_name)
+
+    def _check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise CompilationCancelled()
+
+    def _chunks(self):
+        chunk_size = Config.get('compilation', 'chunk_size')
+        for start in range(0, self._n_total, chunk_size):
+            yield start, self._commands[start:start + chunk_size]
+
+    def _compile_serial(self, program):
+        for start, chunk in self._chunks():
+            self._check_cancelled()
+            for index, raw_command in enumerate(chunk, start):
+                command = Program.command_from_raw(raw_command, index)
+                if command is not None:
+                    program.add_command(command)
+            self._n_done = start + len(chunk)
+
+    def _compile_parallel(self, program):
+        workers = Config.get('compilation', 'workers') or os.cpu_count()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            try:
+                futures = [
+                    (start, len(chunk),
+                     executor.submit(validate_commands, chunk, start))
+                    for start, chunk in self._chunks()
+                ]
+                for start, chunk_length, future in futures:
+                    while not future.done():
+                        self._check_cancelled()
+                        time.sleep(Config.get('timings', 'resolution'))
+                    for raw_address, deciseconds, name, description \
+                            in future.result():
+                        program.add_command(FireCommand(
+                            address=Address.parse(raw_address),
+                            timestamp=Timestamp.from_total_deciseconds(
+                                deciseconds
+                            ),
+                            name=name,
+                            description=description
+                        ))
+                    self._n_done = start + chunk_length
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    def _compilation_handler(self):
+        program = Program(self._program_name)
+        try:
+            if self._n_total >= \
+                    Config.get('compilation', 'parallel_threshold'):
+                self._compile_parallel(program)
+            else:
+                self._compile_serial(program)
+            program.finalize()
+            self._check_cancelled()
+            self._phase = PLANNING
+            if self._shift_tolerance is not None:
+                program = BusPlanner.shift(program, self._shift_tolerance)
+            bus_plan = BusPlanner.plan(program)
+            self._bus_plan = {
+                'peak': bus_plan['peak'],
+                'n_infeasible': bus_plan['n_infeasible']
+            }
+            self._check_cancelled()
+            self._phase = HASHING
+            self._content_hash = program.content_hash
+            self._check_cancelled()
+        except CompilationCancelled:
+            self._callback(self, None)
+            self._finish(CANCELLED)
+            return
+        except Exception as exc:
+            self._error = {
+                'exception_type': str(type(exc)),
+                'exception_args': vars(exc)
+            }
+            self._callback(self, None)
+            self._finish(FAILED)
+            return
+
+        try:
+            taken = self._callback(self, program)
+        except Exception as exc:
+            self._error = {
+                'exception_type': str(type(exc)),
+                'exception_args': vars(exc)
+            }
+            self._finish(FAILED)
+            return
+        self._finish(DONE if taken else CANCELLED)
+
+    def _finish(self, phase):
+        self._end_time = time.monotonic()
+        self._phase = phase
+        COMPILATION_SECONDS.labels(phase).observe(
+            self._end_time - self._start_time
+        )
+        COMPILATION_COMMANDS.observe(self._n_total)
+        # the raw commands are not needed anymore
+        self._commands = None
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self._phase in (DONE, FAILED, CANCELLED)
+
+    @property
+    def program_name(self):
+        return self._program_name
+
+    @property
+    def progress(self):
+        n_done = self._n_done
+        if self._start_time is None:
+            elapsed = 0.0
+        elif self._end_time is None:
+            elapsed = time.monotonic() - self._start_time
+        else:
+            elapsed = self._end_time - self._start_time
+
+        eta = None
+        if self._phase == COMPILING and n_done > 0:
+            eta = elapsed / n_done * (self._n_total - n_done)
+        elif self.finished:
+            eta = 0.0
+
+        return {
+            'program_name': self._program_name,
+            'phase': self._phase,
+            'total': self._n_total,
+            'done': n_done,
+            'elapsed': elapsed,
+            'eta': eta,
+            'hash': self._content_hash if self._phase == DONE else None,
+            'bus_plan': self._bus_plan,
+            'error': self._error
+        }
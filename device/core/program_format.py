@@ -0,0 +1,264 @@
+import hashlib
+import os
+import struct
+
+# Binary program layout (little endian):
+#
+#   header   | magic, version, flags, n_strings, n_records, name index
+#   strings  | n_strings x (u16 length, utf-8 bytes)
+#   records  | n_records x (device_id index, address index, name index,
+#            |              description index, total deciseconds)
+#
+# Every string (device ids, addresses, names, descriptions) is stored once
+# in the string table and referenced by index from the fixed width records.
+#
+# Show layout (little endian), one artifact for a whole fleet:
+#
+#   header    | magic, version, flags, n_devices, sha256 of name and
+#             | directory
+#   name      | u16 length, utf-8 program name
+#   directory | n_devices x (device_id, offset, length, sha256 of the program)
+#   programs  | one binary program per device, offsets are relative to the
+#             | start of this section
+#
+# The header hash covers the digest of every program, so it identifies the
+# whole show while a device only has to hash its own program to verify it.
+
+MAGIC = b'RLPG'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHIII')
+STRING_LENGTH = struct.Struct('<H')
+RECORD = struct.Struct('<IIIII')
+
+MAX_STRING_LENGTH = 0xffff
+MAX_DECISECONDS = 0xffffffff
+
+SHOW_MAGIC = b'RLSH'
+SHOW_VERSION = 2
+
+SHOW_HEADER = struct.Struct('<4sHHI32s')
+DIRECTORY_ENTRY = struct.Struct('<32sQQ32s')
+
+
+class ProgramFormatError(Exception):
+    pass
+
+
+class InvalidFormat(ProgramFormatError, ValueError):
+    def __init__(self, reason):
+        self.reason = reason
+
+
+class UnsupportedVersion(ProgramFormatError, ValueError):
+    def __init__(self, version):
+        self.version = version
+
+
+class StringTooLong(InvalidFormat):
+    def __init__(self, length):
+        InvalidFormat.__init__(self, 'string too long')
+        self.length = length
+
+
+class UnknownMagic(InvalidFormat):
+    def __init__(self, magic):
+        InvalidFormat.__init__(self, 'unknown magic')
+        # hex, exception attributes are reported as json
+        self.magic = bytes(magic).hex()
+
+
+class StringTable():
+
+    def __init__(self):
+        self._strings = list()
+        self._indices = dict()
+
+    def intern(self, string):
+        try:
+            return self._indices[string]
+        except KeyError:
+            index = len(self._strings)
+            self._strings.append(string)
+            self._indices[string] = index
+            return index
+
+    def encode(self):
+        chunks = list()
+        for string in self._strings:
+            raw = string.encode('utf-8')
+            if len(raw) > MAX_STRING_LENGTH:
+                raise StringTooLong(len(raw))
+            chunks.append(STRING_LENGTH.pack(len(raw)))
+            chunks.append(raw)
+        return b''.join(chunks)
+
+    def __len__(self):
+        return len(self._strings)
+
+
+def encode_program(program_name, cues):
+    # cues: iterable of (device_id, raw_address, name, description,
+    # total_deciseconds)
+    strings = StringTable()
+    name_idx = strings.intern(program_name or "")
+    records = bytearray()
+    n_records = 0
+    for device_id, raw_address, name, description, deciseconds in cues:
+        if not 0 <= deciseconds <= MAX_DECISECONDS:
+            raise InvalidFormat('cue time out of range')
+        records += RECORD.pack(
+            strings.intern(device_id),
+            strings.intern(raw_address),
+            strings.intern(name or ""),
+            strings.intern(description or ""),
+            deciseconds
+        )
+        n_records += 1
+
+    header = HEADER.pack(
+        MAGIC, VERSION, 0, len(strings), n_records, name_idx
+    )
+    return header + strings.encode() + bytes(records)
+
+
+def decode_program(data):
+    # returns (program_name, strings, records) where records is a zero-copy
+    # view on data that can be passed to RECORD.iter_unpack
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise InvalidFormat('truncated header')
+    magic, version, _, n_strings, n_records, name_idx = \
+        HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise UnknownMagic(magic)
+    if version != VERSION:
+        raise UnsupportedVersion(version)
+
+    offset = HEADER.size
+    strings = list()
+    try:
+        for _ in range(n_strings):
+            (length,) = STRING_LENGTH.unpack_from(view, offset)
+            offset += STRING_LENGTH.size
+            if offset + length > len(view):
+                raise InvalidFormat('truncated string table')
+            strings.append(str(view[offset:offset + length], 'utf-8'))
+            offset += length
+    except (struct.error, UnicodeDecodeError):
+        raise InvalidFormat('corrupt string table')
+
+    end = offset + n_records * RECORD.size
+    if end != len(view):
+        raise InvalidFormat('record array size mismatch')
+    if name_idx >= len(strings):
+        raise InvalidFormat('string index out of range')
+
+    return strings[name_idx], strings, view[offset:end]
+
+
+def read_program_name(file):
+    # reads a binary program from file only as far as its name, for listing
+    # programs without decoding them
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise InvalidFormat('truncated header')
+    magic, version, _, n_strings, _, name_idx = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise UnknownMagic(magic)
+    if version != VERSION:
+        raise UnsupportedVersion(version)
+    if name_idx >= n_strings:
+        raise InvalidFormat('string index out of range')
+
+    for _ in range(name_idx):
+        raw_length = file.read(STRING_LENGTH.size)
+        if len(raw_length) < STRING_LENGTH.size:
+            raise InvalidFormat('truncated string table')
+        file.seek(STRING_LENGTH.unpack(raw_length)[0], os.SEEK_CUR)
+    raw_length = file.read(STRING_LENGTH.size)
+    if len(raw_length) < STRING_LENGTH.size:
+        raise InvalidFormat('truncated string table')
+    (length,) = STRING_LENGTH.unpack(raw_length)
+    raw_name = file.read(length)
+    if len(raw_name) < length:
+        raise InvalidFormat('truncated string table')
+    try:
+        return raw_name.decode('utf-8')
+    except UnicodeDecodeError:
+        raise InvalidFormat('corrupt string table')
+
+
+def is_show(data):
+    return bytes(data[:len(SHOW_MAGIC)]) == SHOW_MAGIC
+
+
+def encode_show(program_name, device_programs):
+    # device_programs: mapping of device_id to an encoded binary program
+    raw_name = (program_name or "").encode('utf-8')
+    if len(raw_name) > MAX_STRING_LENGTH:
+        raise StringTooLong(len(raw_name))
+    directory = bytearray()
+    offset = 0
+    for device_id, data in device_programs.items():
+        raw_device_id = device_id.lower().encode('utf-8')
+        if len(raw_device_id) > 32:
+            raise InvalidFormat('device id too long')
+        directory += DIRECTORY_ENTRY.pack(
+            raw_device_id, offset, len(data), hashlib.sha256(data).digest()
+        )
+        offset += len(data)
+
+    index = STRING_LENGTH.pack(len(raw_name)) + raw_name + bytes(directory)
+    header = SHOW_HEADER.pack(
+        SHOW_MAGIC, SHOW_VERSION, 0, len(device_programs),
+        hashlib.sha256(index).digest()
+    )
+    return b''.join([header, index, *device_programs.values()])
+
+
+def decode_show(data, device_id, verify=True):
+    # returns (program_name, content_hash, program) where program is a
+    # zero-copy view on this device's binary program or None; verifying
+    # hashes the name, the directory and this device's program only
+    view = memoryview(data)
+    if len(view) < SHOW_HEADER.size:
+        raise InvalidFormat('truncated header')
+    magic, version, _, n_devices, content_hash = \
+        SHOW_HEADER.unpack_from(view, 0)
+    if magic != SHOW_MAGIC:
+        raise UnknownMagic(magic)
+    if version != SHOW_VERSION:
+        raise UnsupportedVersion(version)
+
+    try:
+        offset = SHOW_HEADER.size
+        (length,) = STRING_LENGTH.unpack_from(view, offset)
+        offset += STRING_LENGTH.size
+        program_name = str(view[offset:offset + length], 'utf-8')
+        offset += length
+
+        programs_offset = offset + n_devices * DIRECTORY_ENTRY.size
+        if programs_offset > len(view):
+            raise InvalidFormat('truncated directory')
+        if verify and hashlib.sha256(
+            view[SHOW_HEADER.size:programs_offset]
+        ).digest() != content_hash:
+            raise InvalidFormat('content hash mismatch')
+
+        raw_device_id = device_id.lower().encode('utf-8')
+        program = None
+        for entry_device_id, entry_offset, entry_length, digest in \
+                DIRECTORY_ENTRY.iter_unpack(view[offset:programs_offset]):
+            if entry_device_id.rstrip(b'\x00') == raw_device_id:
+                start = programs_offset + entry_offset
+                if start + entry_length > len(view):
+                    raise InvalidFormat('truncated program')
+                program = view[start:start + entry_length]
+                if verify and hashlib.sha256(program).digest() != digest:
+                    raise InvalidFormat('program hash mismatch')
+                break
+    except (struct.error, UnicodeDecodeError):
+        raise InvalidFormat('corrupt directory')
+
+    return program_name, content_hash.hex(), program
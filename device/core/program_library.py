@@ -0,0 +1,200 @@
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from .config import Config
+from .metrics import Metrics
+from .program import Program
+from .program_format import ProgramFormatError, read_program_name
+
+LIBRARY_ERRORS = Metrics.counter(
+    'device_library_errors_total', "Failed library operations",
+    ('operation',)
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ProgramLibraryError(Exception):
+    pass
+
+
+class UnknownProgram(ProgramLibraryError, KeyError):
+    def __init__(self, content_hash):
+        self.content_hash = content_hash
+
+
+class InvalidLimit(ProgramLibraryError, ValueError):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class ProgramLibrary():
+    _FILE_EXTENSION = '.rlpg'
+
+    _lock = Lock()
+    _cache = OrderedDict()
+    # content hash to program name of every program in the directory seen
+    # by this process, listing does not have to open those files
+    _names = dict()
+
+    _max_programs = None
+    _max_bytes = None
+
+    @classmethod
+    def _directory(cls):
+        directory = Config.get('library', 'directory')
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    @classmethod
+    def _filename(cls, content_hash):
+        if not all(c in '0123456789abcdef' for c in content_hash) \
+                or len(content_hash) != 64:
+            raise UnknownProgram(content_hash)
+        return os.path.join(
+            cls._directory(), content_hash + cls._FILE_EXTENSION
+        )
+
+    @classmethod
+    def _entries(cls):
+        entries = list()
+        with os.scandir(cls._directory()) as it:
+            for entry in it:
+                if entry.is_file() and \
+                        entry.name.endswith(cls._FILE_EXTENSION):
+                    entries.append(entry)
+        return entries
+
+    @classmethod
+    def _cache_put(cls, content_hash, program):
+        cls._cache[content_hash] = program
+        cls._cache.move_to_end(content_hash)
+        while len(cls._cache) > Config.get('library', 'cache_size'):
+            cls._cache.popitem(last=False)
+
+    @classmethod
+    def _enforce_limits(cls, keep=None):
+        max_programs = cls.get_limits()['max_programs']
+        max_bytes = cls.get_limits()['max_bytes']
+        entries = sorted(cls._entries(), key=lambda e: e.stat().st_mtime)
+        n_programs = len(entries)
+        n_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if n_programs <= max_programs and n_bytes <= max_bytes:
+                break
+            content_hash = entry.name[:-len(cls._FILE_EXTENSION)]
+            if content_hash == keep:
+                continue
+            n_programs -= 1
+            n_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+            cls._cache.pop(content_hash, None)
+            cls._names.pop(content_hash, None)
+
+    @classmethod
+    def add(cls, program):
+        content_hash = program.content_hash
+        with cls._lock:
+            filename = cls._filename(content_hash)
+            if os.path.exists(filename):
+                os.utime(filename)
+            else:
+                tmp_filename = filename + '.tmp'
+                with open(tmp_filename, 'wb') as file:
+                    file.write(program.to_binary())
+                os.replace(tmp_filename, filename)
+            cls._cache_put(content_hash, program.copy())
+            cls._names[content_hash] = program.name or ""
+            cls._enforce_limits(keep=content_hash)
+        return content_hash
+
+    @classmethod
+    def report_failure(cls, operation, exc):
+        # the library is a convenience, callers that must not fail on a
+        # full or read only disk count and log instead
+        LIBRARY_ERRORS.labels(operation).inc()
+        logger.warning("Library %s failed: %r", operation, exc)
+
+    @classmethod
+    def get(cls, content_hash):
+        with cls._lock:
+            filename = cls._filename(content_hash)
+            program = cls._cache.get(content_hash)
+            if program is None:
+                try:
+                    with open(filename, 'rb') as file:
+                        data = file.read()
+                except FileNotFoundError:
+                    raise UnknownProgram(content_hash)
+                program = Program.from_binary(data)
+                program._content_hash = content_hash
+            cls._cache_put(content_hash, program)
+            os.utime(filename)
+            return program.copy()
+
+    @classmethod
+    def evict(cls, content_hash):
+        with cls._lock:
+            filename = cls._filename(content_hash)
+            cls._cache.pop(content_hash, None)
+            cls._names.pop(content_hash, None)
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                raise UnknownProgram(content_hash)
+
+    @classmethod
+    def list(cls):
+        with cls._lock:
+            result = list()
+            for entry in cls._entries():
+                content_hash = entry.name[:-len(cls._FILE_EXTENSION)]
+                program_name = cls._names.get(content_hash)
+                corrupt = False
+                if program_name is None:
+                    try:
+                        with open(entry.path, 'rb') as file:
+                            program_name = read_program_name(file)
+                        cls._names[content_hash] = program_name
+                    except ProgramFormatError as exc:
+                        # one bad file must not hide the others
+                        cls.report_failure('list', exc)
+                        corrupt = True
+                result.append({
+                    'hash': content_hash,
+                    'program_name': program_name,
+                    'corrupt': corrupt,
+                    'size': entry.stat().st_size,
+                    'last_used': entry.stat().st_mtime,
+                    'cached': content_hash in cls._cache
+                })
+            return result
+
+    @classmethod
+    def get_limits(cls):
+        return {
+            'max_programs': (
+                Config.get('library', 'max_programs')
+                if cls._max_programs is None else cls._max_programs
+            ),
+            'max_bytes': (
+                Config.get('library', 'max_bytes')
+                if cls._max_bytes is None else cls._max_bytes
+            )
+        }
+
+    @classmethod
+    def set_limits(cls, max_programs=None, max_bytes=None):
+        if max_programs is not None and max_programs < 1:
+            raise InvalidLimit('max_programs', max_programs)
+        if max_bytes is not None and max_bytes < 0:
+            raise InvalidLimit('max_bytes', max_bytes)
+        with cls._lock:
+            if max_programs is not None:
+                cls._max_programs = max_programs
+            if max_bytes is not None:
+                cls._max_bytes = max_bytes
+            cls._enforce_limits()
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from .config import Config
+from .program import Program
+
+# Persisted program layout (little endian):
+#
+#   header  | magic, version, config fingerprint, payload sha256,
+#           | content hash of the program, payload length
+#   payload | binary program as produced by Program.to_binary()
+
+MAGIC = b'RLLP'
+VERSION = 2
+
+HEADER = struct.Struct('<4sH32s32s32sQ')
+
+
+class ProgramStoreError(Exception):
+    pass
+
+
+class NoStoredProgram(ProgramStoreError):
+    pass
+
+
+class CorruptStoredProgram(ProgramStoreError, ValueError):
+    def __init__(self, reason):
+        self.reason = reason
+
+
+class ConfigChanged(ProgramStoreError):
+    pass
+
+
+class ProgramStore():
+
+    @classmethod
+    def _filename(cls):
+        return Config.get('persistence', 'loaded_program')
+
+    @classmethod
+    def config_fingerprint(cls):
+        return hashlib.sha256(json.dumps(
+            {
+                'device_id': Config.get('connection', 'device_id'),
+                'bus_address': Config.get('i2c', 'bus_address'),
+                'chip_buses': Config.get('i2c', 'chip_buses'),
+                'chip_addresses': Config.get('i2c', 'chip_addresses')
+            },
+            sort_keys=True
+        ).encode('utf-8')).digest()
+
+    @classmethod
+    def save(cls, program):
+        payload = program.to_binary()
+        header = HEADER.pack(
+            MAGIC, VERSION,
+            cls.config_fingerprint(),
+            hashlib.sha256(payload).digest(),
+            bytes.fromhex(program.content_hash),
+            len(payload)
+        )
+        filename = cls._filename()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as file:
+            file.write(header)
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def clear(cls):
+        try:
+            os.remove(cls._filename())
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def load(cls):
+        try:
+            file = open(cls._filename(), 'rb')
+        except FileNotFoundError:
+            raise NoStoredProgram()
+
+        with file:
+            # an empty file cannot be mapped, e.g. after a crash before the
+            # first write of a filesystem without atomic renames
+            if os.fstat(file.fileno()).st_size == 0:
+                raise CorruptStoredProgram('empty file')
+            with mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    return cls._decode(view)
+                finally:
+                    view.release()
+
+    @classmethod
+    def _decode(cls, view):
+        if len(view) < HEADER.size:
+            raise CorruptStoredProgram('truncated header')
+        magic, version, fingerprint, checksum, content_hash, length = \
+            HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            raise CorruptStoredProgram('bad magic or version')
+        if len(view) != HEADER.size + length:
+            raise CorruptStoredProgram('size mismatch')
+        if fingerprint != cls.config_fingerprint():
+            raise ConfigChanged()
+
+        payload = view[HEADER.size:]
+        error = None
+        try:
+            if hashlib.sha256(payload).digest() != checksum:
+                raise CorruptStoredProgram('checksum mismatch')
+            try:
+                program = Program.from_binary(payload)
+            except (ValueError, struct.error) as exc:
+                error = type(exc).__name__
+        finally:
+            payload.release()
+        if error is not None:
+            # raised only here, the traceback of the decode error holds
+            # views into the mapped file, which could not be closed then
+            raise CorruptStoredProgram(f"undecodable payload ({error})")
+        # differs from the payload checksum for programs from a show
+        program._content_hash = content_hash.hex()
+        return program
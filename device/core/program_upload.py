@@ -0,0 +1,55 @@
+from .config import Config
+from .program import InvalidProgram, Program
+
+
+class ProgramUploadError(Exception):
+    pass
+
+
+class BatchTooLarge(ProgramUploadError, ValueError):
+    def __init__(self, batch_size, max_batch_size):
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+
+
+class BatchOutOfOrder(ProgramUploadError, ValueError):
+    def __init__(self, offset, expected_offset):
+        self.offset = offset
+        self.expected_offset = expected_offset
+
+
+class ProgramUpload():
+
+    def __init__(self, program_name):
+        self._program = Program(program_name)
+        self._n_received = 0
+
+    def append(self, commands, offset=None):
+        if not isinstance(commands, list):
+            raise InvalidProgram()
+        max_batch_size = Config.get('upload', 'max_batch_size')
+        if len(commands) > max_batch_size:
+            raise BatchTooLarge(len(commands), max_batch_size)
+        if offset is not None and offset != self._n_received:
+            raise BatchOutOfOrder(offset, self._n_received)
+
+        batch = [
+            Program.command_from_raw(raw_command, index)
+            for index, raw_command in enumerate(commands, self._n_received)
+        ]
+        for command in batch:
+            if command is not None:
+                self._program.add_command(command)
+        self._n_received += len(commands)
+
+    def commit(self):
+        self._program.finalize()
+        return self._program
+
+    @property
+    def name(self):
+        return self._program.name
+
+    @property
+    def n_received(self):
+        return self._n_received
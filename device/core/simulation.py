@@ -0,0 +1,288 @@
+import csv
+import io
+import multiprocessing
+import threading
+import time
+from threading import Lock
+
+from .bus_planner import READ_CLOCKS, WRITE_CLOCKS
+from .config import Config
+from .executor import Executor, VirtualClock
+from .fire_command import FireFrame
+from .hardware_controller import Bus, HardwareController
+from .program import Program, to_deciseconds
+
+TRACE_FIELDS = [
+    'address', 'name', 'time', 'scheduled', 'lit', 'unlit', 'lateness'
+]
+
+
+class SimulationError(Exception):
+    pass
+
+
+class NoSimulation(SimulationError):
+    pass
+
+
+class SimulationTimeout(SimulationError, TimeoutError):
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+
+class SimulationDied(SimulationError, RuntimeError):
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+
+
+class SimulatedDevice():
+    # stands in for SMBus, keeps the register contents and accounts every
+    # transaction on the virtual clock, one transaction at a time per bus
+
+    def __init__(self, bus_address, clock):
+        self._bus_address = bus_address
+        self._clock = clock
+        self._registers = dict()
+        self._busy_until = 0.0
+        self._read_time = (
+            READ_CLOCKS / Config.get('bus_planner', 'bus_speed')
+            + Config.get('bus_planner', 'transaction_overhead')
+        )
+        self._write_time = (
+            WRITE_CLOCKS / Config.get('bus_planner', 'bus_speed')
+            + Config.get('bus_planner', 'transaction_overhead')
+        )
+        self.transactions = list()
+        self.writes = list()
+        self.peak_threads = 0
+
+    def _transaction(self, duration):
+        start = max(self._clock.now(), self._busy_until)
+        self._busy_until = start + duration
+        self._clock.occupy(self._busy_until)
+        self.transactions.append((start, duration))
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+        return self._busy_until
+
+    def read_byte_data(self, i2c_address, register_address):
+        self._transaction(self._read_time)
+        return self._registers.get((i2c_address, register_address), 0)
+
+    def write_byte_data(self, i2c_address, register_address, value):
+        end = self._transaction(self._write_time)
+        self._registers[(i2c_address, register_address)] = value
+        self.writes.append((end, i2c_address, register_address))
+
+
+class SimulatedBus(Bus):
+
+    def __init__(self, bus_address, clock):
+        self._bus_address = bus_address
+        self._lock = Lock()
+        self._init_metrics()
+        self._bus = SimulatedDevice(bus_address, clock)
+
+    @property
+    def device(self):
+        return self._bus
+
+
+def _trace_frames(devices, times):
+    # records when the register writes of every cue hit the bus, as
+    # (lit, unlit) per command id
+    def traced(method, slot):
+        def wrapper(frame):
+            marks = {
+                bus_address: len(device.writes)
+                for bus_address, device in devices.items()
+            }
+            method(frame)
+            ends = dict()
+            for bus_address, device in devices.items():
+                for end, chip_address, register_address \
+                        in device.writes[marks[bus_address]:]:
+                    ends[(bus_address, chip_address, register_address)] = end
+            for command in frame.commands:
+                address = command.address
+                times.setdefault(id(command), [None, None])[slot] = ends.get(
+                    (address.bus_address, address.chip_address,
+                     address.register_address)
+                )
+        return wrapper
+
+    FireFrame._light = traced(FireFrame._light, 0)
+    FireFrame._unlight = traced(FireFrame._unlight, 1)
+
+
+def _bus_peak(devices):
+    window = Config.get('bus_planner', 'window')
+    busy = dict()
+    for bus_address, device in devices.items():
+        for start, duration in device.transactions:
+            key = (int(start / window), bus_address)
+            busy[key] = busy.get(key, 0.0) + duration
+    if len(busy) == 0:
+        return None
+    (slot, bus_address), busy_time = max(
+        busy.items(), key=lambda item: item[1]
+    )
+    return {
+        'time': slot * window,
+        'bus': bus_address,
+        'busy': busy_time,
+        'utilization': busy_time / window
+    }
+
+
+def _simulation_main(connection, data, start_offset):
+    # runs in a process of its own: the executor clock and the buses are
+    # replaced for good, the real ones are never touched
+    try:
+        wall_start = time.perf_counter()
+        clock = VirtualClock()
+        Executor.set_clock(clock)
+        HardwareController.set_buses({
+            bus_address: SimulatedBus(bus_address, clock)
+            for bus_address in HardwareController.buses()
+        })
+        devices = {
+            bus_address: bus.device
+            for bus_address, bus in HardwareController.buses().items()
+        }
+        times = dict()
+        _trace_frames(devices, times)
+
+        program = Program.from_binary(data)
+        start_time = clock.now()
+        # with no cue at or after the offset nothing is scheduled and the
+        # executor never starts, so there is nothing to wait for
+        scheduled = any(
+            command.timestamp.total_deciseconds
+            >= to_deciseconds(start_offset)
+            for command in program.schedule
+        )
+        program.run(callback=lambda: None, start_offset=start_offset)
+        if scheduled:
+            clock.idle.wait()
+        wall_time = time.perf_counter() - wall_start
+
+        trace = list()
+        ignitions = list()
+        for command in program.schedule:
+            lit, unlit = (
+                time_ - start_time if time_ is not None else None
+                for time_ in times.get(id(command), (None, None))
+            )
+            scheduled = command.timestamp.total_seconds - start_offset
+            trace.append({
+                'address': command.address.raw_address,
+                'name': command.name,
+                'time': command.timestamp.total_seconds,
+                'scheduled': scheduled if lit is not None else None,
+                'lit': lit,
+                'unlit': unlit,
+                'lateness': lit - scheduled if lit is not None else None
+            })
+            if lit is not None:
+                ignitions.append((lit, 1))
+                if unlit is not None:
+                    ignitions.append((unlit, -1))
+
+        n_ignitions = peak_ignitions = 0
+        for _, change in sorted(ignitions):
+            n_ignitions += change
+            peak_ignitions = max(peak_ignitions, n_ignitions)
+
+        fired = [cue for cue in trace if cue['lit'] is not None]
+        worst = max(fired, key=lambda cue: cue['lateness'], default=None)
+        duration = clock.now() - start_time
+        summary = {
+            'program_name': program.name,
+            'program_hash': program.content_hash,
+            'start_offset': start_offset,
+            'duration': duration,
+            'wall_time': wall_time,
+            'speedup': duration / wall_time if wall_time > 0 else None,
+            'cues': len(trace),
+            'fired': len(fired),
+            'transactions': sum(
+                len(device.transactions) for device in devices.values()
+            ),
+            'peak_bus_load': _bus_peak(devices),
+            'peak_threads': max(
+                (device.peak_threads for device in devices.values()),
+                default=threading.active_count()
+            ),
+            'peak_ignitions': peak_ignitions,
+            'max_lateness': None if worst is None else worst['lateness'],
+            'mean_lateness': (
+                sum(cue['lateness'] for cue in fired) / len(fired)
+                if len(fired) > 0 else None
+            ),
+            'worst_cue': worst
+        }
+        connection.send((True, (summary, trace)))
+    except Exception as exc:
+        connection.send((False, (type(exc), vars(exc))))
+
+
+class Simulation():
+    # dry runs a program through the real executor and bus dispatcher on a
+    # simulated bus and a virtual clock, in a separate process
+
+    _lock = Lock()
+    _summary = None
+    _trace = None
+
+    @classmethod
+    def run(cls, data, start_offset=0.0):
+        with cls._lock:
+            context = multiprocessing.get_context('spawn')
+            connection, child_connection = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_simulation_main,
+                args=(child_connection, data, start_offset),
+                name='__simulation_process__',
+                daemon=True
+            )
+            process.start()
+            child_connection.close()
+            try:
+                timeout = Config.get('simulation', 'timeout')
+                if not connection.poll(timeout):
+                    raise SimulationTimeout(timeout)
+                try:
+                    success, result = connection.recv()
+                except EOFError:
+                    process.join()
+                    raise SimulationDied(process.exitcode)
+            finally:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+                connection.close()
+
+            if not success:
+                exc_type, exc_vars = result
+                exc = exc_type.__new__(exc_type)
+                exc.__dict__.update(exc_vars)
+                raise exc
+
+            cls._summary, cls._trace = result
+            return cls._summary
+
+    @classmethod
+    def summary(cls):
+        if cls._summary is None:
+            raise NoSimulation()
+        return cls._summary
+
+    @classmethod
+    def trace_csv(cls):
+        if cls._trace is None:
+            raise NoSimulation()
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=TRACE_FIELDS)
+        writer.writeheader()
+        writer.writerows(cls._trace)
+        return output.getvalue()
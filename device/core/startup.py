@@ -0,0 +1,164 @@
+import atexit
+import logging
+import time
+from threading import Lock, Thread
+
+from .config import Config
+from .execution_process import ExecutionProcess
+from .metrics import Metrics
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class Startup():
+    # brings the device up in the background, so the api answers (and
+    # reports readiness) while the hardware is still being initialized
+
+    _lock = Lock()
+    _thread = None
+    _steps = dict()
+    _start_time = None
+    _end_time = None
+
+    @classmethod
+    def local_steps(cls):
+        # the steps of the process owning FireController, i.e. this one or
+        # the execution process
+        from .fire_controller import FireController, FireControllerError
+        from .hardware_controller import HardwareController
+        from .program_store import ProgramStoreError
+        from .status_board import StatusBoard
+        from .status_publisher import StatusPublisher
+
+        def restore_program():
+            # the api serves requests meanwhile, a program loaded in the
+            # meantime wins over the stored one
+            try:
+                FireController.restore_program()
+            except (ProgramStoreError, FireControllerError) as exc:
+                return f"Not restoring stored program: {exc!r}"
+
+        return [
+            ('hardware', HardwareController.initialize),
+            ('program', restore_program),
+            (
+                'status_publisher',
+                lambda: StatusPublisher.start(StatusBoard.shared())
+            )
+        ]
+
+    @classmethod
+    def _step_list(cls):
+        def execution_process():
+            # the execution process brings up the hardware itself and
+            # reports its steps once it is done
+            with cls._lock:
+                cls._steps.update(ExecutionProcess.wait_ready())
+
+        if ExecutionProcess.is_reader():
+            return list()
+        if Config.get('execution', 'isolated'):
+            return [('execution_process', execution_process)]
+        return cls.local_steps()
+
+    @classmethod
+    def run_steps(cls, steps):
+        # a failing step does not stop the others, returns the result of
+        # every step
+        results = dict()
+        for name, step in steps:
+            with cls._lock:
+                cls._steps[name] = {'state': RUNNING, 'message': None}
+            try:
+                message = step()
+                state = DONE if message is None else SKIPPED
+            except Exception as exc:
+                state, message = FAILED, repr(exc)
+            if state == FAILED:
+                logger.error("Startup step %s failed: %s", name, message)
+            elif state == SKIPPED:
+                logger.warning("Startup step %s skipped: %s", name, message)
+            results[name] = {'state': state, 'message': message}
+            with cls._lock:
+                cls._steps[name] = results[name]
+        return results
+
+    @classmethod
+    def _startup_handler(cls, steps):
+        cls.run_steps(steps)
+        cls._end_time = time.monotonic()
+
+    @classmethod
+    def start(cls):
+        from .fire_controller import FireController
+        from .status_board import StatusBoard
+
+        # creating the status board refuses to start next to a running
+        # instance, before anything touches the hardware
+        if not ExecutionProcess.is_reader():
+            if Config.get('execution', 'isolated'):
+                # has to be up before the first request, starting it is
+                # cheap
+                ExecutionProcess.start()
+            else:
+                StatusBoard.create_shared()
+            # the segment outlives the process unless it is unlinked
+            atexit.register(cls.stop)
+        if ExecutionProcess.is_remote():
+            FireController.watch_remote_state()
+        steps = cls._step_list()
+        cls._steps = {
+            name: {'state': PENDING, 'message': None} for name, _ in steps
+        }
+        cls._start_time = time.monotonic()
+        # only registered in the process bringing the device up
+        Metrics.gauge(
+            'device_ready', "Whether the device bring-up has finished",
+            function=lambda: int(cls.is_ready())
+        )
+        cls._thread = Thread(
+            target=cls._startup_handler,
+            args=(steps,),
+            name='__STARTUP_THREAD__',
+            daemon=True
+        )
+        cls._thread.start()
+
+    @classmethod
+    def stop(cls):
+        from .status_board import StatusBoard
+        from .status_publisher import StatusPublisher
+
+        if ExecutionProcess.is_active():
+            # the execution process stops its publisher, the board is ours
+            ExecutionProcess.stop()
+        else:
+            StatusPublisher.stop()
+            StatusBoard.close_shared()
+
+    @classmethod
+    def is_ready(cls):
+        with cls._lock:
+            return cls._end_time is not None and all(
+                step['state'] != FAILED for step in cls._steps.values()
+            )
+
+    @classmethod
+    def status(cls):
+        with cls._lock:
+            steps = {name: dict(step) for name, step in cls._steps.items()}
+        if cls._start_time is None:
+            elapsed = None
+        else:
+            elapsed = (cls._end_time or time.monotonic()) - cls._start_time
+        return {
+            'ready': cls.is_ready(),
+            'elapsed': elapsed,
+            'steps': steps
+        }
@@ -0,0 +1,256 @@
+import math
+import os
+import struct
+import time
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+from threading import Lock
+
+from .address import Address
+from .config import Config
+
+# Fixed layout of the shared status segment (little endian):
+#
+#   owner    | pid of the creating process
+#   sequence | seqlock counter, odd while a write is in progress
+#   fields   | publish time (posix), program state index, locked, scheduled
+#            | time (posix, NaN if none), program name length, program name,
+#            | program hash
+#   bitmaps  | staged, fireing, fired, skipped and error bitmap, 2 bytes per
+#            | chip each
+#
+# There is exactly one writer (the process owning FireController), any
+# number of processes may attach and read. The segment is named after the
+# configured name and the api port, so instances on different ports do not
+# share it.
+
+PROGRAM_STATES = [
+    'unloaded', 'loaded', 'running', 'paused',
+    'running_testloop', 'paused_testloop', 'scheduled', 'compiling'
+]
+
+OWNER = struct.Struct('<q')
+SEQUENCE = struct.Struct('<Q')
+FIELDS = struct.Struct('<dBBdH256s64s')
+BITMAP_NAMES = ['staged', 'fireing', 'fired', 'skipped', 'error']
+
+
+class StatusBoardError(Exception):
+    pass
+
+
+class UnknownProgramState(StatusBoardError, ValueError):
+    def __init__(self, program_state):
+        self.program_state = program_state
+
+
+class InconsistentRead(StatusBoardError, RuntimeError):
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+
+class StatusBoardInUse(StatusBoardError, RuntimeError):
+    def __init__(self, name, pid):
+        self.name = name
+        self.pid = pid
+
+
+class StatusBoard():
+
+    _shared = None
+
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self._owner = owner
+        self._bitmap_size = Address.n_chips() * 2
+        self._write_lock = Lock()
+
+    @classmethod
+    def size(cls):
+        return (
+            OWNER.size + SEQUENCE.size + FIELDS.size
+            + len(BITMAP_NAMES) * Address.n_chips() * 2
+        )
+
+    @classmethod
+    def _owner_alive(cls, pid):
+        if pid <= 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @classmethod
+    def create(cls, name=None):
+        try:
+            shm = shared_memory.SharedMemory(
+                name=name, create=True, size=cls.size()
+            )
+        except FileExistsError:
+            existing = cls.attach(name)
+            try:
+                (pid,) = OWNER.unpack_from(existing._shm.buf, 0)
+            finally:
+                existing._shm.close()
+            if cls._owner_alive(pid):
+                # another instance is running, it would keep publishing
+                # into the segment we were about to replace
+                raise StatusBoardInUse(name, pid)
+            # left behind by a previous run that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(
+                name=name, create=True, size=cls.size()
+            )
+        OWNER.pack_into(shm.buf, 0, os.getpid())
+        return StatusBoard(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before python 3.13 every attaching process registers the
+            # segment and would unlink it on exit
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return StatusBoard(shm, owner=False)
+
+    @classmethod
+    def shared_name(cls):
+        return (
+            f"{Config.get('status_board', 'name')}_"
+            f"{Config.get('connection', 'port')}"
+        )
+
+    @classmethod
+    def create_shared(cls):
+        cls._shared = cls.create(cls.shared_name())
+        return cls._shared
+
+    @classmethod
+    def shared(cls):
+        if cls._shared is None:
+            cls._shared = cls.attach(cls.shared_name())
+        return cls._shared
+
+    @classmethod
+    def close_shared(cls):
+        if cls._shared is not None:
+            cls._shared.close()
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            # a child attaching through our resource tracker may have
+            # unregistered the segment, unlink unregisters it again
+            resource_tracker.register(self._shm._name, 'shared_memory')
+            self._shm.unlink()
+        if StatusBoard._shared is self:
+            StatusBoard._shared = None
+
+    def publish(
+        self, program_state, locked, scheduled_time, program_name,
+        program_hash, bitmaps
+    ):
+        if program_state not in PROGRAM_STATES:
+            raise UnknownProgramState(program_state)
+        raw_name = (program_name or "").encode('utf-8')[:256]
+        buf = self._shm.buf
+
+        with self._write_lock:
+            (sequence,) = SEQUENCE.unpack_from(buf, OWNER.size)
+            SEQUENCE.pack_into(buf, OWNER.size, sequence + 1)
+
+            FIELDS.pack_into(
+                buf, OWNER.size + SEQUENCE.size,
+                time.time(),
+                PROGRAM_STATES.index(program_state),
+                1 if locked else 0,
+                math.nan if scheduled_time is None
+                else scheduled_time.timestamp(),
+                len(raw_name) if program_name is not None else 0xffff,
+                raw_name,
+                (program_hash or "").encode('ascii')
+            )
+            for idx, bitmap_name in enumerate(BITMAP_NAMES):
+                if bitmap_name not in bitmaps:
+                    continue
+                offset = self._bitmap_offset(idx)
+                buf[offset:offset + self._bitmap_size] = \
+                    bitmaps[bitmap_name].to_bytes(
+                        self._bitmap_size, 'little'
+                    )
+
+            SEQUENCE.pack_into(buf, OWNER.size, sequence + 2)
+
+    def sequence(self):
+        # changes with every publish, cheap to poll
+        (sequence,) = SEQUENCE.unpack_from(self._shm.buf, OWNER.size)
+        return sequence
+
+    def _bitmap_offset(self, idx):
+        return (
+            OWNER.size + SEQUENCE.size + FIELDS.size
+            + idx * self._bitmap_size
+        )
+
+    def _snapshot(self):
+        buf = self._shm.buf
+        timeout = Config.get('status_board', 'read_timeout')
+        deadline = time.monotonic() + timeout
+        backoff = 0
+        while True:
+            (sequence,) = SEQUENCE.unpack_from(buf, OWNER.size)
+            if sequence % 2 == 0:
+                data = bytes(buf[:self.size()])
+                (sequence_after,) = SEQUENCE.unpack_from(buf, OWNER.size)
+                if sequence == sequence_after:
+                    return data
+            if time.monotonic() >= deadline:
+                raise InconsistentRead(timeout)
+            # the writer may be waiting for the cpu we are spinning on,
+            # yield first and back off up to a millisecond
+            time.sleep(backoff)
+            backoff = min(max(backoff * 2, 0.00001), 0.001)
+
+    def read(self):
+        data = self._snapshot()
+        (
+            published_time, state_idx, locked, scheduled_time, name_length,
+            raw_name, raw_hash
+        ) = FIELDS.unpack_from(data, OWNER.size + SEQUENCE.size)
+        program_hash = raw_hash.rstrip(b'\x00').decode('ascii')
+        return {
+            'published_time': datetime.fromtimestamp(published_time),
+            'program_state': PROGRAM_STATES[state_idx],
+            'locked': locked == 1,
+            'scheduled_time': (
+                None if math.isnan(scheduled_time)
+                else datetime.fromtimestamp(scheduled_time)
+            ),
+            'program_name': (
+                None if name_length == 0xffff
+                else raw_name[:name_length].decode('utf-8', 'replace')
+            ),
+            'program_hash': program_hash or None,
+            'bitmaps': {
+                bitmap_name: int.from_bytes(
+                    data[
+                        self._bitmap_offset(idx):
+                        self._bitmap_offset(idx) + self._bitmap_size
+                    ],
+                    'little'
+                )
+                for idx, bitmap_name in enumerate(BITMAP_NAMES)
+            }
+        }
+
+    @property
+    def name(self):
+        return self._shm.name
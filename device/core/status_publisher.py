@@ -0,0 +1,109 @@
+import logging
+import time
+from threading import Event, Lock, Thread
+
+from .config import Config
+from .fire_controller import FireController
+from .hardware_controller import HardwareController
+from .metrics import Metrics
+
+PUBLISH_ERRORS = Metrics.counter(
+    'device_status_publish_errors_total', "Failed status board updates",
+    ('operation',)
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StatusPublisher():
+    # keeps the shared status board up to date from the process that owns
+    # FireController, either the api process or the execution process
+
+    _status_board = None
+    _thread = None
+    _stop_event = Event()
+    _wakeup = Event()
+
+    _hardware_lock = Lock()
+    _locked = False
+    _error_bitmap = 0
+    _last_hardware_read = None
+
+    @classmethod
+    def _read_hardware(cls, force):
+        # bus reads are rate limited so readers never compete with fireing
+        with cls._hardware_lock:
+            now = time.monotonic()
+            if not force and cls._last_hardware_read is not None and \
+                    now - cls._last_hardware_read \
+                    < Config.get('status_board', 'hardware_period'):
+                return
+            cls._last_hardware_read = now
+            try:
+                cls._locked = HardwareController.is_locked()
+                cls._error_bitmap = HardwareController.error_bitmap()
+            except Exception as exc:
+                # the last known values stay published
+                cls.report_failure('hardware', exc)
+
+    @classmethod
+    def publish(cls, hardware=False):
+        if cls._status_board is None:
+            return
+        cls._read_hardware(force=hardware)
+        bitmaps = FireController.get_fuse_bitmaps()
+        bitmaps['error'] = cls._error_bitmap
+        cls._status_board.publish(
+            program_state=FireController.get_program_state(),
+            locked=cls._locked,
+            scheduled_time=FireController.get_scheduled_time(),
+            program_name=FireController.get_program_name(),
+            program_hash=FireController.get_program_hash(),
+            bitmaps=bitmaps
+        )
+
+    @classmethod
+    def _on_state_change(cls, program_state):
+        cls._wakeup.set()
+
+    @classmethod
+    def _publish_handler(cls):
+        period = Config.get('status_board', 'publish_period')
+        while not cls._stop_event.is_set():
+            cls._wakeup.clear()
+            try:
+                cls.publish()
+            except Exception as exc:
+                cls.report_failure('publish', exc)
+            cls._wakeup.wait(period)
+
+    @classmethod
+    def report_failure(cls, operation, exc):
+        # readers see a stale board rather than none, failures are counted
+        # and logged instead of ending the publisher
+        PUBLISH_ERRORS.labels(operation).inc()
+        logger.warning("Status %s failed: %r", operation, exc)
+
+    @classmethod
+    def start(cls, status_board):
+        cls._status_board = status_board
+        cls.publish(hardware=True)
+        FireController.add_state_listener(cls._on_state_change)
+        cls._stop_event.clear()
+        cls._thread = Thread(
+            target=cls._publish_handler,
+            name='__STATUS_PUBLISHER_THREAD__',
+            daemon=True
+        )
+        cls._thread.start()
+
+    @classmethod
+    def stop(cls):
+        if cls._thread is None:
+            return
+        cls._stop_event.set()
+        cls._wakeup.set()
+        cls._thread.join()
+        cls._thread = None
+        cls._status_board.close()
+        cls._status_board = None
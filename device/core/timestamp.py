@@ -46,6 +46,13 @@ class Timestamp():
             + (deciseconds / 10)
         )
 
+    @classmethod
+    def from_total_deciseconds(cls, total_deciseconds):
+        total_seconds, deciseconds = divmod(int(total_deciseconds), 10)
+        minutes, seconds = divmod(total_seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return Timestamp(hours, minutes, seconds, deciseconds)
+
     @classmethod
     def get_timestamp_components(cls, total_seconds):
         deciseconds = (total_seconds - int(total_seconds)) * 10
@@ -75,3 +82,12 @@ class Timestamp():
     @property
     def total_seconds(self):
         return self._total_seconds
+
+    @property
+    def total_deciseconds(self):
+        return (
+            (self._hours * 36000)
+            + (self._minutes * 600)
+            + (self._seconds * 10)
+            + self._deciseconds
+        )
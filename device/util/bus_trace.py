@@ -0,0 +1,145 @@
+import struct
+import sys
+import time
+from datetime import datetime
+from threading import Lock
+
+# Binary layout of a trace dump (little endian):
+#
+#   header  | magic, version, record size, number of records, offset of
+#           | the wall clock to time.monotonic() at the time of the dump
+#   records | oldest first: monotonic time, duration, bus, chip, register,
+#           | value, operation, thread class, outcome
+#
+# This module only depends on the standard library, so dumps can be decoded
+# anywhere with: python bus_trace.py <dump>
+
+MAGIC = b'I2CT'
+VERSION = 1
+HEADER = struct.Struct('<4sBHQd')
+RECORD = struct.Struct('<dfBBBBBBBx')
+
+OPERATIONS = ['read', 'write']
+THREAD_CLASSES = ['other', 'executor', 'status', 'heartbeat']
+OUTCOMES = ['ok', 'error']
+
+
+class BusTraceError(Exception):
+    pass
+
+
+class InvalidTrace(BusTraceError, ValueError):
+    pass
+
+
+class BusTrace():
+    # fixed size ring buffer of bus transactions, the oldest records are
+    # overwritten; while frozen nothing is recorded
+
+    def __init__(self, size):
+        self._size = size
+        self._buffer = bytearray(RECORD.size * size)
+        self._lock = Lock()
+        self._n_recorded = 0
+        self._frozen = False
+
+    def record(self, start, duration, bus_address, chip_address,
+               register_address, value, operation, thread_class, outcome):
+        if self._frozen:
+            return
+        with self._lock:
+            RECORD.pack_into(
+                self._buffer,
+                (self._n_recorded % self._size) * RECORD.size,
+                start, duration, bus_address, chip_address,
+                register_address, value, operation, thread_class, outcome
+            )
+            self._n_recorded += 1
+
+    def freeze(self):
+        self._frozen = True
+
+    def unfreeze(self):
+        self._frozen = False
+
+    def clear(self):
+        with self._lock:
+            self._n_recorded = 0
+
+    def dump(self):
+        with self._lock:
+            n_records = min(self._n_recorded, self._size)
+            split = (self._n_recorded % self._size) * RECORD.size
+            if self._n_recorded <= self._size:
+                records = bytes(self._buffer[:n_records * RECORD.size])
+            else:
+                records = bytes(self._buffer[split:] + self._buffer[:split])
+        return HEADER.pack(
+            MAGIC, VERSION, RECORD.size, n_records,
+            time.time() - time.monotonic()
+        ) + records
+
+    @property
+    def status(self):
+        return {
+            'size': self._size,
+            'recorded': self._n_recorded,
+            'frozen': self._frozen
+        }
+
+
+def decode(data):
+    if len(data) < HEADER.size:
+        raise InvalidTrace()
+    magic, version, record_size, n_records, wall_offset = \
+        HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size \
+            or len(data) != HEADER.size + n_records * RECORD.size:
+        raise InvalidTrace()
+
+    return [
+        {
+            'time': start,
+            'wall_time': datetime.fromtimestamp(start + wall_offset),
+            'duration': duration,
+            'bus': bus_address,
+            'chip': chip_address,
+            'register': register_address,
+            'value': value,
+            'operation': OPERATIONS[operation],
+            'thread': THREAD_CLASSES[thread_class],
+            'outcome': OUTCOMES[outcome]
+        }
+        for (
+            start, duration, bus_address, chip_address, register_address,
+            value, operation, thread_class, outcome
+        ) in RECORD.iter_unpack(data[HEADER.size:])
+    ]
+
+
+def timeline(records):
+    # one line per transaction, relative to the first one
+    if len(records) == 0:
+        return list()
+    first = records[0]['time']
+    return [
+        "{} +{:10.6f}s {:>9} bus {} chip 0x{:02x} reg 0x{:02x} {:>5} "
+        "0x{:02x} {:7.1f}us {}".format(
+            record['wall_time'].strftime('%H:%M:%S.%f'),
+            record['time'] - first,
+            record['thread'],
+            record['bus'],
+            record['chip'],
+            record['register'],
+            record['operation'],
+            record['value'],
+            record['duration'] * 1e6,
+            record['outcome']
+        )
+        for record in records
+    ]
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'rb') as file:
+        print("\n".join(timeline(decode(file.read()))))
@@ -0,0 +1,82 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Measures the cold start of the api: the time to import the device package
+# in a fresh interpreter, against the budget in the "startup" config section.
+# Run from the repository root: python device/util/import_benchmark.py
+# [runs] [budget]; exits with 1 if the median import time exceeds the budget.
+#
+# Importing the package has no side effects, nothing is brought up. Like
+# bus_trace.py this only depends on the standard library.
+
+CONFIG_FILENAME = os.path.join('device', 'config', 'config.json')
+
+MEASURE = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "import device\n"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def _import_once():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', MEASURE],
+        capture_output=True, text=True, check=True
+    )
+    modules = list()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us), int(cumulative_us), name.strip()))
+    return float(result.stdout.strip().splitlines()[-1]), modules
+
+
+def benchmark(runs=None, budget=None):
+    with open(CONFIG_FILENAME, 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    if runs is None:
+        runs = config['startup']['import_runs']
+    if budget is None:
+        budget = config['startup']['import_budget']
+    times = list()
+    for _ in range(runs):
+        seconds, modules = _import_once()
+        times.append(seconds)
+
+    # top level packages by cumulative time of the last run
+    packages = dict()
+    for _, cumulative_us, name in modules:
+        package = name.lstrip('.').split('.')[0] if not name.startswith(
+            'device'
+        ) else '.'.join(name.split('.')[:3])
+        packages[package] = max(packages.get(package, 0), cumulative_us)
+    return {
+        'runs': runs,
+        'budget': budget,
+        'median': statistics.median(times),
+        'min': min(times),
+        'max': max(times),
+        'slowest': sorted(
+            packages.items(), key=lambda item: item[1], reverse=True
+        )[:10]
+    }
+
+
+if __name__ == '__main__':
+    result = benchmark(
+        int(sys.argv[1]) if len(sys.argv) > 1 else None,
+        float(sys.argv[2]) if len(sys.argv) > 2 else None
+    )
+    print(
+        f"import device: median {result['median'] * 1000:.1f} ms "
+        f"(min {result['min'] * 1000:.1f}, max {result['max'] * 1000:.1f}, "
+        f"{result['runs']} runs), budget {result['budget'] * 1000:.0f} ms"
+    )
+    for package, cumulative_us in result['slowest']:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {package}")
+    sys.exit(0 if result['median'] <= result['budget'] else 1)
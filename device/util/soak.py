@@ -0,0 +1,358 @@
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+# Long running soak test: cycles the fire controller through load, schedule,
+# unschedule, run, pause, continue, stop, testloop, manual fireing and
+# master registration against an in memory bus, and fails if the thread
+# count, RSS, open file descriptors or latencies keep growing.
+#
+# Run from the repository root: python device/util/soak.py [duration]
+# [samples.csv]; exits with 1 on growth, if a cycle fails or if the run was
+# too short to judge (fewer than warmup_cycles + windows cycles). The workload
+# runs in a process of its own, so nothing here brings up the hardware, and
+# in a temporary directory with a copy of the config, so stored programs,
+# the library and the journal of the device are left alone.
+#
+# Growth is judged on the minimum of each of the "windows" equal parts of
+# the run (after "warmup_cycles"): a leak raises the floor, a busy moment
+# does not. A metric fails if these minima strictly increase from window to
+# window and the total increase exceeds its tolerance.
+
+CONFIG_FILENAME = os.path.join('device', 'config', 'config.json')
+
+SAMPLE_FIELDS = [
+    'cycle', 'time', 'threads', 'rss', 'fds', 'lateness', 'call_latency'
+]
+TOLERANCES = {
+    'threads': lambda config: 0,
+    'rss': lambda config: config['rss_tolerance'],
+    'fds': lambda config: 0,
+    'lateness': lambda config: config['latency_tolerance'],
+    'call_latency': lambda config: config['latency_tolerance']
+}
+
+
+class SoakDevice():
+    # stands in for SMBus, a plain register store
+
+    def __init__(self):
+        self._registers = dict()
+
+    def read_byte_data(self, i2c_address, register_address):
+        return self._registers.get((i2c_address, register_address), 0)
+
+    def write_byte_data(self, i2c_address, register_address, value):
+        self._registers[(i2c_address, register_address)] = value
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def _fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def _start_master():
+    # accepts every heartbeat, like a master that is always reachable
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from threading import Thread
+
+    class MasterHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            body = b'{}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MasterHandler)
+    server.daemon_threads = True
+    Thread(
+        target=server.serve_forever, name='__SOAK_MASTER__', daemon=True
+    ).start()
+    return server.server_address[1]
+
+
+class Workload():
+
+    def __init__(self, config, master_port):
+        from device.core.config import Config
+        from device.core.executor import LATENESS
+        from device.core.fire_controller import FireController
+        from device.core.master_communication import MasterCommunicator
+
+        self._config = config
+        self._master_port = master_port
+        self._fire_controller = FireController
+        self._master_communicator = MasterCommunicator
+        self._lateness = LATENESS.labels()
+        self._lateness_seen = (0, 0.0)
+        self._heartbeat_period = Config.get('timings', 'heartbeat_period')
+        self._commands = list()
+        for idx in range(config['cues']):
+            # "ms" counts deciseconds
+            deciseconds = round(idx * config['cue_spacing'] * 10)
+            minutes, seconds = divmod(deciseconds // 10, 60)
+            self._commands.append({
+                'device_id': Config.get('connection', 'device_id'),
+                'address': f"a{idx % 16}",
+                'h': 0,
+                'm': minutes,
+                's': seconds,
+                'ms': deciseconds % 10
+            })
+        self._call_times = list()
+
+    def _call(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        result = getattr(self._fire_controller, method)(*args, **kwargs)
+        self._call_times.append(time.perf_counter() - start)
+        return result
+
+    def _wait_state(self, *states):
+        deadline = time.monotonic() + self._config['state_timeout']
+        while self._fire_controller.get_program_state() not in states:
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"state {self._fire_controller.get_program_state()}, "
+                    f"expected {states}"
+                )
+            time.sleep(0.01)
+
+    def cycle(self, cycle):
+        from datetime import datetime, timedelta
+
+        from device.core.fire_controller import LOADED, UNLOADED
+
+        self._call_times = list()
+        run_time = self._config['cues'] * self._config['cue_spacing']
+
+        self._call('load_program', self._commands, 'soak')
+        self._wait_state(LOADED)
+        self._call(
+            'schedule_program',
+            (datetime.now() + timedelta(minutes=1)).isoformat()
+        )
+        self._call('unschedule_program')
+        self._wait_state(LOADED)
+
+        self._call('run_program')
+        time.sleep(run_time / 3)
+        self._call('pause_program')
+        time.sleep(0.1)
+        self._call('continue_program')
+        if cycle % 2 == 0:
+            self._wait_state(UNLOADED)
+        else:
+            time.sleep(run_time / 3)
+            self._call('stop_program')
+            self._wait_state(LOADED, UNLOADED)
+        if self._fire_controller.get_program_state() == LOADED:
+            self._call('delete_program')
+
+        self._call('testloop', pattern='parallel', verify=True)
+        self._wait_state(UNLOADED)
+        self._call('fire', ['b0-3', 'c4:4'])
+
+        # deregistering and registering right away used to race
+        self._master_communicator.register_master(
+            '127.0.0.1', self._master_port
+        )
+        time.sleep(self._heartbeat_period)
+        self._master_communicator.deregister_master()
+        self._master_communicator.register_master(
+            '127.0.0.1', self._master_port
+        )
+        time.sleep(self._heartbeat_period)
+        self._master_communicator.deregister_master()
+
+    def sample(self, cycle, start):
+        import threading
+
+        counts, total = self._lateness.sample()
+        n_seen, total_seen = self._lateness_seen
+        self._lateness_seen = (sum(counts), total)
+        n_new = sum(counts) - n_seen
+        return {
+            'cycle': cycle,
+            'time': time.monotonic() - start,
+            'threads': threading.active_count(),
+            'rss': _rss(),
+            'fds': _fds(),
+            'lateness': (total - total_seen) / n_new if n_new > 0 else None,
+            'call_latency': (
+                sum(self._call_times) / len(self._call_times)
+                if len(self._call_times) > 0 else None
+            )
+        }
+
+
+def _soak_main(connection, directory, config, duration):
+    try:
+        os.chdir(directory)
+        from device.core.hardware_controller import HardwareController
+
+        for bus in HardwareController.buses().values():
+            with bus.lock:
+                bus._bus = SoakDevice()
+        workload = Workload(config, _start_master())
+
+        start = time.monotonic()
+        cycle = 0
+        while time.monotonic() - start < duration:
+            workload.cycle(cycle)
+            connection.send((True, workload.sample(cycle, start)))
+            cycle += 1
+        connection.send((True, None))
+    except Exception:
+        connection.send((False, traceback.format_exc()))
+
+
+def _growth(samples, config):
+    # None if there are too few cycles to judge anything
+    samples = samples[config['warmup_cycles']:]
+    n_windows = config['windows']
+    if len(samples) < n_windows:
+        return None
+    size = len(samples) // n_windows
+    growth = dict()
+    for field, tolerance in TOLERANCES.items():
+        minima = list()
+        for idx in range(n_windows):
+            window = samples[idx * size:(idx + 1) * size]
+            values = [
+                sample[field] for sample in window
+                if sample[field] is not None
+            ]
+            if len(values) == 0:
+                break
+            minima.append(min(values))
+        else:
+            increasing = all(
+                later > earlier for earlier, later in zip(minima, minima[1:])
+            )
+            if increasing and minima[-1] - minima[0] > tolerance(config):
+                growth[field] = minima
+    return growth
+
+
+def soak(duration=None, on_sample=None):
+    with open(CONFIG_FILENAME, 'r', encoding='utf-8') as file:
+        device_config = json.load(file)
+    config = device_config['soak']
+    if duration is None:
+        duration = config['duration']
+
+    directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(directory, 'device', 'config'))
+    with open(
+        os.path.join(directory, CONFIG_FILENAME), 'w', encoding='utf-8'
+    ) as file:
+        json.dump(device_config, file)
+
+    # the workload process imports the device package from here
+    sys.path.insert(0, os.getcwd())
+    context = multiprocessing.get_context('spawn')
+    connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_soak_main,
+        args=(child_connection, directory, config, duration),
+        name='__soak_process__',
+        daemon=True
+    )
+    process.start()
+    child_connection.close()
+
+    samples = list()
+    error = None
+    try:
+        while True:
+            try:
+                success, result = connection.recv()
+            except EOFError:
+                process.join()
+                error = f"workload process died ({process.exitcode})"
+                break
+            if not success:
+                error = result
+                break
+            if result is None:
+                break
+            samples.append(result)
+            if on_sample is not None:
+                on_sample(result)
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        connection.close()
+        shutil.rmtree(directory)
+
+    return {
+        'cycles': len(samples),
+        'min_cycles': config['warmup_cycles'] + config['windows'],
+        'samples': samples,
+        'error': error,
+        'growth': _growth(samples, config)
+    }
+
+
+def _format_sample(sample):
+    def scaled(value, factor, unit):
+        return "-" if value is None else f"{value * factor:.1f}{unit}"
+
+    return (
+        f"cycle {sample['cycle']:5d} {sample['time']:9.1f}s "
+        f"threads {sample['threads']:3d} "
+        f"rss {scaled(sample['rss'], 1 / 2 ** 20, 'MB')} "
+        f"fds {'-' if sample['fds'] is None else sample['fds']} "
+        f"lateness {scaled(sample['lateness'], 1000, 'ms')} "
+        f"calls {scaled(sample['call_latency'], 1000, 'ms')}"
+    )
+
+
+if __name__ == '__main__':
+    result = soak(
+        float(sys.argv[1]) if len(sys.argv) > 1 else None,
+        on_sample=lambda sample: print(_format_sample(sample), flush=True)
+    )
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=SAMPLE_FIELDS)
+            writer.writeheader()
+            writer.writerows(result['samples'])
+    passed = result['error'] is None and result['growth'] == dict()
+    if result['error'] is not None:
+        print(f"soak failed after {result['cycles']} cycles:")
+        print(result['error'])
+    elif result['growth'] is None:
+        print(
+            f"not enough cycles to judge growth: {result['cycles']}, "
+            f"need at least {result['min_cycles']}"
+        )
+    else:
+        for field, minima in result['growth'].items():
+            print(f"{field} grows: window minima {minima}")
+    if passed:
+        print(f"soak passed, {result['cycles']} cycles")
+    sys.exit(0 if passed else 1)
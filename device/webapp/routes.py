@@ -1,19 +1,55 @@
 import sys
+import time
 import traceback
 from datetime import datetime
 from functools import wraps
 
-from flask import Blueprint, make_response, request
+from flask import Blueprint, g, make_response, request
 from flask_api import status
 
 from ..core.config import Config
+from ..core.execution_process import ExecutionProcess
 from ..core.fire_controller import FireController
+from ..core.fuse_board import VERBOSE
 from ..core.hardware_controller import HardwareController
 from ..core.master_communication import MasterCommunicator
+from ..core.metrics import Metrics
+from ..core.profiler import NotAuthorized, Profiler, ProfilerDisabled
+from ..core.program import Program
+from ..core.program_library import ProgramLibrary
+from ..core.simulation import Simulation
+from ..core.startup import Startup
+from ..core.status_board import StatusBoard
+from ..core.status_publisher import StatusPublisher
+from ..util.bus_trace import decode as decode_bus_trace
 from ..util.sys_time import set_system_time
 
 api_bp = Blueprint('api_blueprint', __name__)
 
+REQUEST_SECONDS = Metrics.histogram(
+    'device_http_request_seconds', "Request latency per route",
+    ('endpoint', 'method')
+)
+
+# everything else is answered with 400
+EXCEPTION_STATUS_CODES = [
+    (NotAuthorized, status.HTTP_401_UNAUTHORIZED),
+    (ProfilerDisabled, status.HTTP_403_FORBIDDEN)
+]
+
+
+@api_bp.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@api_bp.after_request
+def observe_request_latency(response):
+    REQUEST_SECONDS.labels(request.endpoint, request.method).observe(
+        time.perf_counter() - g.request_start
+    )
+    return response
+
 
 def handle_exceptions(func):
     @wraps(func)
@@ -28,24 +64,141 @@ def handle_exceptions(func):
                 'traceback': traceback.extract_tb(tb).format()
             }
             print(content)
-            status_code = status.HTTP_400_BAD_REQUEST
+            status_code = next(
+                (
+                    status_code
+                    for exc_class, status_code in EXCEPTION_STATUS_CODES
+                    if isinstance(exc, exc_class)
+                ),
+                status.HTTP_400_BAD_REQUEST
+            )
             response = make_response((content, status_code))
         finally:
             return response
     return wrapper
 
 
-@api_bp.route("/program", methods=["POST", "DELETE"], endpoint='route_program')
+@api_bp.route(
+    "/program",
+    methods=["GET", "POST", "DELETE"], endpoint='route_program'
+)
 @handle_exceptions
 def route_program():
-    if request.method == "DELETE":
+    if request.method == "GET":
+        response = make_response(FireController.export_program())
+        response.mimetype = 'application/octet-stream'
+        return response
+    elif request.method == "DELETE":
         FireController.delete_program()
+    elif request.mimetype == 'application/octet-stream':
+        content_hash = FireController.load_binary_program(
+            request.get_data(),
+            request.args.get('program_name')
+        )
+        return make_response({'hash': content_hash})
     elif request.method == "POST":
-        FireController.load_program(
-            request.get_json(force=True)['commands'],
-            request.get_json(force=True)['program_name']
+        data = request.get_json(force=True)
+        progress = FireController.load_program(
+            data['commands'],
+            data['program_name'],
+            data.get('shift_tolerance')
+        )
+        return make_response(
+            ({'compilation': progress}, status.HTTP_202_ACCEPTED)
+        )
+
+    return make_response(dict())
+
+
+@api_bp.route("/show", methods=["POST"], endpoint='route_show')
+@handle_exceptions
+def route_show():
+    # builds a show (one artifact with the programs of every device) from a
+    # fleet-wide command list, any device can be asked to
+    data = request.get_json(force=True)
+    response = make_response(
+        Program.build_show(data['commands'], data['program_name'])
+    )
+    response.mimetype = 'application/octet-stream'
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=show.rlsh'
+    return response
+
+
+@api_bp.route(
+    "/program/compilation",
+    methods=["GET", "DELETE"], endpoint='route_program_compilation'
+)
+@handle_exceptions
+def route_program_compilation():
+    if request.method == "GET":
+        return make_response(
+            {'compilation': FireController.get_compilation_progress()}
+        )
+    elif request.method == "DELETE":
+        FireController.cancel_compilation()
+
+    return make_response(dict())
+
+
+@api_bp.route(
+    "/program/upload",
+    methods=["POST"], endpoint='route_program_upload'
+)
+@handle_exceptions
+def route_program_upload():
+    data = request.get_json(force=True)
+    action = data['action']
+    if action == 'begin':
+        FireController.begin_upload(data['program_name'])
+    elif action == 'append':
+        n_received = FireController.append_upload(
+            data['commands'], data.get('offset')
         )
+        return make_response({'received': n_received})
+    elif action == 'commit':
+        content_hash = FireController.commit_upload()
+        return make_response({'hash': content_hash})
+    elif action == 'abort':
+        FireController.abort_upload()
+    else:
+        raise ValueError()
+
+    return make_response(dict())
+
+
+@api_bp.route(
+    "/library", methods=["GET", "POST"], endpoint='route_library'
+)
+@handle_exceptions
+def route_library():
+    if request.method == "GET":
+        return make_response({
+            'programs': ProgramLibrary.list(),
+            'limits': ProgramLibrary.get_limits()
+        })
+    elif request.method == "POST":
+        data = request.get_json(force=True)
+        action = data['action']
+        if action == 'load':
+            FireController.load_program_by_hash(data['hash'])
+        elif action == 'limit':
+            ProgramLibrary.set_limits(
+                data.get('max_programs'), data.get('max_bytes')
+            )
+        else:
+            raise ValueError()
+
+        return make_response(dict())
+
 
+@api_bp.route(
+    "/library/<content_hash>", methods=["DELETE"],
+    endpoint='route_library_entry'
+)
+@handle_exceptions
+def route_library_entry(content_hash):
+    ProgramLibrary.evict(content_hash)
     return make_response(dict())
 
 
@@ -55,9 +208,10 @@ def route_program():
 )
 @handle_exceptions
 def route_program_control():
-    action = request.get_json(force=True)['action']
+    data = request.get_json(force=True)
+    action = data['action']
     if action == 'run':
-        FireController.run_program()
+        FireController.run_program(float(data.get('offset', 0.0)))
     elif action == 'pause':
         FireController.pause_program()
     elif action == 'continue':
@@ -66,7 +220,7 @@ def route_program_control():
         FireController.stop_program()
     elif action == 'schedule':
         FireController.schedule_program(
-            request.get_json(force=True)['time']
+            data['time'], float(data.get('offset', 0.0))
         )
     elif action == 'unschedule':
         FireController.unschedule_program()
@@ -76,25 +230,259 @@ def route_program_control():
     return make_response(dict())
 
 
+@api_bp.route(
+    "/program/bus-plan", methods=["GET"], endpoint='route_bus_plan'
+)
+@handle_exceptions
+def route_bus_plan():
+    return make_response(
+        {'bus_plan': FireController.get_bus_plan(request.args.get('lane'))}
+    )
+
+
+@api_bp.route(
+    "/program/simulate",
+    methods=["GET", "POST"], endpoint='route_program_simulate'
+)
+@handle_exceptions
+def route_program_simulate():
+    if request.method == "POST":
+        data = request.get_json(force=True, silent=True) or dict()
+        summary = Simulation.run(
+            FireController.export_program(), float(data.get('offset', 0.0))
+        )
+    else:
+        summary = Simulation.summary()
+    return make_response({'simulation': summary})
+
+
+@api_bp.route(
+    "/program/simulate/trace",
+    methods=["GET"], endpoint='route_program_simulate_trace'
+)
+@handle_exceptions
+def route_program_simulate_trace():
+    response = make_response(Simulation.trace_csv())
+    response.mimetype = 'text/csv'
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=simulation.csv'
+    return response
+
+
+@api_bp.route("/program/cues", methods=["GET"], endpoint='route_cues')
+@handle_exceptions
+def route_cues():
+    start = request.args.get('from', type=float)
+    end = request.args.get('to', type=float)
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(
+        request.args.get(
+            'limit', Config.get('cues', 'page_size'), type=int
+        ),
+        Config.get('cues', 'max_page_size')
+    )
+    if offset < 0 or limit < 0:
+        raise ValueError()
+    cues, total = FireController.get_cues(
+        start, end, offset, limit, request.args.get('lane')
+    )
+    return make_response({
+        'cues': cues,
+        'total': total,
+        'offset': offset,
+        'limit': limit
+    })
+
+
+@api_bp.route("/journal", methods=["GET"], endpoint='route_journal')
+@handle_exceptions
+def route_journal():
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(
+        request.args.get(
+            'limit', Config.get('journal', 'page_size'), type=int
+        ),
+        Config.get('journal', 'max_page_size')
+    )
+    if offset < 0 or limit < 0:
+        raise ValueError()
+    events, total = FireController.get_journal(
+        request.args.get('from', type=float),
+        request.args.get('to', type=float),
+        request.args.get('address'),
+        request.args.get('event'),
+        offset,
+        limit
+    )
+    return make_response({
+        'events': events,
+        'total': total,
+        'offset': offset,
+        'limit': limit
+    })
+
+
+@api_bp.route(
+    "/journal/recovery",
+    methods=["GET", "DELETE"], endpoint='route_journal_recovery'
+)
+@handle_exceptions
+def route_journal_recovery():
+    if request.method == "DELETE":
+        FireController.clear_journal_recovery()
+        return make_response(dict())
+    return make_response(
+        {'recovery': FireController.get_journal_recovery()}
+    )
+
+
+@api_bp.route("/lanes", methods=["GET", "POST"], endpoint='route_lanes')
+@handle_exceptions
+def route_lanes():
+    if request.method == "GET":
+        return make_response({'lanes': FireController.get_lanes()})
+    elif request.method == "POST":
+        data = request.get_json(force=True)
+        content_hash = FireController.load_lane(
+            data['lane'],
+            commands=data.get('commands'),
+            program_name=data.get('program_name'),
+            content_hash=data.get('hash')
+        )
+        return make_response({'hash': content_hash})
+
+
+@api_bp.route(
+    "/lanes/<lane_name>", methods=["POST", "DELETE"],
+    endpoint='route_lane'
+)
+@handle_exceptions
+def route_lane(lane_name):
+    if request.method == "DELETE":
+        FireController.delete_lane(lane_name)
+        return make_response(dict())
+
+    data = request.get_json(force=True)
+    action = data['action']
+    if action == 'run':
+        FireController.run_lane(lane_name, float(data.get('offset', 0.0)))
+    elif action == 'pause':
+        FireController.pause_lane(lane_name)
+    elif action == 'continue':
+        FireController.continue_lane(lane_name)
+    elif action == 'stop':
+        FireController.stop_lane(lane_name)
+    else:
+        raise ValueError()
+
+    return make_response(dict())
+
+
 @api_bp.route("/fire", methods=["POST", "GET"], endpoint='route_fire')
 @handle_exceptions
 def route_fire():
-    FireController.fire(request.get_json(force=True)['address'])
-    return make_response(dict())
+    data = request.get_json(force=True)
+    return make_response(
+        FireController.fire(data['address'], data.get('fire_time'))
+    )
+
+
+@api_bp.route(
+    "/fuse-status", methods=["GET"], endpoint='route_fuse_status'
+)
+@handle_exceptions
+def route_fuse_status():
+    fuse_format = request.args.get('format', VERBOSE)
+    return make_response({
+        'fuse_states': FireController.get_fuse_status(fuse_format),
+        'error_states': HardwareController.errors(fuse_format)
+    })
 
 
-@api_bp.route("/testloop", methods=["POST"], endpoint='route_testloop')
+@api_bp.route(
+    "/testloop", methods=["GET", "POST"], endpoint='route_testloop'
+)
 @handle_exceptions
 def route_testloop():
-    FireController.testloop()
+    if request.method == "GET":
+        return make_response(
+            {'testloop': FireController.get_testloop_results()}
+        )
+    data = request.get_json(force=True, silent=True) or dict()
+    FireController.testloop(data.get('pattern'), data.get('verify'))
     return make_response(dict())
 
 
+@api_bp.route(
+    "/bus-trace", methods=["GET", "POST"], endpoint='route_bus_trace'
+)
+@handle_exceptions
+def route_bus_trace():
+    if request.method == "POST":
+        action = request.get_json(force=True)['action']
+        if action == 'freeze':
+            trace_status = HardwareController.freeze_trace()
+        elif action == 'unfreeze':
+            trace_status = HardwareController.unfreeze_trace()
+        elif action == 'clear':
+            trace_status = HardwareController.clear_trace()
+        else:
+            raise ValueError()
+        return make_response({'bus_trace': trace_status})
+
+    if request.args.get('format') == 'timeline':
+        trace = decode_bus_trace(HardwareController.dump_trace())
+        for record in trace:
+            record['wall_time'] = record['wall_time'].isoformat()
+        return make_response({
+            'bus_trace': HardwareController.get_trace_status(),
+            'timeline': trace
+        })
+
+    response = make_response(HardwareController.dump_trace())
+    response.mimetype = 'application/octet-stream'
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=bus-trace.bin'
+    return response
+
+
+@api_bp.route(
+    "/profiler", methods=["GET", "POST"], endpoint='route_profiler'
+)
+@handle_exceptions
+def route_profiler():
+    Profiler.check_token(request.headers.get('Authorization'))
+    if request.method == "POST":
+        data = request.get_json(force=True)
+        action = data['action']
+        if action == 'start':
+            profiler_status = Profiler.start(
+                data.get('duration'),
+                data.get('interval'),
+                data.get('force', False)
+            )
+        elif action == 'stop':
+            profiler_status = Profiler.stop()
+        else:
+            raise ValueError()
+        return make_response({'profiler': profiler_status})
+
+    if request.args.get('format') == 'collapsed':
+        response = make_response(Profiler.collapsed())
+        response.mimetype = 'text/plain'
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=profile.folded'
+        return response
+    return make_response({'profiler': Profiler.status()})
+
+
 @api_bp.route("/lock", methods=["GET", "POST"], endpoint='route_lock')
 @handle_exceptions
 def route_lock():
     if request.method == "GET":
-        return make_response({'locked': HardwareController.is_locked()})
+        return make_response(
+            {'locked': StatusBoard.shared().read()['locked']}
+        )
     elif request.method == "POST":
         action = request.get_json(force=True)['action']
         if action == 'lock':
@@ -104,9 +492,50 @@ def route_lock():
         else:
             raise ValueError
 
+        StatusPublisher.publish(hardware=True)
         return make_response(dict())
 
 
+@api_bp.route("/status", methods=["GET"], endpoint='route_status')
+@handle_exceptions
+def route_status():
+    board_status = StatusBoard.shared().read()
+    scheduled_time = board_status['scheduled_time']
+    return make_response({
+        'program_state': board_status['program_state'],
+        'scheduled_time': (
+            None if scheduled_time is None else scheduled_time.isoformat()
+        ),
+        'program_name': board_status['program_name'],
+        'program_hash': board_status['program_hash'],
+        'locked': board_status['locked'],
+        'published_time': board_status['published_time'].isoformat(),
+        'system_time': datetime.now().isoformat()
+    })
+
+
+@api_bp.route("/ready", methods=["GET"], endpoint='route_ready')
+@handle_exceptions
+def route_ready():
+    startup_status = Startup.status()
+    if startup_status['ready']:
+        return make_response(startup_status)
+    return make_response(
+        (startup_status, status.HTTP_503_SERVICE_UNAVAILABLE)
+    )
+
+
+@api_bp.route("/metrics", methods=["GET"], endpoint='route_metrics')
+@handle_exceptions
+def route_metrics():
+    collections = {'main': Metrics.collect()}
+    if ExecutionProcess.is_active():
+        collections['execution'] = Metrics.collect_execution()
+    response = make_response(Metrics.render(collections))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
+
 @api_bp.route(
     "/master-registration",
     methods=["POST", "DELETE"], endpoint='route_master_listener'
@@ -133,6 +562,23 @@ def route_master_listener():
     return make_response(response)
 
 
+@api_bp.route(
+    "/heartbeat", methods=["GET", "POST"],
+    endpoint='route_heartbeat'
+)
+@handle_exceptions
+def route_heartbeat():
+    if request.method == "GET":
+        return make_response(MasterCommunicator.get_heartbeat_stats())
+    elif request.method == "POST":
+        action = request.get_json(force=True)['action']
+        if action == 'keyframe':
+            MasterCommunicator.request_keyframe()
+        else:
+            raise ValueError()
+        return make_response(dict())
+
+
 @api_bp.route(
     "/system-time", methods=["GET", "POST"],
     endpoint='route_system_time'
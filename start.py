@@ -1,9 +1,15 @@
-from device import app
+import os
+
+from device import Startup, app
 from device.core.config import Config
 
 debug = True
 
 if __name__ == '__main__':
+    # with the reloader the first process only watches the sources and
+    # restarts the serving child, which werkzeug marks with WERKZEUG_RUN_MAIN
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        Startup.start()
     if debug:
         app.run(
             use_debugger=True,